@@ -0,0 +1,186 @@
+# coding=utf-8
+'''
+benchmark of the monthly payment cycle through the flask test client.
+example:
+    python gen_dataset.py --uri sqlite:////tmp/100k.db --scale 100k \
+        --out /tmp/100k
+    python bench_endpoints.py --uri sqlite:////tmp/100k.db --files /tmp/100k \
+        --output results.json --baseline baseline.json
+the scenarios run in the order of a month: upload the bank should pay file,
+check it, make the bank grant zip, mark the month success with the fail
+list, make the public report, then the search pages.
+for every scenario the wall time, the growth of the peak rss (kB) while it
+ran and the statements executed (X-SQL-Count) are written to --output.
+with --baseline the results are compared and the exit code is 1 if a
+scenario got slower or ran more statements than --tolerance allows, or
+answered with another status than the baseline or not 200/302.
+the scenarios change the data, a sqlite database is copied first unless
+--in-place; run other backends against a freshly generated database.
+'''
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import argparse
+from datetime import date
+from controller import app
+
+PER_PAGE = 10
+OK_STATUS = (200, 302)
+
+
+def _upload(url, name, **data):
+    def run(client, files):
+        with open(os.path.join(files, name), 'rb') as f:
+            form = dict(data, file=(io.BytesIO(f.read()), name))
+        return client.post(url, data=form,
+                           content_type='multipart/form-data')
+    return run
+
+
+def _get(url):
+    return lambda client, files: client.get(url)
+
+
+def _batch_success(peroid):
+    def run(client, files):
+        with open(os.path.join(files, 'fails.txt'), 'rb') as f:
+            fails = f.read().decode('utf-8')
+        return client.post('/paybook/batchsuccess', data=dict(
+            peroid=peroid, fails=fails))
+    return run
+
+
+def scenarios(peroid):
+    '''(name, fun(client, files folder) -> response) in running order'''
+    peroid = peroid.strftime('%Y-%m-%d')
+    search = '/{}/page/1/perpage/{}/search'
+    return (
+        ('paybook upload', _upload(
+            '/paybook/upload?peroid={}'.format(peroid), 'paybook.csv')),
+        ('paybook check', _upload('/paybook/check', 'paybook.csv')),
+        ('paybook bankgrant', _get(
+            '/paybook/bankgrant?peroid={}'.format(peroid))),
+        ('paybook batchsuccess', _batch_success(peroid)),
+        ('paybook public', _get(
+            '/paybook/public?mindate={0}&maxdate={0}'.format(peroid))),
+        ('person search', _get(
+            search.format('person', PER_PAGE) + u'?name=王伟')),
+        ('bankcard search', _get(
+            search.format('bankcard', PER_PAGE) + '?idcard=4205251951')),
+        ('address search', _get(
+            search.format('address', PER_PAGE) + '?name=village1')),
+        ('paybook bank search', _get(
+            '/paybook/page/1/perpage/{}/bank/search?peroid={}'.format(
+                PER_PAGE, peroid[:7].replace('-', '')))),
+        ('paybook sys search', _get(
+            '/paybook/page/1/perpage/{}/sys/search?all=true'.format(
+                PER_PAGE))),
+    )
+
+
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(files, peroid, names=None, user='admin', password='admin'):
+    '''dict of scenario name: measures'''
+    client = app.test_client()
+    rv = client.post('/login', data=dict(name=user, password=password))
+    if rv.status_code != 302:
+        raise RuntimeError('login as {} failed'.format(user))
+    results = {}
+    for name, fun in scenarios(peroid):
+        if names and name not in names:
+            continue
+        rss = _peak_rss()
+        start = time.time()
+        rv = fun(client, files)
+        size = len(rv.data)
+        results[name] = dict(
+            seconds=round(time.time() - start, 4),
+            rss_growth_kb=_peak_rss() - rss,
+            queries=int(rv.headers.get('X-SQL-Count', -1)),
+            status=rv.status_code,
+            bytes=size)
+        print('{:<24}{:>10.3f}s{:>10} queries{:>8}'.format(
+            name, results[name]['seconds'], results[name]['queries'],
+            rv.status_code))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''print the changes, return names of the regressed scenarios'''
+    regressed = []
+    print('{:<24}{:>12}{:>12}{:>10}{:>10}{:>6}{:>6}'.format(
+        'scenario', 'base(s)', 'now(s)', 'base(q)', 'now(q)', 'base',
+        'now'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        now, base = results[name], baseline[name]
+        slower = now['seconds'] > base['seconds'] * (1 + tolerance)
+        more_queries = now['queries'] > base['queries'] * (1 + tolerance)
+        failed = (now['status'] != base.get('status') or
+                  now['status'] not in OK_STATUS)
+        if slower or more_queries or failed:
+            regressed.append(name)
+        print('{:<24}{:>12.3f}{:>12.3f}{:>10}{:>10}{:>6}{:>6}{}'.format(
+            name, base['seconds'], now['seconds'], base['queries'],
+            now['queries'], base.get('status'), now['status'],
+            ' REGRESSED' if name in regressed else ''))
+    return regressed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='benchmark the payment workflow endpoints')
+    parser.add_argument('--uri', dest='uri', required=True,
+                        help='database uri made by gen_dataset')
+    parser.add_argument('--files', dest='files', required=True,
+                        help='folder of the files made by gen_dataset')
+    parser.add_argument('--period', dest='period',
+                        help='month of the files, as 201703, default now')
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        help='run only this scenario, may repeat')
+    parser.add_argument('--output', dest='output',
+                        help='json file for the results')
+    parser.add_argument('--baseline', dest='baseline',
+                        help='json results to compare with')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        default=0.2, help='allowed slow down, 0.2 is 20%%')
+    parser.add_argument('--in-place', dest='in_place', action='store_true',
+                        help="don't copy a sqlite database first")
+    args = parser.parse_args()
+    uri, copy = args.uri, None
+    if uri.startswith('sqlite:///') and not args.in_place:
+        fd, copy = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        shutil.copyfile(uri[len('sqlite:///'):], copy)
+        uri = 'sqlite:///' + copy
+    app.config.from_pyfile(os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), 'config.cfg'),
+        silent=True)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=uri, SQLALCHEMY_ECHO=False, DEBUG=False,
+        WTF_CSRF_ENABLED=False, SQL_STATS=True)
+    today = date.today()
+    peroid = date(today.year, today.month, 1)
+    if args.period:
+        peroid = date(int(args.period[:4]), int(args.period[4:6]), 1)
+    try:
+        results = run(args.files, peroid, args.scenarios)
+    finally:
+        if copy:
+            os.remove(copy)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            sys.exit(1)
@@ -0,0 +1,75 @@
+# coding=utf-8
+'''
+benchmark of the prefix searches with and without the search indexes.
+example:
+    python bench_search.py --uri sqlite:////tmp/bench.db --count 1000000
+the database at uri is filled by gen_dataset (without paybooks) if its
+persons table is empty.
+'''
+import argparse
+import time
+from models import app, db, Person, Bankcard, Address
+from search_index import (
+    create_search_indexes, drop_search_indexes, prefix_like, person_ids_like,
+    address_ids_like)
+from gen_dataset import generate
+
+
+def _searches():
+    '''the filters used by person_search, bankcard_search, address_search'''
+    return (
+        ('person idcard', lambda: Person.query.filter(
+            prefix_like(Person.idcard, '4205251951'))),
+        ('person name', lambda: Person.query.filter(
+            prefix_like(Person.name, u'王伟'))),
+        ('person address', lambda: Person.query.filter(
+            Person.address_id.in_(address_ids_like(u'village7-1')))),
+        ('bankcard no', lambda: Bankcard.query.filter(
+            prefix_like(Bankcard.no, '62280000005'))),
+        ('bankcard idcard', lambda: Bankcard.query.filter(
+            Bankcard.owner_id.in_(person_ids_like(
+                Person.idcard, '4205251951')))),
+        ('address name', lambda: Address.query.filter(
+            prefix_like(Address.name, u'village1'))),
+    )
+
+
+def _run(repeat, per_page=10):
+    result = []
+    for name, make_query in _searches():
+        start = time.time()
+        for i in range(repeat):
+            query = make_query()
+            query.limit(per_page).all()
+            query.order_by(None).count()
+        result.append((name, (time.time() - start) * 1000 / repeat))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='benchmark prefix searches with and without indexes')
+    parser.add_argument('--uri', dest='uri', required=True,
+                        help='database uri, the data is created if empty')
+    parser.add_argument('--count', dest='count', type=int, default=1000000,
+                        help='persons to create')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='times every search runs')
+    args = parser.parse_args()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.uri
+    app.config['SQLALCHEMY_ECHO'] = False
+    db.create_all()
+    if Person.query.count() == 0:
+        start = time.time()
+        generate(args.count, years=0)
+        print('filled {} persons in {:.1f}s'.format(
+            args.count, time.time() - start))
+    drop_search_indexes()
+    without = _run(args.repeat)
+    start = time.time()
+    create_search_indexes()
+    print('created indexes in {:.1f}s'.format(time.time() - start))
+    with_index = _run(args.repeat)
+    print('{:<20}{:>16}{:>16}'.format('search', 'no index(ms)', 'index(ms)'))
+    for (name, before), (_, after) in zip(without, with_index):
+        print('{:<20}{:>16.2f}{:>16.2f}'.format(name, before, after))
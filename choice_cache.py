@@ -0,0 +1,96 @@
+# coding=utf-8
+'''
+cached (id, name) choice lists for the select fields of forms.
+a list is loaded once per table (and once per user address scope) and
+dropped when a commit of this process inserts, updates or deletes rows of
+its table. other processes' changes show up after TTL_SECONDS.
+'''
+import time
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from models import db, Address, Standard, PayBookItem, Role
+
+
+class ChoiceCache(object):
+    '''choice tuples by (model, scope)'''
+
+    MODELS = (Address, Standard, PayBookItem, Role)
+    TTL_SECONDS = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generations = dict((model, 0) for model in self.MODELS)
+
+    def get(self, model, scope=None):
+        '''
+        tuple of (id, name) of model ordered by id.
+        scope: frozenset of ids, only those rows are returned.
+        '''
+        key = (model, scope)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            generation = self.generations[model]
+        if entry is not None and now - entry[0] <= self.TTL_SECONDS:
+            return entry[1]
+        if scope is None:
+            rows = tuple(
+                (row.id, row.name) for row in
+                db.session.query(model.id, model.name).order_by(model.id))
+        else:
+            rows = tuple(row for row in self.get(model) if row[0] in scope)
+        with self.lock:
+            # a commit during the load makes rows stale, don't keep them
+            if self.generations[model] == generation:
+                self.entries[key] = (now, rows)
+        return rows
+
+    def invalidate(self, *models):
+        with self.lock:
+            for model in models:
+                self.generations[model] += 1
+            self.entries = dict(
+                (key, entry) for key, entry in self.entries.items()
+                if key[0] not in models)
+
+
+choice_cache = ChoiceCache()
+
+
+def choices(model, scope=None, exclude=()):
+    '''new list of (id, name) of model, without the ids in exclude'''
+    return [row for row in choice_cache.get(model, scope)
+            if row[0] not in exclude]
+
+
+def _remember_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('choice_changes', set()).add(type(target))
+
+
+for _model in ChoiceCache.MODELS:
+    for _name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _name, _remember_change)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _remember_bulk_change(context):
+    if context.mapper.class_ in ChoiceCache.MODELS:
+        context.session.info.setdefault(
+            'choice_changes', set()).add(context.mapper.class_)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_choices(session):
+    changes = session.info.pop('choice_changes', None)
+    if changes:
+        choice_cache.invalidate(*changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_choice_changes(session, previous_transaction):
+    session.info.pop('choice_changes', None)
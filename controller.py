@@ -3,11 +3,16 @@ import io
 import csv
 import codecs
 import re
-from zipfile import ZipFile
+import json
+import shutil
+from decimal import Decimal, InvalidOperation
+from zipfile import ZipFile, is_zipfile
 from functools import wraps
 from collections import namedtuple
 from datetime import datetime, date
-from sqlalchemy import exists, and_, or_, false, func
+import numpy
+from sqlalchemy import (
+    exists, and_, or_, false, true, func, select, literal, case)
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from werkzeug.routing import BaseConverter
@@ -25,14 +30,25 @@ from flask_principal import (
 from models import (
     app, db, paginate, User, Role, Address, Person, OperationLog,
     PersonStatusError, PersonAgeError, Standard, Bankcard, Note, PayBookItem,
-    PayBook)
+    PayBook, Job, PeroidClose, PeroidClosedError, UploadFingerprint, ledger)
 from flask_wtf.csrf import CsrfProtect
 from forms import (
     Form, LoginForm, ChangePasswordForm, UserForm, AdminAddRoleForm,
     AdminRemoveRoleForm, RoleForm, PeroidForm, AddressForm, PersonForm,
     DateForm, StandardForm, StandardBindForm, BankcardForm, BankcardBindForm,
     NoteForm, PayItemForm, AmendForm, BatchSuccessFrom, FailCorrectForm,
-    SuccessCorrectForm, AdminUserBindaddrForm)
+    SuccessCorrectForm, AdminUserBindaddrForm, ProfileForm)
+from search_index import prefix_like, person_ids_like, address_ids_like
+from prefix_index import autocomplete, AutocompleteService
+from user_cache import user_cache, CachedUser
+from sql_stats import SqlStats
+from profiler import RequestProfiler
+from metrics import Metrics
+from jobs import job_queue, INPUT
+from uploads import upload_spool, OffsetError, SizeError
+from grant_cache import grant_cache, mark as grant_mark
+from replica import mark_write
+from ledger_columns import ledger_columns, month_index, month_date
 
 
 def __find_obj_or_404(cls, union_field, val):
@@ -123,6 +139,11 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 CsrfProtect(app)
+SqlStats(app)
+profiler = RequestProfiler(app)
+Metrics(app, db)
+job_queue.init_app(app)
+upload_spool.init_app(app)
 Principal(app)
 admin_required = Permission(RoleNeed('admin')).require(403)
 person_admin_required = Permission(RoleNeed('person_admin')).require(403)
@@ -239,12 +260,51 @@ class DbLogger(object):
         request.log_content = request.log_template.render(**kwargs)\
             if request.log_template else None
 
+    @classmethod
+    def log_each(cls, method, remarks, chunk_size=5000):
+        '''
+        bulk insert one log per remark for batch operations,
+        the request log rendered by log() is still written by log_template.
+        '''
+        table = OperationLog.__table__
+        now = datetime.now()
+        chunk = []
+        for remark in remarks:
+            chunk.append(dict(operator_id=current_user.id, method=method,
+                              remark=remark, time=now))
+            if len(chunk) >= chunk_size:
+                db.session.execute(table.insert(), chunk)
+                chunk = []
+        if chunk:
+            db.session.execute(table.insert(), chunk)
+
+
+class BalanceRow(object):
+    '''
+    grouped money of a person's bankcard and item, with the item name and
+    the binding of the card, not a PayBook so nothing is added or flushed.
+    '''
+
+    __slots__ = ('person_id', 'bankcard_id', 'bankcard_no', 'binded',
+                 'item_id', 'item_name', 'peroid', 'money')
+
+    def __init__(self, person_id, bankcard_id, bankcard_no, binded, item_id,
+                 item_name, peroid, money):
+        self.person_id = person_id
+        self.bankcard_id = bankcard_id
+        self.bankcard_no = bankcard_no
+        self.binded = binded
+        self.item_id = item_id
+        self.item_name = item_name
+        self.peroid = peroid
+        self.money = money
+
 
 class PayBookManager(object):
     def __init__(self, person, *items):
+        self._items = []
         self.person = person
         self.items = items
-        self.refresh_query()
 
     def refresh_query(self):
         self.query = PayBook.query.filter(PayBook.money != 0)
@@ -261,8 +321,8 @@ class PayBookManager(object):
             PayBook.person_id == self.person.id)
 
     def item_filter(self, query):
-        return query if self.items else query.filter(
-            PayBook.item_in(*self.items))
+        return query.filter(PayBook.item_id.in_(
+            map(lambda item: item.id, self.items))) if self.items else query
 
     def query_filter(self, query=None):
         if query is None:
@@ -294,8 +354,8 @@ class PayBookManager(object):
     def items(self, items):
         self._items = map(
             lambda item: (PayBookItem.query.filter(
-                PayBookItem.name == item).first() if isinstance(item, str) else
-                item),
+                PayBookItem.name == item).first()
+                if isinstance(item, basestring) else item),
             items)
         self.refresh_query()
 
@@ -328,18 +388,11 @@ class PayBookManager(object):
         return result
 
     def settle_to(self, item, bankcard, remark=None):
-        if self.query.count() == 0:
-            return
-        books = self.query.all()
-        for book in books:
-            db.session.add(PayBook(**self.__create_dict(
-                book.item, book.bankcard, -book.money, self.current_peroid,
-                remark)))
-        money = reduce(lambda a, b: a + b.money, books, 0.0)
-        if abs(money) >= 0.01:
-            db.session.add(PayBook(**self.__create_dict(
-                item, bankcard, money, self.current_peroid, remark)))
-        db.session.commit()
+        '''settle the books of person, PayBookLedger settles all persons'''
+        if self.person is None:
+            raise RuntimeError("person can't be None")
+        PayBookLedger([self.person.id], *self.items).settle_to(
+            item, bankcard, remark)
 
     def create_tuple(self, bankcard1, bankcard2, item1, item2, money,
                      remark=None, commit=True):
@@ -355,40 +408,208 @@ class PayBookManager(object):
         return lst
 
     def lst_groupby_bankcard(self, negative=True, groupby_peroid=False):
-        money = func.sum(PayBook.money).label('money')
+        return PayBookLedger([self.person.id], *self.items).\
+            lst_groupby_bankcard(negative, groupby_peroid).get(
+                self.person.id, [])
+
+
+def _id(obj):
+    return obj if obj is None or isinstance(obj, (int, long)) else obj.id
+
+
+class PayBookLedger(object):
+    '''
+    the PayBookManager operations over many persons at once, for the batch
+    operations. the items are read once, the sums and groups are grouped
+    queries by person, the new paybooks are inserted batch_size rows a
+    statement by flush() and commit().
+    person_ids: ids of the persons, None for all of them.
+    items: PayBookItems, their ids or names.
+    '''
+    batch_size = 1000
+    # persons of an IN list
+    chunk_size = 500
+
+    def __init__(self, person_ids=None, *items):
+        self.person_ids = None if person_ids is None else set(person_ids)
+        names = [item for item in items if isinstance(item, basestring)]
+        by_name = self.items_by_name(*names)
+        self.item_ids = [
+            by_name[item].id if isinstance(item, basestring) else _id(item)
+            for item in items]
+        self.rows = []
+        self.peroids = set()
+
+    @staticmethod
+    def items_by_name(*names):
+        '''dict of name: PayBookItem, by one query'''
+        if not names:
+            return {}
+        return dict((item.name, item) for item in PayBookItem.query.filter(
+            PayBookItem.name.in_(names)))
+
+    @property
+    def current_peroid(self):
+        now = datetime.now()
+        return date(now.year, now.month, 1)
+
+    def clauses(self):
+        '''the filter of the items and of every chunk of the persons'''
+        items = PayBook.item_id.in_(self.item_ids) if self.item_ids \
+            else true()
+        if self.person_ids is None:
+            yield items
+            return
+        person_ids = sorted(self.person_ids)
+        for i in range(0, len(person_ids), self.chunk_size):
+            yield and_(items, PayBook.person_id.in_(
+                person_ids[i:i + self.chunk_size]))
+
+    def queries(self, query):
+        '''query filtered by items and by every chunk of the persons'''
+        for clause in self.clauses():
+            yield query.filter(clause)
+
+    def sum_money(self, bankcard=None, peroid=None):
+        '''dict of person_id: money'''
         query = db.session.query(
-            PayBook.bankcard_id,
-            PayBook.item_id,
-            PayBook.peroid,
-            money,
-            PayBook.peroid)
-        query = self.query_filter(query)
-        groupby_lst = [PayBook.bankcard_id, PayBook.item_id]
+            PayBook.person_id, func.sum(PayBook.money)).group_by(
+                PayBook.person_id)
+        if bankcard:
+            query = query.filter(PayBook.bankcard_id == _id(bankcard))
+        if peroid:
+            query = query.filter(PayBook.in_peroid(peroid))
+        result = {}
+        for chunk in self.queries(query):
+            result.update(chunk.all())
+        return result
+
+    def lst_groupby_bankcard(self, negative=True, groupby_peroid=False):
+        '''
+        dict of person_id: [BalanceRow] of the money of every bankcard and
+        item, of every peroid too if groupby_peroid, by one query a chunk.
+        '''
+        money = func.sum(PayBook.money).label('money')
+        groupby_lst = [PayBook.person_id, PayBook.bankcard_id, Bankcard.no,
+                       Bankcard.owner_id, PayBook.item_id, PayBookItem.name]
         if groupby_peroid:
-            groupby_lst.append(PayBook.peroid)
-        query = query.group_by(*groupby_lst)
-        if negative:
-            query = query.having(money < 0)
+            groupby_lst.append(PayBook._peroid)
+        query = db.session.query(*(groupby_lst + [money])).join(
+            PayBookItem, PayBookItem.id == PayBook.item_id).outerjoin(
+                Bankcard, Bankcard.id == PayBook.bankcard_id).group_by(
+                    *groupby_lst).having(
+                        money < 0 if negative else money > 0)
+        result = {}
+        for chunk in self.queries(query):
+            for row in chunk:
+                result.setdefault(row.person_id, []).append(BalanceRow(
+                    row.person_id, row.bankcard_id, row.no,
+                    row.owner_id is not None, row.item_id, row.name,
+                    row._peroid if groupby_peroid else None, row.money))
+        return result
+
+    def add(self, person_id, item, bankcard, money, peroid=None,
+            remark=None):
+        '''queue one new paybook, flushed batch_size at a time'''
+        peroid = peroid or self.current_peroid
+        self.rows.append(dict(
+            person_id=_id(person_id), bankcard_id=_id(bankcard),
+            item_id=_id(item), create_user_id=current_user.id, money=money,
+            _peroid=peroid, remark=remark))
+        self.peroids.add(peroid)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def create_tuple(self, person_id, bankcard1, bankcard2, item1, item2,
+                     money, remark=None):
+        '''queue a tuple of person'''
+        self.add(person_id, item1, bankcard1, -money, remark=remark)
+        self.add(person_id, item2, bankcard2, money, remark=remark)
+
+    def settle_to(self, item, bankcard, remark=None):
+        '''
+        settle the books of every person to item, bankcard is a dict of
+        person_id: bankcard or one bankcard for all of them.
+        two INSERT ... SELECT a chunk of persons: the books negated, then
+        the net money of every person, so the money stays Decimal.
+        '''
+        self.flush()
+        peroid = self.current_peroid
+        self.check_peroids([peroid])
+        max_id = db.session.query(func.max(PayBook.id)).scalar()
+        if max_id is None:
+            return
+        books = PayBook.__table__.c
+        names = ['person_id', 'bankcard_id', 'item_id', 'money',
+                 'create_user_id', '_peroid', 'create_date', 'remark']
+        constants = [literal(current_user.id), literal(peroid, db.Date),
+                     literal(date.today(), db.Date),
+                     literal(remark, db.String)]
+        if isinstance(bankcard, dict):
+            to_bankcard = case(dict(
+                (person_id, _id(value)) for person_id, value in
+                bankcard.items()), value=books.person_id)
         else:
-            query = query.having(money > 0)
-        return map(
-            lambda row: PayBook(
-                bankcard_id=row.bankcard_id,
-                person_id=self.person.id,
-                item_id=row.item_id,
-                create_user_id=current_user.id,
-                money=row.money,
-                peroid=self.current_peroid),
-            query.all())
+            to_bankcard = literal(_id(bankcard), db.Integer)
+        money = func.sum(books.money)
+        for clause in self.clauses():
+            # the books settled are the ones there before the settlement
+            clause = and_(clause, books.id <= max_id)
+            db.session.execute(PayBook.__table__.insert().from_select(
+                names, select([
+                    books.person_id, books.bankcard_id, books.item_id,
+                    -books.money] + constants).where(and_(
+                        clause, books.money != 0))))
+            db.session.execute(PayBook.__table__.insert().from_select(
+                names, select([
+                    books.person_id, to_bankcard,
+                    literal(_id(item), db.Integer), money] +
+                    constants).where(clause).group_by(
+                        books.person_id).having(func.abs(money) >= 0.01)))
+        grant_mark(db.session, peroid)
+        mark_write(db.session)
+        db.session.commit()
+
+    def check_peroids(self, peroids):
+        closed = PeroidClose.closed(peroids)
+        if closed:
+            raise PeroidClosedError('peroid {} closed'.format(','.join(
+                peroid.strftime('%Y%m') for peroid in sorted(closed))))
+
+    def flush(self):
+        '''insert the queued paybooks'''
+        if not self.rows:
+            return
+        self.check_peroids(self.peroids)
+        db.session.execute(PayBook.__table__.insert(), self.rows)
+        grant_mark(db.session, *self.peroids)
+        mark_write(db.session)
+        self.rows = []
+
+    def commit(self):
+        self.flush()
+        db.session.commit()
+
+
+def _in_background():
+    '''should the request queue a job instead of doing the work'''
+    return BooleanConverter.to_python(request.args.get('background'))
+
+
+def _queued(job):
+    return flask.jsonify(
+        job=job.id, status=url_for('job_status', pk=job.id)), 202
+
+
+def _user_address_ids():
+    '''ids of current user's address and its descendants'''
+    return list(current_user.address_ids) or [current_user.address_id]
 
 
 def person_addr_filter(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        address_ids = map(
-            lambda a: a.id,
-            current_user.address and current_user.address.descendants or [])
-        address_ids.append(current_user.address_id)
+        address_ids = _user_address_ids()
         old_person_query, old_bankcard_query\
             = Person.query, Bankcard.query
         Person.query = Person.query.filter(
@@ -407,9 +628,10 @@ def person_addr_filter(f):
 
 @login_manager.user_loader
 def load_user(userid):
-    try:
-        user = User.query.filter(User.id == userid).one()
-    except NoResultFound:
+    snapshot = user_cache.get(int(userid))
+    if snapshot is not None:
+        user = CachedUser(snapshot)
+    else:
         user = {
             'is_authenticated': (lambda: False),
             'is_active': (lambda: False),
@@ -427,16 +649,16 @@ class AddressAccessPermission(Permission):
 @identity_loaded.connect_via(app)
 def on_identity_loaded(sender, identity):
     identity.user = current_user
-    if hasattr(current_user, 'id'):
-        identity.provides.add(UserNeed(current_user.id))
-    if hasattr(current_user, 'roles') and current_user.roles:
-        for role in current_user.roles:
-            identity.provides.add(RoleNeed(role.name))
-    if hasattr(current_user, 'address') and current_user.address:
-        ids = [address.id for address in current_user.address.descendants]
-        ids.append(current_user.address.id)
-        for id in ids:
-            identity.provides.add(AddressAccessPermission(id))
+    if not hasattr(current_user, 'id'):
+        return
+    identity.provides.add(UserNeed(current_user.id))
+    snapshot = user_cache.get(current_user.id)
+    if snapshot is None:
+        return
+    for name in snapshot.role_names:
+        identity.provides.add(RoleNeed(name))
+    for id in snapshot.address_ids:
+        identity.provides.add(AddressAccessPermission(id))
 
 
 @app.errorhandler(404)
@@ -496,7 +718,7 @@ def lst2csv(lst):
 def url_for_other_page(page, per_page):
     args = request.view_args.copy()
     args.update(**request.args)
-    args['page'] = page,
+    args['page'] = page
     args['per_page'] = per_page
     return url_for(request.endpoint, **args)
 
@@ -737,8 +959,7 @@ def admin_user_detail(pk):
 def admin_user_search(page, per_page):
     name = request.args.get('name')
     if name:
-        query = User.query.filter(
-            User.name.like('{}%'.decode('utf-8').format(name)))
+        query = User.query.filter(prefix_like(User.name, name))
     else:
         query = User.query
     return render_template(
@@ -791,8 +1012,7 @@ def admin_role_search(page, per_page):
     name = request.args.get('name')
     query = Role.query
     if name:
-        query = query.filter(
-            Role.name.like('{}%'.decode('utf-8').format(name)))
+        query = query.filter(prefix_like(Role.name, name))
     return render_template('role_search.html',
                            pagination=query.paginate(page, per_page))
 
@@ -850,6 +1070,35 @@ def admin_log_clean(operator_id):
     return render_template('admin_log_clean.html', form=form, user=user)
 
 
+@app.route('/admin/profile', methods=['GET', 'POST'])
+@admin_required
+@DbLogger.log_template('{{ settings }}')
+def admin_profile():
+    settings = profiler.settings
+    form = ProfileForm(
+        request.form,
+        endpoints=','.join(settings['endpoints']),
+        users=','.join(map(str, settings['users'])),
+        fraction=settings['fraction'])
+    if request.method == 'POST' and form.validate_on_submit():
+        settings = form.populate_obj({})
+        profiler.save_settings(**settings)
+        DbLogger.log(settings=json.dumps(settings))
+        return 'success'
+    return render_template('admin_profile.html', form=form,
+                           captures=profiler.captures())
+
+
+@app.route('/admin/profile/<name>', methods=['GET'])
+@admin_required
+def admin_profile_detail(name):
+    report = profiler.report(name)
+    if report is None:
+        abort(404)
+    return render_template('admin_profile_detail.html', name=name,
+                           report=report.decode('utf-8', 'replace'))
+
+
 @app.route('/address/add', methods=['GET', 'POST'])
 @admin_required
 @DbLogger.log_template('{{ address.id }}')
@@ -914,15 +1163,12 @@ def address_edit(pk):
 def address_search(page, per_page):
     name = (lambda x: x != 'None' and x or None)(request.args.get('name'))
     query = Address.query
-    if current_user.address:
-        address_ids = map(lambda a: a.id, current_user.address.descendants)
-        address_ids.append(current_user.address.id)
-        query = query.filter(Address.id.in_(address_ids))
+    if current_user.address_ids:
+        query = query.filter(Address.id.in_(current_user.address_ids))
     else:
         query = query.filter(false())
     if name:
-        query = query.filter(
-            Address.name.like('{}%'.decode('utf-8').format(name)))
+        query = query.filter(prefix_like(Address.name, name))
     return render_template(
         'address_search.html', pagination=query.paginate(page, per_page))
 
@@ -954,23 +1200,35 @@ def person_add():
 def person_upload():
     form = Form(request.form)
     if request.method == 'POST' and form.validate_on_submit():
-        f = request.files.get('file')
-        if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
-            f.seek(0)
-        persons = []
-        Reader = namedtuple(
-            'Reader', 'idcard,name,address_no,address_detail,securi_no')
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'person_upload', current_user.id, request.files.get('file')))
+        return _upload_result(_person_upload(request.files.get('file')))
+    return render_template('upload.html', form=form)
 
-        def idcard2birthday(idcard):
-            return datetime.strptime(idcard[6:14], '%Y%m%d').date()
-        for no, fields in enumerate(csv.reader(f)):
-            record = Reader._make(fields)
-            if not (re.match(r'^\d{17}[\d|X]$', record.idcard)
-                    and re.match(r'^[\w\W]+[号|组]$', record.address_detail)):
-                flash(('Syntax error in upload file at line:{},' +
-                       ' content:{}').format(no, fields))
-                abort(500)
-            # fields = map(lambda x: x.decode('utf-8'), fields)
+
+def _person_upload(f, progress=None):
+    '''
+    register the persons of csv file f, the numbers of the lines uploaded
+    already, skipped, are returned.
+    '''
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        f.seek(0)
+    fingerprint = UploadFingerprint('person')
+    lines, duplicates = [], []
+    Reader = namedtuple(
+        'Reader', 'idcard,name,address_no,address_detail,securi_no')
+
+    def idcard2birthday(idcard):
+        return datetime.strptime(idcard[6:14], '%Y%m%d').date()
+
+    def register(lines):
+        applied = fingerprint.applied([hash for no, record, hash in lines])
+        persons = []
+        for no, record, hash in lines:
+            if hash in applied:
+                duplicates.append(no)
+                continue
             address = db.my_get_obj_or_404(
                 Address, Address.no, record.address_no)
             persons.append(
@@ -982,12 +1240,56 @@ def person_upload():
                     address_detail=record.address_detail,
                     securi_no=record.securi_no,
                     personal_wage=0,
-                    create_by=current_user
+                    create_user_id=current_user.id
                 ).reg())
+            fingerprint.add(hash)
         db.session.add_all(persons)
-        db.session.commit()
+    # csv.reader over the file, a quoted field may span lines
+    for no, fields in enumerate(csv.reader(f)):
+        record = Reader._make(fields)
+        if not (re.match(r'^\d{17}[\d|X]$', record.idcard)
+                and re.match(r'^[\w\W]+[号|组]$', record.address_detail)):
+            flash(('Syntax error in upload file at line:{},' +
+                   ' content:{}').format(no, fields))
+            abort(500)
+        record = Reader._make(map(lambda x: x.decode('utf-8'), fields))
+        lines.append((no, record, fingerprint.line(','.join(fields))))
+        if len(lines) >= PayBookLedger.batch_size:
+            register(lines)
+            lines = []
+        if progress:
+            progress(no + 1)
+    if lines:
+        register(lines)
+    fingerprint.save(current_user.id)
+    db.session.commit()
+    return duplicates
+
+
+def _upload_result(duplicates):
+    '''the response of an upload, with the lines skipped'''
+    if not duplicates:
         return 'success'
-    return render_template('upload.html', form=form)
+    return 'success, duplicate lines skipped: {}'.format(
+        ','.join(map(str, duplicates)))
+
+
+def _duplicates_file(job, duplicates):
+    '''the file of the lines an upload job skipped, its result, if any'''
+    if not duplicates:
+        return None
+    with open(job_queue.path(job, 'duplicates.txt'), 'w') as f:
+        f.write('\n'.join(map(str, duplicates)))
+    return 'duplicates.txt'
+
+
+@job_queue.task('person_upload')
+def person_upload_job(job):
+    progress = job_queue.progress(job)
+    with open(job_queue.path(job, INPUT), 'rb') as f:
+        progress(0, sum(1 for line in f))
+        f.seek(0)
+        return _duplicates_file(job, _person_upload(f, progress))
 
 
 @app.route('/person/<int:pk>/delete', methods=['GET', 'POST'])
@@ -1049,19 +1351,17 @@ def person_normal_reg(pk):
 
 @app.route('/person/batch_normal', methods=['GET', 'POST'])
 @admin_required
-@person_addr_filter
-@DbLogger.log_template('{{ person.id }},')
+@DbLogger.log_template('batch normal:{{ count }}')
 def person_batch_normal():
     form = PeroidForm(request.form)
     if request.method == 'POST' and form.validate_on_submit():
-        persons = Person.query.filter(
-            Person.can_normal.is_(True)).filter(
-                Person.birthday >= form.start_date.data).filter(
-                    Person.birthday <= form.end_date.data).all()
-        for person in persons:
-            person.normal()
-            DbLogger.log(person=person)
-        db.session.flush()
+        rows = Person.batch_normal(
+            form.start_date.data, form.end_date.data, current_user.address_id)
+        DbLogger.log_each(
+            'person_batch_normal', ('{},'.format(row.id) for row in rows))
+        DbLogger.log(count=len(rows))
+        # the core update fires no orm events for the grant cache
+        grant_mark(db.session, None)
         db.session.commit()
         return 'succes'
     return render_template('person_batch_normal.html', form=form)
@@ -1180,20 +1480,34 @@ def person_search(page, per_page):
         lambda x: request.args.get(x), ('idcard', 'name', 'address'))
     query = Person.query
     if idcard:
-        query = query.filter(
-            Person.idcard.like('{}%'.decode('utf-8').format(idcard)))
+        query = query.filter(prefix_like(Person.idcard, idcard))
     if name:
-        query = query.filter(
-            Person.name.like('{}%'.decode('utf-8').format(name)))
+        query = query.filter(prefix_like(Person.name, name))
     if address:
-        stmt = exists().where(and_(
-            Person.address_id == Address.id,
-            Address.name.like('{}%'.decode('utf-8').format(address))))
-        query = query.filter(stmt)
+        query = query.filter(Person.address_id.in_(address_ids_like(address)))
     return render_template('person_search.html',
                            pagination=query.paginate(page, per_page))
 
 
+@app.route('/autocomplete/<field>', methods=['GET'])
+@login_required
+def autocomplete_search(field):
+    '''
+    json suggestions of idcard, name, bankcard_no or bankcard_name which
+    start with arg q, only persons in the user's addresses are suggested.
+    '''
+    if field not in AutocompleteService.FIELDS:
+        abort(404)
+    prefix = request.args.get('q')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    items = []
+    if prefix:
+        items = autocomplete.suggest(
+            field, prefix, current_user.address_ids, limit)
+    return flask.jsonify(
+        items=[dict(value=value, id=id) for value, id in items])
+
+
 @app.route('/person/<int:pk>/standardbind', methods=['GET', 'POST'])
 @admin_required
 @person_addr_filter
@@ -1272,7 +1586,8 @@ def bankcard_add():
     if request.method == 'POST' and form.validate_on_submit():
         bankcard = Bankcard()
         form.populate_obj(bankcard)
-        bankcard.create_by = current_user
+        bankcard.create_user_id = current_user.id
+        db.session.add(bankcard)
         db.session.commit()
         DbLogger.log(bankcard=bankcard)
         db.session.commit()
@@ -1331,17 +1646,12 @@ def bankcard_search(page, per_page):
         ('no', 'name', 'idcard'))
     query = Bankcard.query
     if no:
-        query = query.filter(
-            Bankcard.no.like('{}%'.decode('utf-8').format(no)))
+        query = query.filter(prefix_like(Bankcard.no, no))
     if name:
-        query = query.filter(
-            Bankcard.name.like('{}%'.decode('utf-8').format(name)))
+        query = query.filter(prefix_like(Bankcard.name, name))
     if idcard:
-        stmt = exists().where(and_(
-                              Bankcard.owner_id == Person.id,
-                              Person.idcard.like(
-                                  '{}%'.decode('utf-8').format(idcard))))
-        query = query.filter(stmt)
+        query = query.filter(Bankcard.owner_id.in_(
+            person_ids_like(Person.idcard, idcard)))
     return render_template('bankcard_search.html',
                            pagination=query.paginate(page, per_page))
 
@@ -1354,7 +1664,7 @@ def note_add():
     if request.method == 'POST' and form.validate_on_submit():
         note = Note()
         form.populate_obj(note)
-        note.user = current_user
+        note.user_id = current_user.id
         db.session.add(note)
         db.session.commit()
         return 'success'
@@ -1489,8 +1799,7 @@ def pay_item_search(page, per_page):
     name = request.args.get('name')
     query = PayBookItem.query
     if name:
-        query = query.filter(
-            PayBookItem.name.like('{}%'.decode('utf-8').format(name)))
+        query = query.filter(prefix_like(PayBookItem.name, name))
     return render_template('pay_item_search.html',
                            pagination=query.paginate(page, per_page))
 
@@ -1504,53 +1813,95 @@ def paybook_upload():
         peroid = datetime.strptime(peroid, '%Y-%m-%d').date()
     form = Form(request.form)
     if request.method == 'POST' and form.validate_on_submit():
-        f = request.files['file']
-        if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
-            f.seek(0)
-        Reader = namedtuple('Reader',
-                            'securi_no,name,idcard,money,village_no,bankcard')
+        DbLogger.log(peroid=peroid)
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'paybook_upload', current_user.id, request.files['file']))
+        return _upload_result(_paybook_upload(request.files['file']))
+    return render_template('upload.html', form=form)
 
-        def validate(record):
-            if not re.match(r'^(?:(?:\d{19})|(?:\d{2}-\d{15}))[\w\W]*$',
-                            record.bankcard):
-                return False
-            if not re.match(r'^\d{17}[\d|X]$', record.idcard):
-                return False
-            if not re.match(r'^\d+(?:\.\d{2})?$', record.money):
-                return False
-            return True
-        for line_no, line in enumerate(f):
-            line = line.replace('|', ',').rstrip(',')
-            fields = map(lambda x: x.decode('utf-8'),
-                         csv.reader([line]).next())
-            record = Reader._make(fields)
-            if not validate(record):
-                flash('Syntx error in line:{}'.format(line_no))
-                abort(500)
-            item1 = PayBookItem.query.filter(
-                PayBookItem.name == 'sys_should_pay').one()
-            item2 = PayBookItem.query.filter(
-                PayBookItem.name == 'bank_should_pay').one()
-            try:
-                bankcard_no = re.match(r'^((?:\d{19})|(?:\d{2}-\d{15}))' +
-                                       '[\w\W]*$', record.bankcard).group(1)
-                bankcard = Bankcard.query.filter(
-                    Bankcard.no == bankcard_no).one()
-                person = Person.query.filter(
-                    Person.idcard == record.idcard).one()
-            except NoResultFound:
+
+def _paybook_upload(f, progress=None):
+    '''
+    create the should pay books of bank file f, the numbers of the lines
+    uploaded already in the peroid, skipped, are returned.
+    '''
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        f.seek(0)
+    Reader = namedtuple('Reader',
+                        'securi_no,name,idcard,money,village_no,bankcard')
+    bankcard_regex = re.compile(r'^((?:\d{19})|(?:\d{2}-\d{15}))[\w\W]*$')
+
+    def validate(record):
+        if not bankcard_regex.match(record.bankcard):
+            return False
+        if not re.match(r'^\d{17}[\d|X]$', record.idcard):
+            return False
+        if not re.match(r'^\d+(?:\.\d{2})?$', record.money):
+            return False
+        return True
+    items = PayBookLedger.items_by_name('sys_should_pay', 'bank_should_pay')
+    ledger = PayBookLedger()
+    fingerprint = UploadFingerprint(
+        'paybook', ledger.current_peroid.isoformat())
+    duplicates = []
+
+    def create(lines):
+        '''the tuples of lines, their bankcards and persons by one query'''
+        applied = fingerprint.applied([line[3] for line in lines])
+        duplicates.extend(line[0] for line in lines if line[3] in applied)
+        new = [line for line in lines if line[3] not in applied]
+        query = db.session.query(
+            Bankcard.no, Bankcard.id, Bankcard.owner_id).filter(
+                Bankcard.no.in_(set(line[2] for line in lines)))
+        bankcards = dict((bankcard.no, bankcard) for bankcard in query)
+        persons = dict(db.session.query(Person.idcard, Person.id).filter(
+            Person.idcard.in_(set(line[1].idcard for line in lines))))
+        for line_no, record, bankcard_no, hash in new:
+            bankcard = bankcards.get(bankcard_no)
+            if bankcard is None or record.idcard not in persons:
                 flash('Bankcard or person not find. In line:{}'.format(
                     line_no))
                 abort(500)
-            if not bankcard.binded:
+            if bankcard.owner_id is None:
                 flash("unbind bankcard can't pay")
                 abort(500)
-            PayBookManager(person).create_tuple(
-                bankcard, bankcard, item1, item2, float(record.money))
-            db.session.flush()
-        DbLogger.log(peroid=peroid)
-        return 'success'
-    return render_template('upload.html', form=form)
+            ledger.create_tuple(
+                persons[record.idcard], bankcard.id, bankcard.id,
+                items['sys_should_pay'], items['bank_should_pay'],
+                Decimal(record.money))
+            fingerprint.add(hash)
+        if progress:
+            progress(lines[-1][0] + 1)
+    lines = []
+    for line_no, raw in enumerate(f):
+        line = raw.replace('|', ',').rstrip(',')
+        fields = map(lambda x: x.decode('utf-8'),
+                     csv.reader([line]).next())
+        record = Reader._make(fields)
+        if not validate(record):
+            flash('Syntx error in line:{}'.format(line_no))
+            abort(500)
+        lines.append((line_no, record,
+                      bankcard_regex.match(record.bankcard).group(1),
+                      fingerprint.line(raw)))
+        if len(lines) >= ledger.batch_size:
+            create(lines)
+            lines = []
+    if lines:
+        create(lines)
+    fingerprint.save(current_user.id)
+    ledger.commit()
+    return duplicates
+
+
+@job_queue.task('paybook_upload')
+def paybook_upload_job(job):
+    progress = job_queue.progress(job)
+    with open(job_queue.path(job, INPUT), 'rb') as f:
+        progress(0, sum(1 for line in f))
+        f.seek(0)
+        return _duplicates_file(job, _paybook_upload(f, progress))
 
 
 @app.route('/paybook/person/<int:person_id>/amend', methods=['GET', 'POST'])
@@ -1582,49 +1933,272 @@ def paybook_batch_success():
     the fail line first field is bankcard no, second field is failed money
     if fail bankcard duplicate, the last money will be use
     if fail bankcard not in db, the line be ignored
-    if fail money greater than should pay or less than zero, the line be ignore
+    if fail money greater than should pay or not greater than zero, nothing
+    is payed and the bankcards are reported
 '''
     form = BatchSuccessFrom(request.form)
     if request.method == 'POST' and form.validate_on_submit():
-        money = func.sum(PayBook.money).label('money')
-        query = db.session.query(
-            PayBook.person_id,
-            PayBook.bankcard_id,
-            money).filter(
-                PayBook.item_is('bank_should_pay'),
-                PayBook.in_peroid(form.peroid.data)).group_by(
-                    PayBook.bankcard_id).having(money > 0)
-        bank_should, bank_payed, bank_failed = [PayBookItem.query.filter(
-            PayBookItem.name == name).one() for name in
-            ('bank_should_pay', 'bank_payed', 'bank_failed')]
-        fail_lines = dict(map(
-            lambda line: line.split(','), form.fails.data.splitlines()))
-        fail_bankcard = fail_lines.keys()
-        in_fails = exists().where(and_(
-            PayBook.bankcard_id == Bankcard.id,
-            Bankcard.no.in_(fail_bankcard))) if form.fails.data.splitlines()\
-            else false()
-        for book in query.filter(in_fails):
-            bankcard = Bankcard.query.get(book.bankcard_id).no
-            money = float(fail_lines[bankcard.no])
-            if money <= 0 or money > book.money:
-                break
-            book_manager = PayBookManager(book.person_id)
-            book_manager.create_tuple(
-                book.bankcard_id, book.bankcard_id, bank_should, bank_failed,
-                money, remark='batch success')
-            book_manager.create_tuple(
-                book.bankcard_id, book.bankcard_id, bank_should, bank_payed,
-                book.money - money, remark='batch success')
-        for book in query.filter(~in_fails):
-            PayBookManager(book.person_id).create_tuple(
-                book.bankcard_id, book.bankcard_id, bank_should, bank_payed,
-                book.money, remark='batch success')
         DbLogger.log(fails=','.join(form.fails.data.splitlines()))
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'paybook_batch_success', current_user.id,
+                peroid=DateConverter.to_url(form.peroid.data),
+                fails=form.fails.data))
+        _batch_success(form.peroid.data, form.fails.data)
         return 'success'
     return render_template('paybook_batch_success.html', form=form)
 
 
+def _batch_success(peroid, fails, progress=None):
+    '''pay the bank should pay books of peroid, except the fail lines'''
+    money = func.sum(PayBook.money).label('money')
+    query = db.session.query(
+        PayBook.person_id,
+        PayBook.bankcard_id,
+        money).filter(
+            PayBook.item_is('bank_should_pay'),
+            PayBook.in_peroid(peroid)).group_by(
+                PayBook.bankcard_id).having(money > 0)
+    items = PayBookLedger.items_by_name(
+        'bank_should_pay', 'bank_payed', 'bank_failed')
+    bank_should, bank_payed, bank_failed = [items[name] for name in (
+        'bank_should_pay', 'bank_payed', 'bank_failed')]
+    fail_lines = {}
+    for line in fails.splitlines():
+        if not line.strip():
+            continue
+        no, _, fail_money = line.partition(',')
+        try:
+            fail_lines[no.strip()] = Decimal(fail_money.strip())
+        except InvalidOperation:
+            flash(unicode('invalid fail line:{}').format(line))
+            abort(500)
+    fail_bankcard = fail_lines.keys()
+    in_fails = exists().where(and_(
+        PayBook.bankcard_id == Bankcard.id,
+        Bankcard.no.in_(fail_bankcard))) if fails.splitlines() else false()
+    ledger = PayBookLedger()
+    done = 0
+    if progress:
+        progress(done, query.count())
+    fail_books = query.filter(in_fails).all()
+    bankcard_nos = dict(db.session.query(Bankcard.id, Bankcard.no).filter(
+        Bankcard.no.in_(fail_bankcard))) if fail_books else {}
+    invalids = [bankcard_nos[book.bankcard_id] for book in fail_books
+                if not 0 < fail_lines[bankcard_nos[book.bankcard_id]] <=
+                Decimal(book.money)]
+    if invalids:
+        flash(unicode('fail money must be greater than zero and not greater'
+                      ' than bank should pay, bankcard:{}').format(
+                          ','.join(invalids)))
+        abort(500)
+    for book in fail_books:
+        done += 1
+        if progress:
+            progress(done)
+        money = fail_lines[bankcard_nos[book.bankcard_id]]
+        ledger.create_tuple(
+            book.person_id, book.bankcard_id, book.bankcard_id, bank_should,
+            bank_failed, money, remark='batch success')
+        ledger.create_tuple(
+            book.person_id, book.bankcard_id, book.bankcard_id, bank_should,
+            bank_payed, Decimal(book.money) - money, remark='batch success')
+    for book in query.filter(~in_fails):
+        ledger.create_tuple(
+            book.person_id, book.bankcard_id, book.bankcard_id, bank_should,
+            bank_payed, book.money, remark='batch success')
+        done += 1
+        if progress:
+            progress(done)
+    ledger.commit()
+
+
+@job_queue.task('paybook_batch_success')
+def paybook_batch_success_job(job, peroid, fails):
+    _batch_success(DateConverter.to_python(peroid), fails,
+                   job_queue.progress(job))
+
+
+@app.route('/paybook/peroid/<date:peroid>/reconcile', methods=['GET', 'POST'])
+@pay_admin_required
+@DbLogger.log_template('{{ peroid }}')
+def paybook_reconcile(peroid):
+    '''
+    success the bank should pay of peroid by the bank's return file, the
+    csv lines of the bank grant files with the payed money appended, or a
+    zip of them. the result is the csv report of the discrepancies.
+'''
+    form = Form(request.form)
+    if request.method == 'POST' and form.validate_on_submit():
+        DbLogger.log(peroid=peroid)
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'paybook_reconcile', current_user.id, request.files['file'],
+                peroid=DateConverter.to_url(peroid)))
+        report = io.BytesIO()
+        _reconcile(peroid, request.files['file'], report)
+        return _csv_report(report, 'reconcile_{}'.format(
+            peroid.strftime('%Y%m')))
+    return render_template('upload.html', form=form)
+
+
+def _return_lines(f):
+    '''the csv lines of the return file f, of every file if it is a zip'''
+    if is_zipfile(f):
+        f.seek(0)
+        zipf = ZipFile(f)
+        for name in sorted(zipf.namelist()):
+            for line in _return_lines(io.BytesIO(zipf.read(name))):
+                yield line
+        return
+    f.seek(0)
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        f.seek(0)
+    for fields in csv.reader(f):
+        if fields:
+            yield fields
+
+
+def _cents(money):
+    '''
+    money, a Decimal or a string of money_regex, as integer cents. the
+    string is split at the point, Decimal() of it takes 10 times longer.
+    '''
+    if isinstance(money, Decimal):
+        money = str(money.quantize(Decimal('0.01')))
+    sign = -1 if money.startswith('-') else 1
+    whole, _, part = money.lstrip('-').partition('.')
+    return sign * (int(whole) * 100 + int(part.ljust(2, '0')))
+
+
+def _reconcile(peroid, f, report, progress=None):
+    '''
+    reconcile the bank should pay balances of peroid with the return file
+    f. the balances by bankcard no are read by one query and every return
+    line is looked up in them, by its bankcard no, grant money and payed
+    money (its last field):
+    paid: payed is the balance, it goes to bank_payed.
+    failed: payed is 0, the balance goes to bank_failed.
+    partial: payed is less, it goes to bank_payed, the rest to bank_failed.
+    unknown card: no balance of the bankcard.
+    several balances: the bankcard has balances of more than one person,
+    the line can't tell which one is payed.
+    amount mismatch: grant money is not the balance, or payed is more.
+    duplicate: the bankcard is in an earlier line.
+    the tuples are committed at the end, all at once. all lines but the
+    paid ones, and the balances missing in f, are written to csv file
+    report. the counts of every class are returned.
+    '''
+    items = PayBookLedger.items_by_name(
+        'bank_should_pay', 'bank_payed', 'bank_failed')
+    bank_should, bank_payed, bank_failed = [items[name] for name in (
+        'bank_should_pay', 'bank_payed', 'bank_failed')]
+    money_regex = re.compile(r'^-?\d+(?:\.\d{1,2})?$')
+    money = func.sum(PayBook.money).label('money')
+    Balance = namedtuple('Balance', 'person_id,bankcard_id,money,cents')
+    # [Balance] by bankcard no, one a person the bankcard paid
+    balances = {}
+    for row in db.session.query(
+            Bankcard.no, PayBook.person_id, PayBook.bankcard_id,
+            money).select_from(PayBook).join(
+                Bankcard, Bankcard.id == PayBook.bankcard_id).filter(
+                    PayBook.item_id == bank_should.id,
+                    PayBook.in_peroid(peroid)).group_by(
+                        Bankcard.no, PayBook.person_id,
+                        PayBook.bankcard_id).having(money > 0):
+        balances.setdefault(row.no, []).append(Balance(
+            row.person_id, row.bankcard_id, row.money, _cents(row.money)))
+    ledger = PayBookLedger()
+    writer = csv.writer(report)
+    writer.writerow(
+        ('line', 'bankcard', 'balance', 'money', 'payed', 'result'))
+    seen, counts = set(), {}
+    if progress:
+        progress(0, sum(1 for fields in _return_lines(f)))
+    for line_no, fields in enumerate(_return_lines(f)):
+        if len(fields) < 6:
+            flash('Syntax error in line:{}'.format(line_no))
+            abort(500)
+        bankcard_no, grant, payed = fields[1], fields[3], fields[-1]
+        if not (money_regex.match(grant) and money_regex.match(payed)):
+            flash('Syntax error in line:{}'.format(line_no))
+            abort(500)
+        grant_cents, payed_cents = _cents(grant), _cents(payed)
+        found = balances.get(bankcard_no, [])
+        balance = found[0] if len(found) == 1 else None
+        if not found:
+            result = 'unknown card'
+        elif balance is None:
+            result = 'several balances'
+        elif bankcard_no in seen:
+            result = 'duplicate'
+        elif grant_cents != balance.cents or \
+                not 0 <= payed_cents <= balance.cents:
+            result = 'amount mismatch'
+        else:
+            result = 'paid' if payed_cents == balance.cents else \
+                'failed' if payed_cents == 0 else 'partial'
+            if payed_cents:
+                ledger.create_tuple(
+                    balance.person_id, balance.bankcard_id,
+                    balance.bankcard_id, bank_should, bank_payed,
+                    Decimal(payed_cents).scaleb(-2), remark='reconcile')
+            if payed_cents != balance.cents:
+                ledger.create_tuple(
+                    balance.person_id, balance.bankcard_id,
+                    balance.bankcard_id, bank_should, bank_failed,
+                    Decimal(balance.cents - payed_cents).scaleb(-2),
+                    remark='reconcile')
+        seen.add(bankcard_no)
+        counts[result] = counts.get(result, 0) + 1
+        if result != 'paid':
+            writer.writerow((line_no, bankcard_no, '' if balance is None
+                             else balance.money, grant, payed, result))
+        if progress:
+            progress(line_no + 1)
+    for bankcard_no in sorted(set(balances) - seen):
+        for balance in balances[bankcard_no]:
+            counts['missing'] = counts.get('missing', 0) + 1
+            writer.writerow(('', bankcard_no, balance.money, '', '',
+                             'missing'))
+    ledger.commit()
+    return counts
+
+
+@job_queue.task('paybook_reconcile')
+def paybook_reconcile_job(job, peroid):
+    progress = job_queue.progress(job)
+    with open(job_queue.path(job, INPUT), 'rb') as f, \
+            open(job_queue.path(job, 'report.csv'), 'wb') as report:
+        _reconcile(DateConverter.to_python(peroid), f, report, progress)
+    return 'report.csv'
+
+
+@app.route('/paybook/peroid/<date:peroid>/close', methods=['GET', 'POST'])
+@pay_admin_required
+@DbLogger.log_template('{{ peroid }}')
+def paybook_peroid_close(peroid):
+    '''
+    sum up the paybooks of an ended peroid and close it.
+    the searches and reports read a closed peroid from its sums, its
+    paybooks can't be created, changed or deleted any more.
+'''
+    form = Form(formdata=request.form)
+    if request.method == 'POST' and form.validate_on_submit():
+        try:
+            PeroidClose.close(peroid, current_user)
+        except PeroidClosedError as e:
+            flash(unicode(e))
+            db.session.rollback()
+            abort(500)
+        DbLogger.log(peroid=peroid)
+        db.session.commit()
+        return 'success'
+    return render_template(
+        'confirm.html', form=form, title='peroid close', message=(
+            'confirm close the peroid:{}').format(peroid.strftime('%Y%m')))
+
+
 @app.route('/paybook/person/<int:person_id>',
            methods=['GET', 'POST'])
 @pay_admin_required
@@ -1660,6 +2234,219 @@ def paybook_fail_correct(person_id):
     return render_template('paybook_fail_correct.html', form=form)
 
 
+@app.route('/paybook/failcorrect/upload', methods=['GET', 'POST'])
+@pay_admin_required
+@DbLogger.log_template()
+def paybook_fail_correct_upload():
+    '''
+    paybook_fail_correct of the persons of a csv file, a line is
+    "idcard,new bankcard[,failed money]". the result is the csv report.
+'''
+    form = Form(request.form)
+    if request.method == 'POST' and form.validate_on_submit():
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'paybook_fail_correct_upload', current_user.id,
+                request.files['file']))
+        report = io.BytesIO()
+        _fail_correct_upload(request.files['file'], report)
+        return _csv_report(report, 'fail_correct')
+    return render_template('upload.html', form=form)
+
+
+@app.route('/paybook/amend/upload', methods=['GET', 'POST'])
+@admin_required
+@DbLogger.log_template()
+def paybook_amend_upload():
+    '''
+    paybook_amend of the persons of a csv file, a line is
+    "idcard,new bankcard,money". the result is the csv report.
+'''
+    form = Form(request.form)
+    if request.method == 'POST' and form.validate_on_submit():
+        if _in_background():
+            return _queued(job_queue.enqueue(
+                'paybook_amend_upload', current_user.id,
+                request.files['file']))
+        report = io.BytesIO()
+        _amend_upload(request.files['file'], report)
+        return _csv_report(report, 'amend')
+    return render_template('upload.html', form=form)
+
+
+def _csv_report(report, name):
+    return Response(
+        report.getvalue(),
+        mimetype="text/plain",
+        headers={"Content-Disposition":
+                 "attachment;filename={}_report.csv".format(name)})
+
+
+def _bulk_correct(f, report, correct, progress=None):
+    '''
+    correct the persons of the lines "idcard,bankcard[,money]" of csv file
+    f, ledger.batch_size lines at a time, their persons and bankcards by one
+    query. correct(ledger, lines) writes the tuples of the lines to ledger
+    and returns (money, result) of every line. the lines and results are
+    written to csv file report, the tuples are committed at the end, all at
+    once. a line of an unknown person or bankcard, or of a person of an
+    earlier line, is left out.
+    '''
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        f.seek(0)
+    Line = namedtuple('Line', 'no,idcard,bankcard_no,money,person_id,bankcard')
+    ledger = PayBookLedger()
+    writer = csv.writer(report)
+    writer.writerow(('line', 'idcard', 'bankcard', 'money', 'result'))
+    seen, duplicates = set(), set()
+
+    def run(lines):
+        persons = dict(db.session.query(Person.idcard, Person.id).filter(
+            Person.idcard.in_(set(line.idcard for line in lines))))
+        query = db.session.query(
+            Bankcard.no, Bankcard.id, Bankcard.owner_id).filter(
+                Bankcard.no.in_(set(line.bankcard_no for line in lines)))
+        bankcards = dict((bankcard.no, bankcard) for bankcard in query)
+        results, found = {}, []
+        for line in lines:
+            if line.no in duplicates:
+                results[line.no] = (line.money, 'duplicate idcard')
+            elif line.idcard not in persons:
+                results[line.no] = (line.money, 'person not found')
+            elif line.bankcard_no not in bankcards:
+                results[line.no] = (line.money, 'bankcard not found')
+            else:
+                found.append(line._replace(
+                    person_id=persons[line.idcard],
+                    bankcard=bankcards[line.bankcard_no]))
+        results.update(zip(
+            [line.no for line in found], correct(ledger, found)))
+        for line in lines:
+            money, result = results[line.no]
+            writer.writerow((line.no, line.idcard, line.bankcard_no,
+                             '' if money is None else money, result))
+        if progress:
+            progress(lines[-1].no + 1)
+    lines = []
+    for line_no, fields in enumerate(csv.reader(f)):
+        if not fields:
+            continue
+        fields = [field.strip() for field in fields]
+        if not (len(fields) in (2, 3) and
+                re.match(r'^\d{17}[\d|X]$', fields[0]) and
+                re.match(r'^(?:\d{19}|\d{2}-\d{15})$', fields[1]) and
+                (len(fields) == 2 or
+                 re.match(r'^\d+(?:\.\d{1,2})?$', fields[2]))):
+            flash('Syntax error in line:{}'.format(line_no))
+            abort(500)
+        line = Line(line_no, fields[0], fields[1], Decimal(fields[2])
+                    if len(fields) == 3 else None, None, None)
+        if line.idcard in seen:
+            duplicates.add(line_no)
+        seen.add(line.idcard)
+        lines.append(line)
+        if len(lines) >= ledger.batch_size:
+            run(lines)
+            lines = []
+    if lines:
+        run(lines)
+    ledger.commit()
+
+
+def _fail_correct_upload(f, report, progress=None):
+    '''
+    the rules of paybook_fail_correct: the failed money of every bankcard
+    of the person goes to bank should pay of the new, binded, bankcard. a
+    money of a line must be the failed money of the person.
+    '''
+    items = PayBookLedger.items_by_name('bank_failed', 'bank_should_pay')
+    bank_failed, bank_should = items['bank_failed'], items['bank_should_pay']
+
+    def correct(ledger, lines):
+        books = PayBookLedger(
+            [line.person_id for line in lines],
+            bank_failed).lst_groupby_bankcard(False)
+        results = []
+        for line in lines:
+            failed = books.get(line.person_id, [])
+            money = sum(book.money for book in failed)
+            if line.bankcard.owner_id is None:
+                results.append((money, 'bankcard not binded'))
+            elif not failed:
+                results.append((money, 'no failed money'))
+            elif line.money is not None and line.money != money:
+                results.append((money, 'failed money is not {}'.format(
+                    line.money)))
+            else:
+                for book in failed:
+                    ledger.create_tuple(
+                        line.person_id, book.bankcard_id, line.bankcard.id,
+                        bank_failed, bank_should, book.money,
+                        remark='fail correct')
+                results.append((money, 'success'))
+        return results
+    _bulk_correct(f, report, correct, progress)
+
+
+def _amend_upload(f, report, progress=None):
+    '''
+    the rules of paybook_amend: a person not having bank should pay money
+    and whose sys should pay balances pass AmendForm.amendable has them
+    taken back and gets money to sys_amend on the new bankcard.
+    '''
+    items = PayBookLedger.items_by_name(
+        'sys_should_pay', 'sys_amend', 'bank_should_pay')
+    sys_should, sys_amend, bank_should = [items[name] for name in (
+        'sys_should_pay', 'sys_amend', 'bank_should_pay')]
+
+    def correct(ledger, lines):
+        person_ids = [line.person_id for line in lines]
+        books = PayBookLedger(person_ids, sys_should).lst_groupby_bankcard()
+        payed = PayBookLedger(person_ids, bank_should).sum_money()
+        results = []
+        for line in lines:
+            balances = books.get(line.person_id, [])
+            if line.money is None or not 0.01 <= line.money <= 1000000:
+                results.append((line.money, 'money out of range'))
+            elif payed.get(line.person_id):
+                results.append((line.money, 'bank should pay not payed'))
+            elif not balances:
+                results.append((line.money, 'no balance to amend'))
+            elif not AmendForm.amendable(balances):
+                results.append((line.money, 'balance not amendable'))
+            else:
+                for book in balances:
+                    ledger.create_tuple(
+                        line.person_id, book.bankcard_id, book.bankcard_id,
+                        sys_should, bank_should, book.money, remark='remend')
+                ledger.create_tuple(
+                    line.person_id, line.bankcard.id, line.bankcard.id,
+                    sys_amend, bank_should, line.money, remark='remnd')
+                results.append((line.money, 'success'))
+        return results
+    _bulk_correct(f, report, correct, progress)
+
+
+@job_queue.task('paybook_fail_correct_upload')
+def paybook_fail_correct_upload_job(job):
+    return _bulk_correct_job(job, _fail_correct_upload)
+
+
+@job_queue.task('paybook_amend_upload')
+def paybook_amend_upload_job(job):
+    return _bulk_correct_job(job, _amend_upload)
+
+
+def _bulk_correct_job(job, upload):
+    progress = job_queue.progress(job)
+    with open(job_queue.path(job, INPUT), 'rb') as f, \
+            open(job_queue.path(job, 'report.csv'), 'wb') as report:
+        progress(0, sum(1 for line in f))
+        f.seek(0)
+        upload(f, report, progress)
+    return 'report.csv'
+
+
 @app.route('/paybook/bankcard/<int:bankcard_id>' +
            '/person/<int:person_id>' +
            '/peroid/<date:peroid>/successcorrect', methods=['GET', 'POST'])
@@ -1694,42 +2481,42 @@ def paybook_success_correct(person_id, bankcard_id, peroid):
 
 
 def _paybook_query(person_idcard, item_names, peroid, negative=False):
-    money = func.sum(PayBook.money).label('money')
+    if peroid and isinstance(peroid, basestring):
+        try:
+            peroid = datetime.strptime(peroid, '%Y-%m-%d').date()
+        except ValueError:
+            try:
+                peroid = datetime.strptime(peroid, '%Y%m').date()
+            except ValueError:
+                peroid = False
+    rows = ledger(*PayBook._date_range(peroid)) if peroid else ledger()
+    money = func.sum(rows.c.money).label('money')
     item = aliased(PayBookItem)
     query = db.session.query(
-        PayBook.peroid,
-        PayBook.person_id.label('person'),
+        rows.c.peroid,
+        rows.c.person_id.label('person'),
         Person.idcard,
         Person.name.label('person_name'),
-        PayBook.bankcard_id.label('bankcard'),
+        rows.c.bankcard_id.label('bankcard'),
         Bankcard.no.label('bankcard_no'),
         Bankcard.name.label('bankcard_name'),
         item.name.label('item'),
-        money).join(
-            Person, Person.id == PayBook.person_id).join(
-                Bankcard, Bankcard.id == PayBook.bankcard_id).join(
-                    item, item.id == PayBook.item_id)
+        money).select_from(rows).join(
+            Person, Person.id == rows.c.person_id).join(
+                Bankcard, Bankcard.id == rows.c.bankcard_id).join(
+                    item, item.id == rows.c.item_id)
     if person_idcard:
         query = query.filter(Person.idcard == person_idcard)
     if item_names:
-        query = query.filter(PayBook.item_in(*item_names))
-    if peroid:
-        if isinstance(peroid, str):
-            try:
-                peroid = datetime.strptime(peroid, '%Y-%m-d').date()
-            except ValueError:
-                try:
-                    peroid = datetime.strptime(peroid, '%Y%m').date()
-                except ValueError:
-                    peroid = None
-        query = query.filter(PayBook.in_peroid(peroid))
-    if current_user.address is not None:
-        addr_ids = map(lambda a: a.id, current_user.address.descendants)
-        addr_ids.append(current_user.address.id)
-        query = query.filter(Person.address_id.in_(addr_ids))
+        query = query.filter(item.name.in_(item_names))
+    if peroid is False:
+        query = query.filter(false())
+    if current_user.address_ids:
+        query = query.filter(
+            Person.address_id.in_(current_user.address_ids))
     else:
         query = query.filter(false())
-    query = query.group_by(PayBook.bankcard_id, item.id, PayBook.peroid)
+    query = query.group_by(rows.c.bankcard_id, item.id, rows.c.peroid)
     if negative:
         query = query.having(money < 0)
     else:
@@ -1778,23 +2565,36 @@ def paybook_sys_search(page, per_page):
 @pay_admin_required
 @DbLogger.log_template()
 def paybook_bankgrant():
-    money = func.sum(PayBook.money).label('money')
+    peroid = None
+    if request.args.get('peroid'):
+        peroid = DateConverter.to_python(request.args.get('peroid'))
+    if _in_background():
+        return _queued(job_queue.enqueue(
+            'paybook_bankgrant', current_user.id,
+            peroid=DateConverter.to_url(peroid)))
+    path = grant_cache.fetch(peroid, lambda: _bankgrant_zip(peroid))
+    db.session.commit()
+    return flask.send_file(path, mimetype='application/zip',
+                           as_attachment=True,
+                           attachment_filename='{}.csv'.format(peroid))
+
+
+def _bankgrant_zip(peroid):
+    '''zip of the bank grant csv files of peroid, 3000 lines a file'''
+    rows = ledger(*PayBook._date_range(peroid)) if peroid else ledger()
+    money = func.sum(rows.c.money).label('money')
     query = db.session.query(
         Person.idcard.label('idcard'),
         Bankcard.no.label('bankcard_no'),
         Bankcard.name.label('bankcard_name'),
         money,
-        Person.status.label('remark')).join(
-            PayBook, Person.id == PayBook.person_id).join(
-                Bankcard, Bankcard.id == PayBook.bankcard_id).filter(
-                    PayBook.item_is('bank_should_pay'))
-    peroid = None
-    if request.args.get('peroid'):
-        peroid = DateConverter.to_python(request.args.get('peroid'))
-    if peroid:
-        query = query.filter(PayBook.in_peroid(peroid))
+        Person.status.label('remark')).select_from(rows).join(
+            Person, Person.id == rows.c.person_id).join(
+                Bankcard, Bankcard.id == rows.c.bankcard_id).join(
+                    PayBookItem, PayBookItem.id == rows.c.item_id).filter(
+                        PayBookItem.name == 'bank_should_pay')
     books = query.group_by(
-        PayBook.bankcard_id).having(
+        rows.c.bankcard_id).having(
             money > 0).all()
 
     def book2csv(book):
@@ -1804,7 +2604,7 @@ def paybook_bankgrant():
                 or idcard[8:] + '0'
         return ','.join(
             map(
-                lambda x: str(x),
+                lambda x: unicode(x).encode('utf-8'),
                 (
                     make_no(book.idcard),
                     book.bankcard_no,
@@ -1823,47 +2623,152 @@ def paybook_bankgrant():
             except IndexError:
                 pass
             zipf.writestr('{}.csv'.format(i + 1), '\n'.join(lines))
+        zipf.close()
         f.seek(0)
-        data = f.read()
-    db.session.commit()
-    return Response(
-        (x for x in data),
-        mimetype='application/zip',
-        headers={
-            'Content-Disposition': 'attachment;filename={}.csv'.format(
-                peroid)})
+        return f.read()
+
+
+@job_queue.task('paybook_bankgrant')
+def paybook_bankgrant_job(job, peroid):
+    peroid = DateConverter.to_python(peroid)
+    shutil.copyfile(
+        grant_cache.fetch(peroid, lambda: _bankgrant_zip(peroid)),
+        job_queue.path(job, 'bankgrant.zip'))
+    return 'bankgrant.zip'
+
+
+def _own_job(pk):
+    job = db.my_get_obj_or_404(Job, Job.id, pk)
+    if job.user_id != current_user.id and not current_user.has_role('admin'):
+        abort(403)
+    return job
+
+
+@app.route('/job/<int:pk>', methods=['GET'])
+@login_required
+def job_status(pk):
+    '''json state and progress of the job'''
+    job = _own_job(pk)
+    status = job_queue.status(job)
+    if job.result:
+        status['result'] = url_for('job_result', pk=job.id)
+    return flask.jsonify(**status)
+
+
+@app.route('/job/<int:pk>/result', methods=['GET'])
+@login_required
+def job_result(pk):
+    job = _own_job(pk)
+    if job.status != 'done' or not job.result:
+        abort(404)
+    return flask.send_file(job_queue.path(job, job.result),
+                           as_attachment=True,
+                           attachment_filename=job.result)
+
+
+def _own_upload(upload_id, complete=False):
+    upload = upload_spool.get(upload_id)
+    if upload is None:
+        abort(404)
+    if upload['user_id'] != current_user.id:
+        abort(403)
+    if complete and not upload['complete']:
+        abort(409)
+    return upload
+
+
+@app.route('/upload', methods=['POST'])
+@login_required
+def upload_start():
+    '''start a chunked upload of file name, size is its bytes'''
+    size = request.form.get('size', type=int)
+    if size is None or size < 0:
+        abort(400)
+    return flask.jsonify(**upload_spool.start(
+        current_user.id, request.form.get('name'), size)), 201
+
+
+@app.route('/upload/<upload_id>', methods=['GET', 'PUT'])
+@login_required
+def upload_part(upload_id):
+    '''
+    GET the state of the upload, its offset is where the next part starts.
+    PUT a part, the body is its raw bytes, arg offset is where it starts.
+    '''
+    _own_upload(upload_id)
+    if request.method == 'PUT':
+        try:
+            upload_spool.append(upload_id, request.args.get(
+                'offset', type=int), request.stream)
+        except OffsetError as e:
+            return flask.jsonify(offset=e.offset), 409
+        except SizeError as e:
+            return flask.jsonify(offset=e.offset, size=e.size), 413
+    return flask.jsonify(**upload_spool.get(upload_id))
+
+
+@app.route('/upload/<upload_id>/paybook', methods=['POST'])
+@pay_admin_required
+@DbLogger.log_template('{{ peroid }},{{ name }}')
+def paybook_upload_spooled(upload_id):
+    '''paybook upload of a completed chunked upload'''
+    upload = _own_upload(upload_id, complete=True)
+    peroid = DateConverter.to_python(request.args.get('peroid'))
+    DbLogger.log(peroid=peroid, name=upload['name'])
+    if _in_background():
+        job = job_queue.enqueue('paybook_upload', current_user.id,
+                                upload_spool.path(upload_id))
+        upload_spool.discard(upload_id)
+        return _queued(job)
+    with open(upload_spool.path(upload_id), 'rb') as f:
+        duplicates = _paybook_upload(f)
+    upload_spool.discard(upload_id)
+    return _upload_result(duplicates)
+
+
+@app.route('/upload/<upload_id>/person', methods=['POST'])
+@admin_required
+@DbLogger.log_template('{{ name }}')
+def person_upload_spooled(upload_id):
+    '''person upload of a completed chunked upload'''
+    upload = _own_upload(upload_id, complete=True)
+    DbLogger.log(name=upload['name'])
+    if _in_background():
+        job = job_queue.enqueue('person_upload', current_user.id,
+                                upload_spool.path(upload_id))
+        upload_spool.discard(upload_id)
+        return _queued(job)
+    with open(upload_spool.path(upload_id), 'rb') as f:
+        duplicates = _person_upload(f)
+    upload_spool.discard(upload_id)
+    return _upload_result(duplicates)
 
 
 @app.route('/paybook/public', methods=['GET'])
 @admin_required
 @DbLogger.log_template()
 def paybook_public_report():
-    money = func.sum(PayBook.money).label('money')
+    mindate, maxdate = map(
+        lambda x: DateConverter.to_python(request.args.get(x)),
+        ('mindate', 'maxdate'))
+    rows = ledger(mindate, maxdate)
+    money = func.sum(rows.c.money).label('money')
     query = db.session.query(
         Person.idcard.label('idcard'),
         Person.name.label('name'),
         Address.name.label('address_name'),
         Person.address_detail.label('address_detail'),
-        money).join(
-            PayBook, PayBook.person_id == Person.id).join(
+        money).select_from(rows).join(
+            Person, Person.id == rows.c.person_id).join(
                 Address, Address.id == Person.address_id)
-    mindate, maxdate = map(
-        lambda x: request.args.get(x),
-        ('mindate', 'maxdate'))
-    if mindate:
-        mindate = DateConverter.to_python(mindate)
-        query = query.filter(PayBook.peroid >= mindate)
-    if maxdate:
-        maxdate = DateConverter.to_python(maxdate)
-        query = query.filter(PayBook.peroid <= maxdate)
     books = query.group_by(
-        PayBook.person_id).having(
+        rows.c.person_id).having(
             money > 0)
 
     def book2csv(book):
         return ','.join(
             map(
-                lambda f: str(f),
+                lambda f: unicode(f).encode('utf-8'),
                 (
                     book.idcard,
                     book.name,
@@ -1880,6 +2785,69 @@ def paybook_public_report():
                      mindate, maxdate)})
 
 
+@app.route('/paybook/analysis', methods=['GET'])
+@admin_required
+def paybook_analysis():
+    '''
+    money of the paybooks from the columnar ledger, grouped by the child
+    addresses of address (its own persons are grouped under address), by
+    month and by item.
+    args: address (id, default the user's), items (names, comma separated),
+    mindate, maxdate, by (any of address, month and item, comma separated,
+    default address,month).
+'''
+    columns = dict(address='address_id', month='month', item='item_id')
+    by = (request.args.get('by') or 'address,month').split(',')
+    if any(name not in columns for name in by):
+        abort(400)
+    root = request.args.get('address', type=int) or current_user.address_id
+    if root not in current_user.address_ids:
+        abort(403)
+    addresses, childs = {}, {}
+    for address in db.session.query(
+            Address.id, Address.parent_id, Address.name):
+        addresses[address.id] = address.name
+        childs.setdefault(address.parent_id, []).append(address.id)
+    # every address under root to the child of root it is in
+    groups = numpy.full(max(addresses) + 1, -1, dtype=numpy.int64)
+    groups[root] = root
+    stack = [(child, child) for child in childs.get(root, ())]
+    while stack:
+        id, group = stack.pop()
+        groups[id] = group
+        stack.extend((child, group) for child in childs.get(id, ()))
+    mindate, maxdate = map(
+        lambda x: DateConverter.to_python(request.args.get(x)),
+        ('mindate', 'maxdate'))
+    books = ledger_columns.get().filter(
+        address_id=numpy.flatnonzero(groups >= 0), month=tuple(
+            month_index(day) if day else None for day in (mindate, maxdate)))
+    items = dict(db.session.query(PayBookItem.id, PayBookItem.name))
+    if request.args.get('items'):
+        names = request.args.get('items').split(',')
+        books = books.filter(item_id=[
+            id for id, name in items.items() if name in names])
+    labels = dict(
+        address=lambda id: addresses[id],
+        month=lambda index: month_date(index).strftime('%Y%m'),
+        item=lambda id: items.get(id, id))
+
+    def group2csv(group):
+        keys, cents = group
+        return u','.join([labels[name](key) for name, key in zip(
+            by, keys)] + [unicode(Decimal(cents).scaleb(-2))]).encode(
+                'utf-8')
+    lines = map(group2csv, books.group_sum(
+        *[columns[name] for name in by], address_id=groups))
+    db.session.commit()
+    return Response(
+        '\n'.join(lines),
+        mimetype="text/plain",
+        headers={"Content-Disposition":
+                 "attachment;filename=analysis_{}-{}.csv".format(
+                     mindate, maxdate)})
+
+
 @app.route('/paybook/check', methods=['GET', 'POST'])
 @pay_admin_required
 def paybook_check():
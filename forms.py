@@ -11,6 +11,8 @@ from models import db
 from models import (
     User, Role, Address, Person, Standard, PersonStandardAssoc, Bankcard,
     Note, PayBookItem, PayBook)
+from choice_cache import choices
+from user_cache import UserCache
 
 
 BaseModelForm = model_form_factory(Form)
@@ -69,14 +71,8 @@ class AdminAddRoleForm(_AdminRoleForm):
 
     def __init__(self, user, **kwargs):
         super(AdminAddRoleForm, self).__init__(user, **kwargs)
-        if user.roles:
-            self.role.choices = map(
-                lambda x: (x.id, x.name),
-                Role.query.filter(
-                    ~Role.id.in_(map(lambda x: x.id, user.roles))).all())
-        else:
-            self.role.choices = map(
-                lambda x: (x.id, x.name), Role.query.all())
+        self.role.choices = choices(
+            Role, exclude=set(map(lambda x: x.id, user.roles)))
 
     def populate_obj(self, user):
         role = Role.query.get(self.role.data)
@@ -91,9 +87,7 @@ class AdminUserBindaddrForm(Form):
 
     def __init__(self, *args, **kwargs):
         super(AdminUserBindaddrForm, self).__init__(*args, **kwargs)
-        self.address.choices = map(
-            lambda addr: (addr.id, addr.name),
-            Address.query.all())
+        self.address.choices = choices(Address)
         self.address.choices.append(('', ''))
 
 
@@ -126,12 +120,9 @@ class AddressForm(ModelForm):
     def __init__(self, **kwargs):
         super(AddressForm, self).__init__(**kwargs)
         address = kwargs.get('obj', None)
-        if address:
-            # self can not be self's parent
-            query = Address.query.filter(Address.id != address.id)
-        else:
-            query = Address.query
-        self.parent_id.choices = map(lambda x: (x.id, x.name), query.all())
+        # self can not be self's parent
+        self.parent_id.choices = choices(
+            Address, exclude=address and (address.id, ) or ())
         self.parent_id.choices.append(('', ''))
 
     class Meta:
@@ -149,16 +140,14 @@ class PersonForm(ModelForm):
     def __init__(self, user, **kwargs):
         super(PersonForm, self).__init__(**kwargs)
         self.user = user
-        if user.address:
-            addresses = [a for a in user.address.descendants]
-            addresses.append(user.address)
-        else:
-            addresses = []
-        self.address_id.choices = map(lambda x: (x.id, x.name), addresses)
+        address_ids = getattr(user, 'address_ids', None)
+        if address_ids is None:
+            address_ids = UserCache.address_scope(user.address_id)
+        self.address_id.choices = choices(Address, address_ids)
 
     def populate_obj(self, person):
         super(PersonForm, self).populate_obj(person)
-        person.create_by = self.user
+        person.create_user_id = self.user.id
         if person.status is None:
             person.reg()
 
@@ -183,8 +172,7 @@ class StandardBindForm(Form):
     def __init__(self, person, **kwargs):
         super(StandardBindForm, self).__init__(**kwargs)
         self.person = person
-        self.standard_id.choices = map(lambda s: (s.id, s.name),
-                                       Standard.query.all())
+        self.standard_id.choices = choices(Standard)
 
     def populate_obj(self, person):
         assoc = PersonStandardAssoc(
@@ -223,11 +211,9 @@ class PayItemForm(ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(PayItemForm, self).__init__(*args, **kwargs)
-        query = PayBookItem.query
         obj = kwargs.get('obj', None)
-        if obj:
-            query = query.filter(PayBookItem.id != obj.id)
-        self.parent_id.choices = map(lambda a: (a.id, a.name), query.all())
+        self.parent_id.choices = choices(
+            PayBookItem, exclude=obj and (obj.id, ) or ())
 
     class Meta:
         model = PayBookItem
@@ -246,16 +232,15 @@ class AmendForm(ModelForm):
         self.bookmanager = kwargs['obj']
         self.books = self.bookmanager.lst_groupby_bankcard()
 
+    @staticmethod
+    def amendable(books):
+        '''can the balance rows books of a person be amended'''
+        return all(book.item_name in ['sys_should_pay', 'bank_payed'] and
+                   book.binded for book in books)
+
     def validate_on_submit(self):
-        for book in self.books:
-            item = (lambda x, q: isinstance(x, int) and q.get(x) or x)(
-                book.item, PayBookItem.query)
-            if item.name not in ['sys_should_pay', 'bank_payed']:
-                return False
-            bankcard = (lambda x, q: isinstance(x, int) and q.get(x) or x)(
-                book.bankcard, Bankcard.query)
-            if not bankcard.binded:
-                return False
+        if not self.amendable(self.books):
+            return False
         return super(AmendForm, self).validate_on_submit()
 
     def populate_obj(self, lst=[]):
@@ -290,6 +275,23 @@ class FailCorrectForm(Form):
         'bankcard', validators=[Regexp('^(?:\d{19})|(?:{\d{2}-\d{15})$')])
 
 
+class ProfileForm(Form):
+    endpoints = TextField('endpoints, comma separated')
+    users = TextField('user ids, comma separated', validators=[
+        Regexp(r'^\s*(?:\d+\s*(?:,\s*\d+\s*)*)?$')])
+    fraction = DecimalField(
+        'fraction of all requests',
+        validators=[Optional(), NumberRange(min=0, max=1)], places=3)
+
+    def populate_obj(self, settings):
+        settings.update(
+            endpoints=[e.strip() for e in self.endpoints.data.split(',')
+                       if e.strip()],
+            users=[int(u) for u in self.users.data.split(',') if u.strip()],
+            fraction=float(self.fraction.data or 0))
+        return settings
+
+
 class SuccessCorrectForm(Form):
     money = DecimalField('failed money',
                          validators=[NumberRange(0.01, 1000000)],
@@ -0,0 +1,326 @@
+# coding=utf-8
+'''
+deterministic production scale dataset.
+example:
+    python gen_dataset.py --uri sqlite:////tmp/100k.db --scale 100k \
+        --out /tmp/100k
+the database gets:
+    an admin user (password admin) with the admin, person_admin and
+        pay_admin roles, bound to the county.
+    a county -> towns -> villages address tree.
+    persons with valid idcards, the birthday is idcard2birthday(idcard);
+        the older ones are retired with their standards bound.
+    one bankcard of every person, some persons have a second one and some
+        bankcards are not binded.
+    --years of monthly paybook tuples of the retired persons: system should
+        pay -> bank should pay -> bank payed, 1% failed.
+the out folder gets the upload files of the current month:
+    persons.csv: new persons for /person/upload.
+    paybook.csv: the bank should pay file of /paybook/upload and
+        /paybook/check.
+    fails.txt: the fail list of /paybook/batchsuccess.
+same arguments give the same data.
+'''
+import os
+import io
+import codecs
+import random
+import argparse
+import time
+from datetime import date, datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from models import (
+    app, db, User, Role, Address, Person, Standard, PersonStandardAssoc,
+    Bankcard, PayBookItem, PayBook, PersonStatusCounter)
+
+SCALES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+ITEMS = (
+    ('sys', ('sys_should_pay', 'sys_amend')),
+    ('bank', ('bank_should_pay', 'bank_payed', 'bank_failed')),
+)
+STANDARDS = ((u'basic pension', 55.0), (u'over 75 allowance', 10.0))
+ROLES = ('admin', 'person_admin', 'pay_admin')
+COUNTY_NO = '420525'
+FIRST_BIRTHDAY = date(1930, 1, 1)
+BIRTHDAY_DAYS = 21900
+IMPLEMENT_DATE = date(2011, 7, 1)
+
+_SURNAMES = u'王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗'
+_GIVEN_NAMES = u'伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华'
+_CHECK_WEIGHTS = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+_CHECK_DIGITS = '10X98765432'
+
+
+def idcard2birthday(idcard):
+    return datetime.strptime(idcard[6:14], '%Y%m%d').date()
+
+
+def make_idcard(region_no, birthday, seq):
+    '''18 digits idcard with the GB 11643 check digit'''
+    body = '{}{}{:03d}'.format(region_no, birthday.strftime('%Y%m%d'), seq)
+    total = sum(int(c) * w for c, w in zip(body, _CHECK_WEIGHTS))
+    return body + _CHECK_DIGITS[total % 11]
+
+
+def retire_day(birthday):
+    '''the same as Person.earliest_retire_day'''
+    return max(date(birthday.year, birthday.month, 1) +
+               relativedelta(years=60, months=1), IMPLEMENT_DATE)
+
+
+def months(start, end):
+    '''first days of the months from start's to the one before end's'''
+    month = date(start.year, start.month, 1)
+    while month < end:
+        yield month
+        month += relativedelta(months=1)
+
+
+class DatasetGenerator(object):
+    '''fill the database and write the upload files, see module doc'''
+
+    def __init__(self, count, years=3, period=None, seed=0,
+                 chunk_size=10000):
+        self.count = count
+        self.years = years
+        today = date.today()
+        self.period = period or date(today.year, today.month, 1)
+        self.rnd = random.Random(seed)
+        self.chunk_size = chunk_size
+        self.villages_per_town = max(5, min(99, count // 50000))
+        self.upload_lines = []
+        self.fail_lines = []
+
+    def _person(self, i):
+        '''idcard, birthday, name of the i-th person, idcards are unique'''
+        day = (i * 7919) % BIRTHDAY_DAYS
+        birthday = FIRST_BIRTHDAY + timedelta(days=day)
+        idcard = make_idcard(COUNTY_NO, birthday, i // BIRTHDAY_DAYS)
+        name = self.rnd.choice(_SURNAMES) + self.rnd.choice(_GIVEN_NAMES)
+        return idcard, idcard2birthday(idcard), name
+
+    def create_base(self):
+        roles = [Role(name=name) for name in ROLES]
+        county = Address(no=COUNTY_NO, name=u'county')
+        db.session.add_all(roles + [county])
+        db.session.flush()
+        user = User(name='admin', password='admin', roles=roles,
+                    address_id=county.id)
+        db.session.add(user)
+        villages = []
+        for town_no in range(20):
+            town = Address(no='{}{:02d}'.format(COUNTY_NO, town_no),
+                           name=u'town{}'.format(town_no),
+                           parent_id=county.id)
+            db.session.add(town)
+            db.session.flush()
+            for village_no in range(self.villages_per_town):
+                villages.append(Address(
+                    no='{}{:03d}'.format(town.no, village_no),
+                    name=u'village{}-{}'.format(town_no, village_no),
+                    parent_id=town.id))
+        db.session.add_all(villages)
+        items = []
+        for parent_name, names in ITEMS:
+            parent = PayBookItem(name=parent_name, direct=1)
+            db.session.add(parent)
+            db.session.flush()
+            items.extend(PayBookItem(name=name, direct=1,
+                                     parent_id=parent.id) for name in names)
+        standards = [Standard(name=name, money=money)
+                     for name, money in STANDARDS]
+        db.session.add_all(items + standards)
+        db.session.commit()
+        # plain values, expired objects would reload on every access
+        self.user_id = user.id
+        self.villages = [(village.id, village.no) for village in villages]
+        self.item_ids = dict((item.name, item.id) for item in items)
+        self.standards = [(standard.id, standard.money)
+                          for standard in standards]
+
+    def _status(self, birthday):
+        '''(status, retire day, stop day)'''
+        roll = self.rnd.random()
+        retire = retire_day(birthday)
+        if retire <= self.period:
+            if roll < 0.92:
+                return Person.NORMAL_RETIRE, retire, None
+            stop = retire + timedelta(
+                days=self.rnd.randint(0, (self.period - retire).days))
+            if roll < 0.97:
+                return Person.DEAD_RETIRE, retire, stop
+            if roll < 0.99:
+                return Person.ABORT_RETIRE, retire, stop
+            return Person.SUSPEND_RETIRE, retire, stop
+        if roll < 0.95:
+            return Person.NORMAL, None, None
+        if roll < 0.97:
+            return Person.DEAD_UNRETIRE, None, self.period
+        if roll < 0.98:
+            return Person.ABROT_UNRETIRE, None, None
+        return Person.REG, None, None
+
+    def _paybooks(self, person_id, bankcard_id, money, start, end, rows):
+        '''monthly tuples from start's month to the one before end'''
+        def pair(item1, item2, peroid, remark):
+            for item, value in ((item1, -money), (item2, money)):
+                rows.append(dict(
+                    person_id=person_id, bankcard_id=bankcard_id,
+                    item_id=self.item_ids[item], money=value,
+                    _peroid=peroid, create_date=peroid,
+                    create_user_id=self.user_id, remark=remark))
+        last = self.period - relativedelta(months=1)
+        for peroid in months(max(start, self.period - relativedelta(
+                years=self.years)), end):
+            pair('sys_should_pay', 'bank_should_pay', peroid, None)
+            if self.rnd.random() < 0.01:
+                pair('bank_should_pay', 'bank_failed', peroid,
+                     'batch success')
+                if peroid == last:
+                    continue
+                pair('bank_failed', 'bank_should_pay', peroid,
+                     'fail correct')
+            pair('bank_should_pay', 'bank_payed', peroid, 'batch success')
+
+    def create_persons(self):
+        now = datetime.now()
+        (basic_id, basic_money), (over75_id, over75_money) = self.standards
+        bankcard_id = 0
+        persons, bankcards, assoces, paybooks = [], [], [], []
+        for i in range(self.count):
+            person_id = i + 1
+            idcard, birthday, name = self._person(i)
+            village_id, village_no = self.rnd.choice(self.villages)
+            status, retire, stop = self._status(birthday)
+            wage = round(self.rnd.uniform(0, 500), 2)\
+                if status == Person.NORMAL_RETIRE else 0.0
+            persons.append(dict(
+                id=person_id, idcard=idcard, _birthday=birthday, name=name,
+                address_id=village_id,
+                address_detail=u'{}组'.format(self.rnd.randint(1, 12)),
+                securi_no='{}{:09d}'.format(COUNTY_NO, person_id),
+                _personal_wage=wage, _status=status, retire_day=retire,
+                dead_day=stop if status in (
+                    Person.DEAD_RETIRE, Person.DEAD_UNRETIRE) else None,
+                create_user_id=self.user_id, create_time=now))
+            owners = [person_id] * (2 if self.rnd.random() < 0.03 else 1)
+            if self.rnd.random() < 0.01:
+                owners.insert(0, None)
+            for owner_id in owners:
+                bankcard_id += 1
+                bankcards.append(dict(
+                    id=bankcard_id, no='6228{:015d}'.format(bankcard_id),
+                    name=name, owner_id=owner_id,
+                    create_user_id=self.user_id, create_time=now))
+            if retire is not None:
+                money = basic_money + wage
+                assoces.append(dict(
+                    person_id=person_id, standard_id=basic_id,
+                    start_date=retire, end_date=stop))
+                over75_day = date(birthday.year + 75, birthday.month, 1)
+                if over75_day <= (stop or self.period):
+                    assoces.append(dict(
+                        person_id=person_id, standard_id=over75_id,
+                        start_date=max(retire, over75_day), end_date=stop))
+                    money += over75_money
+                self._paybooks(person_id, bankcard_id, money,
+                               retire, stop or self.period, paybooks)
+                if status == Person.NORMAL_RETIRE:
+                    self._upload_line(persons[-1], village_no,
+                                      bankcards[-1], money)
+            if len(persons) >= self.chunk_size or\
+                    len(paybooks) >= self.chunk_size * 10:
+                self._insert(persons, bankcards, assoces, paybooks)
+                persons, bankcards, assoces, paybooks = [], [], [], []
+        self._insert(persons, bankcards, assoces, paybooks)
+        PersonStatusCounter.rebuild()
+        db.session.commit()
+        self._sync_sequences()
+
+    def _upload_line(self, person, village_no, bankcard, money):
+        self.upload_lines.append(u'|'.join((
+            person['securi_no'], person['name'], person['idcard'],
+            '{:.2f}'.format(money), village_no, bankcard['no'])))
+        if self.rnd.random() < 0.01:
+            self.fail_lines.append('{},{:.2f}'.format(bankcard['no'], money))
+
+    @staticmethod
+    def _insert(persons, bankcards, assoces, paybooks):
+        for table, rows in (
+                (Person.__table__, persons),
+                (Bankcard.__table__, bankcards),
+                (PersonStandardAssoc.__table__, assoces),
+                (PayBook.__table__, paybooks)):
+            if rows:
+                db.session.execute(table.insert(), rows)
+
+    @staticmethod
+    def _sync_sequences():
+        '''ids were given explicitly, move postgresql sequences after them'''
+        if db.engine.dialect.name != 'postgresql':
+            return
+        for table in ('persons', 'bankcards'):
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "(SELECT max(id) FROM {0}))".format(table))
+        db.session.commit()
+
+    def write_files(self, folder, new_persons=None):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        new_persons = new_persons or max(10, self.count // 100)
+        lines = []
+        for i in range(self.count, self.count + new_persons):
+            idcard, birthday, name = self._person(i)
+            village_id, village_no = self.rnd.choice(self.villages)
+            lines.append(u','.join((
+                idcard, name, village_no,
+                u'{}号'.format(self.rnd.randint(1, 200)),
+                '{}{:09d}'.format(COUNTY_NO, i + 1))))
+        for name, lines in (
+                ('persons.csv', lines),
+                ('paybook.csv', self.upload_lines),
+                ('fails.txt', self.fail_lines)):
+            with io.open(os.path.join(folder, name), 'wb') as f:
+                if name.endswith('.csv'):
+                    f.write(codecs.BOM_UTF8)
+                f.write(u'\n'.join(lines).encode('utf-8'))
+
+
+def generate(count, years=3, out=None, period=None, seed=0):
+    '''fill the empty database of app and write the files to out'''
+    generator = DatasetGenerator(count, years, period, seed)
+    generator.create_base()
+    generator.create_persons()
+    if out:
+        generator.write_files(out)
+    return generator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='generate a production scale dataset')
+    parser.add_argument('--uri', dest='uri', required=True,
+                        help='database uri of an empty database')
+    parser.add_argument('--scale', dest='scale', default='10k',
+                        help='{} or a number of persons'.format(
+                            '/'.join(sorted(SCALES))))
+    parser.add_argument('--years', dest='years', type=int, default=3,
+                        help='years of paybooks before the current month')
+    parser.add_argument('--out', dest='out',
+                        help='folder of the upload files')
+    parser.add_argument('--period', dest='period',
+                        help='current month, as 201703, default now')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    args = parser.parse_args()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.uri
+    app.config['SQLALCHEMY_ECHO'] = False
+    db.create_all()
+    if Person.query.count():
+        parser.error('database of {} is not empty'.format(args.uri))
+    start = time.time()
+    generate(SCALES.get(args.scale.lower()) or int(args.scale),
+             args.years, args.out,
+             args.period and datetime.strptime(args.period, '%Y%m').date(),
+             args.seed)
+    print('generated in {:.1f}s'.format(time.time() - start))
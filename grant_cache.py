@@ -0,0 +1,159 @@
+# coding=utf-8
+'''
+generated bank grant zips cached on disk.
+a zip is kept in GRANT_CACHE_FOLDER (default UPLOAD_FOLDER/grants) under
+its peroid and the ledger versions it was made at: the version of its
+peroid, which changes when a commit inserts, updates or deletes paybooks
+of the peroid, and the version of the whole ledger, which changes on bulk
+paybook changes and on changes of the person and bankcard fields in the
+zip. the versions are files, so every process sees the commits of the
+others. a version is changed after the commit, a zip made meanwhile is
+keyed by the old version and never served again. versions start with the
+time they were made at, so they sort in the order of the changes.
+paybooks written with core inserts must be marked with mark(session, ...).
+'''
+import os
+import time
+import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+from models import app, PayBook, Person, Bankcard
+
+ALL = 'all'
+LEDGER = 'ledger'
+_FIELDS = {Person: ('idcard', '_status'), Bankcard: ('no', 'name')}
+
+
+def peroid_key(peroid):
+    return peroid.strftime('%Y%m') if peroid else ALL
+
+
+def _order(version):
+    # the versions before they started with the time are shorter
+    return len(version), version
+
+
+class GrantCache(object):
+    '''bank grant zips by peroid and ledger version'''
+
+    @property
+    def folder(self):
+        return app.config.get('GRANT_CACHE_FOLDER') or os.path.join(
+            app.config.get('UPLOAD_FOLDER') or '.', 'grants')
+
+    def _read(self, key):
+        try:
+            with open(os.path.join(self.folder, key + '.version')) as f:
+                return f.read()
+        except IOError:
+            return '0'
+
+    def version(self, peroid):
+        return '{}-{}'.format(self._read(peroid_key(peroid)),
+                              self._read(LEDGER))
+
+    def bump(self, *keys):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        for key in keys:
+            path = os.path.join(self.folder, key + '.version')
+            tmp = '{}.{}'.format(path, uuid.uuid4().hex)
+            with open(tmp, 'w') as f:
+                f.write('{:x}{}'.format(int(time.time() * 1000000),
+                                        uuid.uuid4().hex[:6]))
+            os.rename(tmp, path)
+
+    def path(self, peroid, version):
+        return os.path.join(self.folder, '{}_{}.zip'.format(
+            peroid_key(peroid), version))
+
+    def fetch(self, peroid, make):
+        '''path of the zip of peroid, make() -> zip bytes if not cached'''
+        version = self.version(peroid)
+        path = self.path(peroid, version)
+        if os.path.isfile(path):
+            return path
+        data = make()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        tmp = '{}.{}'.format(path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        # a zip of an older version is never served again, a newer one may
+        # have been made by another process meanwhile and is kept
+        prefix = peroid_key(peroid) + '_'
+        current = map(_order, version.split('-'))
+        for name in os.listdir(self.folder):
+            if not (name.startswith(prefix) and name.endswith('.zip')):
+                continue
+            versions = name[len(prefix):-len('.zip')].split('-')
+            if len(versions) == 2 and versions != version.split('-') and all(
+                    _order(old) <= new
+                    for old, new in zip(versions, current)):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+        return path
+
+
+grant_cache = GrantCache()
+
+
+def mark(session, *peroids):
+    '''the session changed paybooks of peroids, None for all of them'''
+    keys = session.info.setdefault('grant_changes', set())
+    keys.add(ALL)
+    for peroid in peroids:
+        keys.add(peroid_key(peroid) if peroid else LEDGER)
+
+
+def _paybook_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        old = get_history(target, '_peroid').deleted
+        mark(session, target.peroid, *(old or ()))
+
+
+for _name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(PayBook, _name, _paybook_changed)
+
+
+def _field_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and any(
+            get_history(target, key).has_changes()
+            for key in _FIELDS[type(target)]):
+        mark(session, None)
+
+
+def _row_deleted(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        mark(session, None)
+
+
+for _model in _FIELDS:
+    event.listen(_model, 'after_update', _field_changed)
+    event.listen(_model, 'after_delete', _row_deleted)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _bulk_changed(context):
+    if context.mapper.class_ in (PayBook, Person, Bankcard):
+        mark(context.session, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_versions(session):
+    keys = session.info.pop('grant_changes', None)
+    if keys:
+        grant_cache.bump(*keys)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_grant_changes(session, previous_transaction):
+    session.info.pop('grant_changes', None)
@@ -0,0 +1,207 @@
+# coding=utf-8
+'''
+local background jobs for the long paybook operations.
+a job is a row of the jobs table, its files are in the folder
+JOB_FOLDER/<job id> (default UPLOAD_FOLDER/jobs): the uploaded input, the
+progress and the result. the workers are started by
+    python run.py worker --processes 2
+every worker takes the oldest queued job, runs its task as the user who
+queued it, inside a request context so flash, abort and current_user work
+like in the view, and commits when the task returns.
+while a job runs its worker sets its heartbeat_time every
+JOB_HEARTBEAT_SECONDS (default 30); a running job whose heartbeat is older
+than JOB_STALE_SECONDS (default 300) lost its worker and is queued again.
+'''
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from flask import get_flashed_messages
+from flask_login import login_user
+from models import db, Job
+from user_cache import user_cache, CachedUser
+
+INPUT = 'input'
+PROGRESS = 'progress'
+
+
+class Progress(object):
+    '''callable writing done (and total) of a job, at most every second'''
+
+    def __init__(self, path, total=None):
+        self.path = path
+        self.total = total
+        self.done = 0
+        self.written = 0
+
+    def __call__(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        if time.time() - self.written >= 1:
+            self.write()
+
+    def write(self):
+        self.written = time.time()
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(dict(done=self.done, total=self.total), f)
+        os.rename(self.path + '.tmp', self.path)
+
+
+class JobQueue(object):
+    '''the tasks and the jobs of app'''
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def folder(self):
+        return self.app.config.get('JOB_FOLDER') or os.path.join(
+            self.app.config.get('UPLOAD_FOLDER') or '.', 'jobs')
+
+    def path(self, job, name):
+        '''path of file name of job, its folder is created'''
+        folder = os.path.join(self.folder, str(job.id))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return os.path.join(folder, name)
+
+    def task(self, kind):
+        '''
+        register the decorated fun(job, **params) as the task of kind.
+        the return value is the name of the result file of the job folder.
+        '''
+        def decorator(f):
+            self.tasks[kind] = f
+            return f
+        return decorator
+
+    def enqueue(self, kind, user_id, upload=None, **params):
+        '''
+        queue a job of kind, upload is a FileStorage saved as its input,
+        or the path of a file moved to be its input.
+        '''
+        if kind not in self.tasks:
+            raise KeyError('no task {}'.format(kind))
+        job = Job(kind=kind, user_id=user_id, params=json.dumps(params))
+        db.session.add(job)
+        db.session.commit()
+        if isinstance(upload, basestring):
+            shutil.move(upload, self.path(job, INPUT))
+        elif upload is not None:
+            upload.save(self.path(job, INPUT))
+        return job
+
+    def progress(self, job):
+        '''Progress of job, its last value is written when the job ends'''
+        job.progress = Progress(self.path(job, PROGRESS))
+        return job.progress
+
+    def status(self, job):
+        '''dict of the state of job'''
+        result = dict(id=job.id, kind=job.kind, status=job.status,
+                      error=job.error, done=None, total=None)
+        path = os.path.join(self.folder, str(job.id), PROGRESS)
+        if os.path.isfile(path):
+            with open(path) as f:
+                result.update(json.load(f))
+        return result
+
+    def requeue_stale(self):
+        '''queue again the running jobs whose worker stopped beating'''
+        stale = datetime.now() - timedelta(
+            seconds=self.app.config.get('JOB_STALE_SECONDS', 300))
+        count = Job.query.filter(
+            Job.status == 'running',
+            func.coalesce(Job.heartbeat_time, Job.start_time) < stale).update(
+                dict(status='queued', worker=None, start_time=None,
+                     heartbeat_time=None),
+                synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def claim(self, worker):
+        '''take the oldest queued job, None if there is none'''
+        self.requeue_stale()
+        ids = db.session.query(Job.id).filter(
+            Job.status == 'queued').order_by(Job.id).limit(10).all()
+        for job_id, in ids:
+            # a worker wins the job only if it is still queued
+            now = datetime.now()
+            claimed = Job.query.filter(
+                Job.id == job_id, Job.status == 'queued').update(
+                    dict(status='running', worker=worker, start_time=now,
+                         heartbeat_time=now),
+                    synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(job_id)
+        return None
+
+    def beat(self, job_id, stop):
+        '''set the heartbeat_time of job until stop is set'''
+        interval = self.app.config.get('JOB_HEARTBEAT_SECONDS', 30)
+        with self.app.app_context():
+            while not stop.wait(interval):
+                # its own connection, the task holds the session
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(Job.__table__.update().where(
+                            Job.__table__.c.id == job_id).values(
+                                heartbeat_time=datetime.now()))
+                except Exception:
+                    self.app.logger.error(traceback.format_exc())
+
+    def run(self, job):
+        '''run the task of job and record how it ended'''
+        params = json.loads(job.params or '{}')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.beat, args=(job.id, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        with self.app.test_request_context():
+            try:
+                login_user(CachedUser(user_cache.get(job.user_id)),
+                           force=True)
+                job.result = self.tasks[job.kind](job, **params)
+                job.status = 'done'
+                if getattr(job, 'progress', None) is not None:
+                    job.progress.write()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(traceback.format_exc())
+                job.status = 'failed'
+                job.error = '; '.join(
+                    get_flashed_messages()) or unicode(e) or repr(e)
+            finally:
+                stop.set()
+                heartbeat.join()
+            job.finish_time = datetime.now()
+            db.session.commit()
+        return job
+
+    def work(self, poll=1.0, once=False):
+        '''run jobs until killed, or until none is queued if once'''
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        while True:
+            with self.app.app_context():
+                job = self.claim(worker)
+                if job is not None:
+                    self.run(job)
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll)
+
+
+job_queue = JobQueue()
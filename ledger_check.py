@@ -0,0 +1,148 @@
+# coding=utf-8
+'''
+double entry integrity check of the paybooks.
+every write of the ledger (create_tuple, settle_to) puts money on one item
+and takes it from another, so the paybooks of a write, of a person and of
+a peroid all sum to zero. the check scans paybooks in chunks of id, runs
+the chunks on several threads with a connection each, and in every chunk
+only keeps the groups not summing to zero. a balanced write ends in one
+chunk or is cut in two by a chunk edge, so adding up the kept groups of all
+chunks gives the groups really out of balance, without moving the whole
+ledger out of the database. a write is the paybooks of one person, peroid,
+creator, create date and remark.
+run it nightly with
+    python run.py check --threads 4
+'''
+import time
+import threading
+from Queue import Queue, Empty
+from decimal import Decimal
+from sqlalchemy import select, func, and_
+from models import PayBook
+
+CHUNK_SIZE = 100000
+# max writes whose paybooks are listed
+ROW_LIMIT = 1000
+_CENT = Decimal('0.01')
+_WRITE = ('person_id', '_peroid', 'create_user_id', 'create_date', 'remark')
+_CHECKS = {'writes': _WRITE, 'persons': ('person_id',),
+           'peroids': ('_peroid',)}
+
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(_CENT)
+
+
+class LedgerChecker(object):
+    '''check the paybooks of engine, of one peroid if it is given'''
+
+    def __init__(self, engine, threads=4, chunk_size=CHUNK_SIZE,
+                 peroid=None):
+        self.engine = engine
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.peroid = peroid
+        self.table = PayBook.__table__
+
+    def _filter(self, *clauses):
+        clauses = list(clauses)
+        if self.peroid:
+            first_date, last_date = PayBook._date_range(self.peroid)
+            clauses.extend((self.table.c._peroid >= first_date,
+                            self.table.c._peroid <= last_date))
+        return and_(*clauses)
+
+    def chunks(self):
+        '''(first id, last id) of every chunk'''
+        c = self.table.c
+        with self.engine.connect() as connection:
+            low, high = connection.execute(select([
+                func.min(c.id), func.max(c.id)]).where(
+                    self._filter())).first()
+        if low is None:
+            return []
+        return [(start, min(start + self.chunk_size - 1, high))
+                for start in xrange(low, high + 1, self.chunk_size)]
+
+    def check_chunk(self, connection, chunk):
+        '''{check: {key: money}} of the groups of chunk not summing to 0'''
+        c = self.table.c
+        where = self._filter(c.id >= chunk[0], c.id <= chunk[1])
+        money = func.sum(c.money)
+        result = {}
+        for check, names in _CHECKS.items():
+            columns = [c[name] for name in names]
+            result[check] = dict(
+                (tuple(row[:-1]), row[-1]) for row in connection.execute(
+                    select(columns + [money]).where(where).group_by(
+                        *columns).having(func.abs(money) >= 0.005)))
+        return result
+
+    def _work(self, chunks, results, errors):
+        try:
+            with self.engine.connect() as connection:
+                while True:
+                    try:
+                        chunk = chunks.get_nowait()
+                    except Empty:
+                        return
+                    results.append(self.check_chunk(connection, chunk))
+        except Exception as e:
+            errors.append(e)
+
+    def rows(self, connection, key):
+        '''the paybooks of the write key'''
+        c = self.table.c
+        return [dict(row) for row in connection.execute(select([
+            c.id, c.item_id, c.bankcard_id, c.money]).where(self._filter(*[
+                c[name] == value for name, value in zip(_WRITE, key)])
+            ).order_by(c.id))]
+
+    def run(self):
+        '''
+        dict of the writes, persons and peroids out of balance, as lists of
+        dicts of their key fields and money, the writes with their rows.
+        '''
+        start = time.time()
+        chunks, results, errors = Queue(), [], []
+        for chunk in self.chunks():
+            chunks.put(chunk)
+        report = dict(chunks=chunks.qsize())
+        threads = [threading.Thread(
+            target=self._work, args=(chunks, results, errors))
+            for i in range(max(1, min(self.threads, chunks.qsize())))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        for check, names in _CHECKS.items():
+            totals = {}
+            for result in results:
+                for key, value in result[check].items():
+                    totals[key] = totals.get(key, 0) + _money(value)
+            report[check] = [
+                dict(zip(names, key), money=money)
+                for key, money in sorted(totals.items()) if money]
+        with self.engine.connect() as connection:
+            for write in report['writes'][:ROW_LIMIT]:
+                write['rows'] = self.rows(
+                    connection, [write[name] for name in _WRITE])
+        report['seconds'] = time.time() - start
+        return report
+
+
+def format_report(report):
+    '''lines of the text of report'''
+    yield 'chunks: {chunks}, seconds: {seconds:.1f}'.format(**report)
+    for check in ('peroids', 'persons', 'writes'):
+        yield '{}: {} out of balance'.format(check, len(report[check]))
+        for group in report[check]:
+            yield '  ' + ', '.join(
+                u'{}={}'.format(name, value)
+                for name, value in sorted(group.items())
+                if name != 'rows').encode('utf-8')
+            for row in group.get('rows', ()):
+                yield '    id={id}, item_id={item_id}, ' \
+                    'bankcard_id={bankcard_id}, money={money}'.format(**row)
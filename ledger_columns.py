@@ -0,0 +1,360 @@
+# coding=utf-8
+'''
+columnar in memory snapshot of the paybooks for the analysis reports.
+every process keeps the columns of the paybooks as numpy arrays:
+person_id, bankcard_id (-1 for none), item_id, month (year * 12 + month - 1
+of the peroid), cents (money in integer cents) and address_id of the
+person. a read first loads the paybooks with an id over the last one
+loaded. a commit updating or deleting paybooks or moving persons writes a
+new version to LEDGER_COLUMNS_VERSION_FILE (default
+UPLOAD_FOLDER/ledger_columns.version) and every process loads again.
+the ids are taken before the commits, so a paybook can be committed after
+a higher id was loaded: the last ID_LAG ids are read again and the ones
+loaded already are skipped.
+a snapshot of the columns is kept as .npy files in LEDGER_SNAPSHOT_FOLDER
+(default UPLOAD_FOLDER/ledger). a process starting, or loading again,
+maps the snapshot of the version with mmap, so all the processes share one
+page cached copy, and loads only the paybooks after its max id. when the
+loaded paybooks reach LEDGER_SNAPSHOT_ROWS (default 500000) a new snapshot
+is written, so the first process loading the whole ledger writes one.
+    python run.py snapshot
+writes one at once, e.g. nightly.
+'''
+import os
+import json
+import fcntl
+import shutil
+import datetime
+import threading
+from uuid import uuid4
+import numpy
+from sqlalchemy import select, event, type_coerce, Float
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from models import app, db, PayBook, Person
+
+BATCH_SIZE = 100000
+ID_LAG = 1000
+# loaded paybooks kept in memory before a new snapshot is written
+SNAPSHOT_ROWS = 500000
+CURRENT = 'current'
+META = 'meta.json'
+LOCK = 'lock'
+COLUMNS = (('id', numpy.int64), ('person_id', numpy.int32),
+           ('bankcard_id', numpy.int32), ('item_id', numpy.int32),
+           ('month', numpy.int16), ('cents', numpy.int64),
+           ('address_id', numpy.int32))
+
+
+def month_index(day):
+    return day.year * 12 + day.month - 1
+
+
+def month_date(index):
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+class Columns(object):
+    '''arrays of some paybooks by column name, in one or more parts'''
+
+    def __init__(self, *parts):
+        self.parts = parts
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = self.parts[0] if len(self.parts) == 1 else dict(
+                (name, numpy.concatenate([part[name] for part in self.parts]))
+                for name, dtype in COLUMNS)
+        return self._arrays
+
+    def __len__(self):
+        return sum(len(part['id']) for part in self.parts)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def filter(self, **conditions):
+        '''
+        Columns of the rows with column in values, for name=values, or
+        low <= column <= high, for name=(low, high), None for no bound.
+        '''
+        masks = []
+        for part in self.parts:
+            mask = numpy.ones(len(part['id']), dtype=bool)
+            for name, values in conditions.items():
+                column = part[name]
+                if isinstance(values, tuple):
+                    low, high = values
+                    if low is not None:
+                        mask &= column >= low
+                    if high is not None:
+                        mask &= column <= high
+                else:
+                    mask &= numpy.in1d(column, list(values))
+            masks.append(mask)
+        return Columns(dict((name, numpy.concatenate([
+            part[name][mask] for part, mask in zip(self.parts, masks)]))
+            for name, dtype in COLUMNS))
+
+    def total(self):
+        return int(self.arrays['cents'].sum())
+
+    def group_sum(self, *names, **maps):
+        '''
+        [(keys, cents)] of the rows grouped by the columns names, sorted.
+        a name of maps groups by maps[name][column] instead, e.g. by the
+        ancestors of the addresses, the rows mapped to -1 are left out.
+        '''
+        keys = [self.arrays[name].astype(numpy.int64) for name in names]
+        mask = numpy.ones(len(self), dtype=bool)
+        for index, name in enumerate(names):
+            if name in maps:
+                lookup, key = numpy.asarray(maps[name]), keys[index]
+                inside = (key >= 0) & (key < len(lookup))
+                keys[index] = numpy.where(
+                    inside, lookup[numpy.where(inside, key, 0)], -1)
+                mask &= keys[index] >= 0
+        keys = [key[mask] for key in keys]
+        cents = self.arrays['cents'][mask]
+        if not len(cents):
+            return []
+        # the keys in one int64, a digit of base high - low + 1 a key
+        combined = numpy.zeros(len(cents), dtype=numpy.int64)
+        bases = []
+        for key in keys:
+            low, base = key.min(), key.max() - key.min() + 1
+            combined = combined * base + (key - low)
+            bases.append((low, base))
+        groups, inverse = numpy.unique(combined, return_inverse=True)
+        # exact while a sum is under 2 ** 53 cents
+        sums = numpy.rint(numpy.bincount(
+            inverse, weights=cents, minlength=len(groups))).astype(
+                numpy.int64)
+        columns = []
+        for low, base in reversed(bases):
+            columns.insert(0, groups % base + low)
+            groups = groups // base
+        return [(tuple(int(column[i]) for column in columns), int(sums[i]))
+                for i in range(len(sums))]
+
+
+class LedgerColumns(object):
+    '''
+    the Columns of all the paybooks: the mapped snapshot of the version
+    and the paybooks loaded after it.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear(None)
+
+    def clear(self, version):
+        self.version = version
+        self.size = 0
+        self.max_id = 0
+        self.base = dict(
+            (name, numpy.zeros(0, dtype=dtype)) for name, dtype in COLUMNS)
+        self.buffers = dict(self.base)
+
+    def tail(self):
+        return dict((name, buffer[:self.size])
+                    for name, buffer in self.buffers.items())
+
+    @property
+    def version_file(self):
+        return app.config.get('LEDGER_COLUMNS_VERSION_FILE') or \
+            os.path.join(app.config.get('UPLOAD_FOLDER') or '.',
+                         'ledger_columns.version')
+
+    def current_version(self):
+        try:
+            with open(self.version_file) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def invalidate(self):
+        '''write a new version, all processes load the paybooks again'''
+        path = self.version_file
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp = '{}.{}'.format(path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            f.write(uuid4().hex)
+        os.rename(tmp, path)
+        with self.lock:
+            self.clear(None)
+
+    @property
+    def snapshot_folder(self):
+        return app.config.get('LEDGER_SNAPSHOT_FOLDER') or os.path.join(
+            app.config.get('UPLOAD_FOLDER') or '.', 'ledger')
+
+    def open_snapshot(self):
+        '''map the snapshot if it is of the version, return if it is'''
+        folder = self.snapshot_folder
+        try:
+            with open(os.path.join(folder, CURRENT)) as f:
+                folder = os.path.join(folder, f.read())
+            with open(os.path.join(folder, META)) as f:
+                meta = json.load(f)
+            if meta['version'] != self.version:
+                return False
+            base = dict((name, numpy.load(
+                os.path.join(folder, name + '.npy'), mmap_mode='r'))
+                for name, dtype in COLUMNS)
+        except (IOError, ValueError, KeyError):
+            return False
+        self.base, self.max_id = base, meta['max_id']
+        return True
+
+    def save(self):
+        '''
+        write the columns as the snapshot of the version, sorted by id, and
+        map it instead of keeping the loaded paybooks in memory.
+        '''
+        columns = Columns(self.base, self.tail())
+        order = numpy.argsort(columns['id'], kind='mergesort')
+        if not os.path.isdir(self.snapshot_folder):
+            os.makedirs(self.snapshot_folder)
+        # one process saves at a time, the others wait for it
+        with open(os.path.join(self.snapshot_folder, LOCK), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            name = uuid4().hex
+            folder = os.path.join(self.snapshot_folder, name)
+            os.makedirs(folder)
+            for column, dtype in COLUMNS:
+                numpy.save(os.path.join(folder, column + '.npy'),
+                           columns[column][order])
+            with open(os.path.join(folder, META), 'w') as f:
+                json.dump(dict(version=self.version, max_id=self.max_id,
+                               size=len(order)), f)
+            path = os.path.join(self.snapshot_folder, CURRENT)
+            tmp = '{}.{}'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(name)
+            os.rename(tmp, path)
+            # a process mapping an old snapshot keeps its pages until it
+            # maps the new one
+            published = os.path.getmtime(folder)
+            for other in os.listdir(self.snapshot_folder):
+                other = os.path.join(self.snapshot_folder, other)
+                if other != folder and os.path.isdir(other) and \
+                        os.path.getmtime(other) < published:
+                    shutil.rmtree(other, True)
+            # the loaded paybooks are dropped only when the snapshot holding
+            # them is mapped, else they stay in memory
+            if self.open_snapshot():
+                self.size = 0
+                self.buffers = dict(
+                    (column, numpy.zeros(0, dtype=dtype))
+                    for column, dtype in COLUMNS)
+
+    def get(self):
+        '''Columns of the paybooks committed up to now'''
+        version = self.current_version()
+        with self.lock:
+            if version != self.version:
+                self.clear(version)
+                self.open_snapshot()
+            self.load()
+            if self.size >= app.config.get(
+                    'LEDGER_SNAPSHOT_ROWS', SNAPSHOT_ROWS):
+                self.save()
+            return Columns(self.base, self.tail())
+
+    def load(self):
+        books, persons = PayBook.__table__, Person.__table__
+        last_id = max(self.max_id - ID_LAG, 0)
+        while True:
+            rows = db.session.execute(select([
+                books.c.id, books.c.person_id, books.c.bankcard_id,
+                books.c.item_id, books.c._peroid,
+                # floats, a Decimal a row would take most of the time
+                type_coerce(books.c.money, Float),
+                persons.c.address_id]).select_from(books.join(
+                    persons, persons.c.id == books.c.person_id)).where(
+                        books.c.id > last_id).order_by(books.c.id).limit(
+                            BATCH_SIZE)).fetchall()
+            if rows:
+                self.append(rows)
+                last_id = rows[-1][0]
+            if len(rows) < BATCH_SIZE:
+                return
+
+    def append(self, rows):
+        ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        base = self.base['id']
+        loaded = self.buffers['id'][:self.size]
+        new = ~numpy.in1d(ids, numpy.concatenate((
+            base[numpy.searchsorted(base, ids.min()):],
+            loaded[loaded >= ids.min()])))
+        rows = [row for row, is_new in zip(rows, new) if is_new]
+        if not rows:
+            return
+        self.reserve(len(rows))
+        columns = zip(*rows)
+        values = dict(
+            id=columns[0], person_id=columns[1],
+            bankcard_id=[-1 if x is None else x for x in columns[2]],
+            item_id=columns[3], month=map(month_index, columns[4]),
+            cents=numpy.rint(numpy.array(
+                columns[5], dtype=numpy.float64) * 100),
+            address_id=[-1 if x is None else x for x in columns[6]])
+        end = self.size + len(rows)
+        for name, dtype in COLUMNS:
+            self.buffers[name][self.size:end] = numpy.asarray(
+                values[name]).astype(dtype)
+        self.size = end
+        self.max_id = max(self.max_id, int(ids.max()))
+
+    def reserve(self, count):
+        '''room for count more rows, the arrays double when they grow'''
+        capacity = len(self.buffers['id'])
+        if self.size + count <= capacity:
+            return
+        capacity = max(capacity * 2, self.size + count, 1024)
+        for name, dtype in COLUMNS:
+            buffer = numpy.zeros(capacity, dtype=dtype)
+            buffer[:self.size] = self.buffers[name][:self.size]
+            self.buffers[name] = buffer
+
+
+ledger_columns = LedgerColumns()
+
+
+def _columns_changed(session):
+    for obj in session.dirty:
+        if isinstance(obj, PayBook) and session.is_modified(obj) or \
+                isinstance(obj, Person) and \
+                get_history(obj, 'address_id').has_changes():
+            return True
+    return any(isinstance(obj, (PayBook, Person)) for obj in session.deleted)
+
+
+@event.listens_for(Session, 'after_flush')
+def _check_columns_changes(session, flush_context):
+    if not session.info.get('ledger_columns_changed') and \
+            _columns_changed(session):
+        session.info['ledger_columns_changed'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _check_bulk_columns_changes(context):
+    if context.mapper.class_ in (PayBook, Person):
+        context.session.info['ledger_columns_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_ledger_columns(session):
+    if session.info.pop('ledger_columns_changed', False):
+        ledger_columns.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_columns_changes(session, previous_transaction):
+    session.info.pop('ledger_columns_changed', None)
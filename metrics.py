@@ -0,0 +1,298 @@
+# coding=utf-8
+'''
+prometheus text format metrics at /metrics, without any external service.
+every process keeps its counters and histograms in memory and writes them
+to its own json file of METRICS_FOLDER (default UPLOAD_FOLDER/metrics) at
+most every METRICS_FLUSH_SECONDS (default 10); /metrics adds up the files
+of all the processes, so it works under multi-process servers. clear the
+folder when the server starts, like the prometheus multiprocess mode.
+the gauges of the pool are only reported for processes still alive.
+config:
+    METRICS: False to turn it off, default True.
+    METRICS_ALLOWED: remote addresses allowed to read /metrics, default
+        ('127.0.0.1',).
+the sql statements come from sql_stats, so create Metrics after SqlStats:
+after_request functions run in reverse order.
+'''
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+from flask import g, request, abort
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 22, 1 << 24,
+                1 << 26)
+
+# name: (type, help, buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'requests by endpoint, method and status', None),
+    'http_request_duration_seconds': (
+        'histogram', 'request latency by endpoint', BUCKETS),
+    'sql_statements_total': (
+        'counter', 'sql statements by endpoint', None),
+    'sql_statement_seconds_total': (
+        'counter', 'time of the sql statements by endpoint', None),
+    'db_pool_checkouts_total': (
+        'counter', 'connections taken from the pool', None),
+    'db_pool_wait_seconds': (
+        'histogram', 'time waiting for a pool connection', BUCKETS),
+    'db_pool_checked_out': (
+        'gauge', 'connections in use', None),
+    'db_pool_overflow': (
+        'gauge', 'connections over the pool size', None),
+    'operation_bytes': (
+        'histogram', 'size of uploads and exports by endpoint', SIZE_BUCKETS),
+}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return u'{}{{{}}}'.format(name, u','.join(u'{}="{}"'.format(
+        key, unicode(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels))
+
+
+class Registry(object):
+    '''metrics of this process'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels): value, labels are sorted (key, value) tuples
+        self.counters = {}
+        # (name, labels): [bucket counts..., sum, count]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self.lock:
+            item = self.histograms.get(key)
+            if item is None:
+                item = self.histograms[key] = [0] * (len(buckets) + 2)
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                item[index] += 1
+            item[-2] += value
+            item[-1] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def dump(self):
+        with self.lock:
+            return dict(
+                counters=[[name, labels, value] for (name, labels), value
+                          in self.counters.items()],
+                histograms=[[name, labels, list(item)]
+                            for (name, labels), item
+                            in self.histograms.items()])
+
+
+def render(dumps):
+    '''prometheus text of the dumps of all the processes'''
+    counters, histograms, gauges = {}, {}, {}
+    for dump in dumps:
+        for name, labels, value in dump['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, item in dump['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(item))
+            for index, value in enumerate(item):
+                total[index] += value
+        for name, value in dump.get('gauges', {}).items():
+            gauges[name] = gauges.get(name, 0) + value
+    lines = []
+    for name in sorted(METRICS):
+        kind, text, buckets = METRICS[name]
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'gauge' and name in gauges:
+            lines.append('{} {}'.format(name, gauges[name]))
+        for (key_name, labels), value in sorted(counters.items()):
+            if key_name == name:
+                lines.append(u'{} {}'.format(_series(name, labels), value))
+        for (key_name, labels), item in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bucket, value in zip(buckets, item):
+                cumulative += value
+                lines.append(u'{} {}'.format(_series(
+                    name + '_bucket', labels + (('le', bucket),)),
+                    cumulative))
+            lines.append(u'{} {}'.format(_series(
+                name + '_bucket', labels + (('le', '+Inf'),)), item[-1]))
+            lines.append(u'{} {}'.format(
+                _series(name + '_sum', labels), item[-2]))
+            lines.append(u'{} {}'.format(
+                _series(name + '_count', labels), item[-1]))
+    return u'\n'.join(lines) + u'\n'
+
+
+registry = Registry()
+
+
+@event.listens_for(Pool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    registry.inc('db_pool_checkouts_total')
+
+
+def _timed_get(pool):
+    '''time the waits of pool, the checkout event fires only after them'''
+    do_get = pool._do_get
+
+    def _do_get():
+        start = time.time()
+        try:
+            return do_get()
+        finally:
+            registry.observe('db_pool_wait_seconds', time.time() - start)
+    pool._do_get = _do_get
+    pool.metrics_timed = True
+
+
+class Metrics(object):
+    '''collect the metrics of app and serve them at /metrics'''
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+        self.pid = None
+        self.last_flush = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    @property
+    def folder(self):
+        return self.app.config.get('METRICS_FOLDER') or os.path.join(
+            self.app.config.get('UPLOAD_FOLDER') or '.', 'metrics')
+
+    @property
+    def enabled(self):
+        return self.app.config.get('METRICS', True)
+
+    @property
+    def key(self):
+        '''file name of this process'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._key = '{}_{}'.format(self.pid, uuid.uuid4().hex[:8])
+            registry.clear()
+        return self._key
+
+    def pool(self):
+        pool = self.db.engine.pool if self.db is not None else None
+        if pool is not None and not getattr(pool, 'metrics_timed', False):
+            _timed_get(pool)
+        return pool
+
+    def before_request(self):
+        if self.enabled:
+            # a worker forked from the loading process starts from zero
+            self.key
+            self.pool()
+            g.metrics_start = time.time()
+
+    def after_request(self, response):
+        start = getattr(g, 'metrics_start', None)
+        if start is None:
+            return response
+        g.metrics_start = None
+        endpoint = request.endpoint or 'none'
+        registry.inc('http_requests_total', endpoint=endpoint,
+                     method=request.method, status=response.status_code)
+        registry.observe('http_request_duration_seconds',
+                         time.time() - start, endpoint=endpoint)
+        stats = getattr(g, 'sql_stats', None)
+        if stats is not None:
+            registry.inc('sql_statements_total', stats.count,
+                         endpoint=endpoint)
+            registry.inc('sql_statement_seconds_total', stats.seconds,
+                         endpoint=endpoint)
+        if request.files and request.content_length:
+            registry.observe('operation_bytes', request.content_length,
+                             endpoint=endpoint, direction='upload')
+        disposition = response.headers.get('Content-Disposition', '')
+        if 'attachment' in disposition and \
+                response.content_length is not None:
+            registry.observe('operation_bytes', response.content_length,
+                             endpoint=endpoint, direction='export')
+        interval = self.app.config.get('METRICS_FLUSH_SECONDS', 10)
+        if time.time() - self.last_flush >= interval:
+            self.flush()
+        return response
+
+    def gauges(self):
+        pool = self.pool()
+        result = {}
+        if hasattr(pool, 'checkedout'):
+            result['db_pool_checked_out'] = pool.checkedout()
+        if hasattr(pool, 'overflow'):
+            result['db_pool_overflow'] = max(pool.overflow(), 0)
+        return result
+
+    def flush(self):
+        '''write the metrics of this process to its file'''
+        self.last_flush = time.time()
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = os.path.join(self.folder, '{}.json'.format(self.key))
+        dump = registry.dump()
+        dump['pid'] = os.getpid()
+        dump['gauges'] = self.gauges()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dump, f)
+        os.rename(path + '.tmp', path)
+
+    def collect(self):
+        '''dumps of every process'''
+        self.flush()
+        dumps = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name)) as f:
+                    dump = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if not _pid_alive(dump.get('pid', 0)):
+                dump['gauges'] = {}
+            dumps.append(dump)
+        return dumps
+
+    def view(self):
+        allowed = self.app.config.get('METRICS_ALLOWED', ('127.0.0.1',))
+        if request.remote_addr not in allowed:
+            abort(403)
+        return render(self.collect()), 200, {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -5,13 +5,21 @@ import calendar
 from datetime import timedelta
 from hashlib import md5
 from dateutil.relativedelta import relativedelta
-from flask import Flask, abort
-from sqlalchemy import or_, and_, false, exists, select, func
+from flask import Flask, abort, has_request_context
+from flask_login import current_user
+from sqlalchemy import (
+    or_, and_, false, exists, select, func, case, event, Index, literal,
+    union_all, inspect, Integer)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
-from flask_sqlalchemy import SQLAlchemy, Pagination
+from flask_sqlalchemy import Pagination
+from replica import RoutingSQLAlchemy
 
 app = Flask(__name__)
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 
 _IMPLEMENT_DATE = datetime.date(2011, 7, 1)
 _MIN_ENGAGE_IN_AGE = 16
@@ -151,6 +159,32 @@ class Address(db.Model):
     def __str__(self):
         return "{name}".decode('utf-8').format(name=self.name).encode('utf-8')
 
+    @staticmethod
+    def scope(address_id):
+        '''ids of address and all its descendants, by one query'''
+        if address_id is None:
+            return frozenset()
+        childs = {}
+        for id, parent_id in db.session.query(Address.id, Address.parent_id):
+            childs.setdefault(parent_id, []).append(id)
+        scope, stack = set(), [address_id]
+        while stack:
+            id = stack.pop()
+            if id not in scope:
+                scope.add(id)
+                stack.extend(childs.get(id, ()))
+        return frozenset(scope)
+
+    @staticmethod
+    def subtree(address_id):
+        '''select of the ids of address and all its descendants'''
+        table = Address.__table__
+        tree = select([table.c.id]).where(
+            table.c.id == address_id).cte('subtree', recursive=True)
+        tree = tree.union_all(select([table.c.id]).where(
+            table.c.parent_id == tree.c.id))
+        return select([tree.c.id])
+
     @property
     def descendants(self):
         descendants = []
@@ -337,7 +371,7 @@ class Person(db.Model):
     (NORMAL, DEAD_UNRETIRE, ABROT_UNRETIRE, NORMAL_RETIRE, ABORT_RETIRE,
      DEAD_RETIRE, SUSPEND_RETIRE, REG) = range(len(STATUS_CHOICES))
     _status = db.Column(
-        db.String, nullable=False)
+        db.SmallInteger, nullable=False, index=True)
     retire_day = db.Column(db.Date)
     dead_day = db.Column(db.Date)
     create_user_id = db.Column(
@@ -345,6 +379,9 @@ class Person(db.Model):
     create_by = db.relationship('User', backref='created_persons')
     create_time = db.Column(db.DateTime, nullable=False,
                             default=datetime.datetime.now)
+    __table_args__ = (
+        Index('ix_persons_address_id_status', 'address_id', '_status'),
+    )
 
     def __repr__(self):
         return "<Person(idcard='{idcard};,name='{name}',address_id={address},\
@@ -372,7 +409,7 @@ class Person(db.Model):
 
     @personal_wage.setter
     def personal_wage(self, val):
-        if self.status != self.__status_str(self.NORMAL_RETIRE):
+        if self._status != self.NORMAL_RETIRE:
             self._personal_wage = 0.0
         else:
             self._personal_wage = val
@@ -409,25 +446,25 @@ class Person(db.Model):
 
     @hybrid_method
     def __status_in(self, *args):
-        return self.status in (self.__status_str(i) for i in args)
+        return self._status in args
 
     @__status_in.expression
     def __status_in(cls, *args):
-        return cls._status.in_(map(lambda i: cls.__status_str(i), args))
+        return cls._status.in_(args)
 
     @hybrid_method
     def __status_is(self, index):
-        return self.status == self.__status_str(index)
+        return self._status == index
 
     @__status_is.expression
     def __status_is(cls, index):
-        return cls._status == cls.__status_str(index)
+        return cls._status == index
 
     def reg(self):
         if not self.can_reg:
             raise PersonStatusError(
                 unicode('status error, person already been registed'))
-        self._status = self.__status_str(self.REG)
+        self._status = self.REG
         return self
 
     def retire(self, retire_day):
@@ -439,14 +476,14 @@ class Person(db.Model):
         elif retire_day < self.earliest_retire_day:
             raise PersonAgeError('person is not reach retire day')
         self.retire_day = max(retire_day, self.earliest_retire_day)
-        self._status = self.__status_str(self.NORMAL_RETIRE)
+        self._status = self.NORMAL_RETIRE
         return self
 
     def dead(self, dead_day):
         if self.can_dead_unretire:
-            self._status = self.__status_str(self.DEAD_UNRETIRE)
+            self._status = self.DEAD_UNRETIRE
         elif self.can_dead_retire:
-            self._status = self.__status_str(self.DEAD_RETIRE)
+            self._status = self.DEAD_RETIRE
             self.standard_assoces = filter(  # remove invalid standard
                 lambda assoc: assoc.start_date <= dead_day,
                 self.standard_assoces)
@@ -459,9 +496,9 @@ class Person(db.Model):
 
     def abort(self, abort_date=None):
         if self.can_abort_normal:
-            self._status = self.__status_str(self.ABROT_UNRETIRE)
+            self._status = self.ABROT_UNRETIRE
         elif self.can_abort_retire:
-            self._status = self.__status_str(self.ABORT_RETIRE)
+            self._status = self.ABORT_RETIRE
             self.standard_assoces = filter(  # remove invalid standard
                 lambda assoc: assoc.start_date <= abort_date,
                 self.standard_assoces)
@@ -474,32 +511,87 @@ class Person(db.Model):
 
     def normal(self):
         if self.can_normal:
-            self._status = self.__status_str(self.NORMAL)
+            self._status = self.NORMAL
         else:
             raise PersonStatusError('Person can not be normal')
         return self
 
+    @classmethod
+    def batch_normal(cls, start_date=None, end_date=None, address_id=None):
+        '''
+        normal all registed persons born in [start_date, end_date] with one
+        update statement, keep the status counters in step. the persons
+        loaded in the session are expired to read the new status.
+        address_id: limit to persons in address and its descendants if not
+            None
+        return list of (id, address_id) of the normaled persons
+        '''
+        table = cls.__table__
+        condition = [cls.can_normal]
+        if start_date:
+            condition.append(table.c._birthday >= start_date)
+        if end_date:
+            condition.append(table.c._birthday <= end_date)
+        if address_id is not None:
+            condition.append(table.c.address_id.in_(
+                Address.subtree(address_id)))
+        stmt = table.update().where(and_(*condition)).values(
+            _status=cls.NORMAL)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            rows = connection.execute(stmt.returning(
+                table.c.id, table.c.address_id)).fetchall()
+        else:
+            rows = connection.execute(select(
+                [table.c.id, table.c.address_id]).where(
+                    and_(*condition))).fetchall()
+            connection.execute(stmt)
+        deltas = {}
+        for row in rows:
+            deltas[(row.address_id, cls.REG)] = deltas.get(
+                (row.address_id, cls.REG), 0) - 1
+            deltas[(row.address_id, cls.NORMAL)] = deltas.get(
+                (row.address_id, cls.NORMAL), 0) + 1
+        PersonStatusCounter.apply(connection, deltas)
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, cls):
+                db.session.expire(obj, ['_status'])
+        return rows
+
     def suspend(self):
         if not self.can_suspend:
-            self._status = self.__status_str(self.SUSPEND_RETIRE)
+            self._status = self.SUSPEND_RETIRE
         else:
             raise PersonStatusError('Person can not be suspend')
         return self
 
     def resume(self):
         if not self.can_resume:
-            self._status = self.__status_str(self.NORMAL_RETIRE)
+            self._status = self.NORMAL_RETIRE
         else:
             raise PersonStatusError('Person can not be resume')
         return self
 
     @hybrid_property
     def status(self):
-        return self._status
+        if self._status is None:
+            return None
+        return self.__status_str(self._status)
 
     @status.expression
     def status(cls):
-        return cls._status.label('status')
+        return case(
+            dict((i, choice[0]) for i, choice in enumerate(
+                cls.STATUS_CHOICES)),
+            value=cls._status).label('status')
+
+    @hybrid_property
+    def status_code(self):
+        return self._status
+
+    @status_code.expression
+    def status_code(cls):
+        return cls._status.label('status_code')
 
     @hybrid_property
     def can_reg(self):
@@ -571,7 +663,7 @@ class Person(db.Model):
 
     @property
     def is_valid_standard_wages(self):
-        if self.status != self.__status_str(self.NORMAL_RETIRE):
+        if self._status != self.NORMAL_RETIRE:
             return False
         for assoc in self.standard_assoces:
             if assoc.start_date < self.retire_day:
@@ -643,6 +735,187 @@ class PersonStatus(object):
     ''''''
 
 
+class PersonStatusCounter(db.Model):
+    '''
+    count of persons per (address, status).
+    kept in step with persons by the flush listeners below, bulk
+    query.update()/query.delete() must call apply() (or rebuild()) itself.
+    '''
+    __tablename__ = 'person_status_counters'
+    id = db.Column(db.Integer, primary_key=True)
+    address_id = db.Column(
+        db.Integer, db.ForeignKey('addresses.id', ondelete='CASCADE'),
+        nullable=False)
+    status = db.Column(db.SmallInteger, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('address_id', 'status'),
+    )
+
+    def __repr__(self):
+        return "<PersonStatusCounter(address_id={address},status={status},\
+        count={count})>".format(
+            address=self.address_id,
+            status=self.status,
+            count=self.count)
+
+    @classmethod
+    def apply(cls, connection, deltas):
+        '''
+        add deltas to counters.
+        deltas: dict of {(address_id, status): delta}
+        '''
+        table = cls.__table__
+        for (address_id, status), delta in deltas.items():
+            if not delta or address_id is None or status is None:
+                continue
+            if connection.dialect.name == 'postgresql':
+                insert = postgresql.insert(table).values(
+                    address_id=address_id, status=status, count=delta)
+                connection.execute(insert.on_conflict_do_update(
+                    index_elements=[table.c.address_id, table.c.status],
+                    set_=dict(count=table.c.count + delta)))
+            elif cls._add(connection, address_id, status, delta) == 0:
+                cls._insert(connection, address_id, status, delta)
+
+    @classmethod
+    def _add(cls, connection, address_id, status, delta):
+        '''add delta to the counter, return the rows changed'''
+        table = cls.__table__
+        return connection.execute(table.update().where(and_(
+            table.c.address_id == address_id,
+            table.c.status == status)).values(
+                count=table.c.count + delta)).rowcount
+
+    @classmethod
+    def _insert(cls, connection, address_id, status, delta):
+        '''
+        insert the counter, or add delta to it if a concurrent first write
+        inserted it after _add found nothing. sqlite and mysql only roll the
+        failed statement back, postgresql upserts instead.
+        '''
+        try:
+            connection.execute(cls.__table__.insert().values(
+                address_id=address_id, status=status, count=delta))
+        except IntegrityError:
+            cls._add(connection, address_id, status, delta)
+
+    @classmethod
+    def rebuild(cls):
+        '''recount all counters from persons, caller commit it'''
+        table = cls.__table__
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(
+            ['address_id', 'status', 'count'],
+            select([
+                Person.__table__.c.address_id,
+                Person.__table__.c._status,
+                func.count(Person.__table__.c.id)]).group_by(
+                    Person.__table__.c.address_id,
+                    Person.__table__.c._status)))
+
+    @classmethod
+    def total(cls, address, *statuses):
+        '''
+        count persons in address (an Address or its id) and its descendants
+        with statuses. the scope of the current user's address is the one
+        cached with the user.
+        '''
+        if address is None:
+            return 0
+        address_id = getattr(address, 'id', address)
+        if has_request_context() and getattr(
+                current_user, 'address_id', None) == address_id and \
+                getattr(current_user, 'address_ids', None):
+            address_ids = current_user.address_ids
+        else:
+            address_ids = Address.scope(address_id)
+        query = db.session.query(
+            func.coalesce(func.sum(cls.count), 0)).filter(
+                cls.address_id.in_(address_ids))
+        if statuses:
+            query = query.filter(cls.status.in_(statuses))
+        return query.scalar()
+
+
+def convert_person_status(engine=None):
+    '''
+    convert persons._status of a database made when it was the status
+    string to the SmallInteger index of STATUS_CHOICES, with its indexes.
+    return if it was converted, the caller then rebuilds the
+    PersonStatusCounters. raise ValueError on an unknown status.
+    '''
+    engine = engine or db.engine
+    columns = dict((column['name'], column) for column in inspect(
+        engine).get_columns(Person.__tablename__))
+    if '_status' not in columns or isinstance(
+            columns['_status']['type'], Integer):
+        return False
+    names = [name for name, label in Person.STATUS_CHOICES]
+    unknown = [status for status, in engine.execute(
+        'SELECT DISTINCT _status FROM persons') if status not in names]
+    if unknown:
+        raise ValueError('unknown person status {}'.format(
+            ','.join(map(repr, unknown))))
+    index = ' '.join("WHEN '{}' THEN {}".format(name, i)
+                     for i, name in enumerate(names))
+    with engine.begin() as connection:
+        connection.execute(
+            'ALTER TABLE persons ADD COLUMN _status_index SMALLINT')
+        connection.execute(
+            'UPDATE persons SET _status_index = CASE _status {} END'.format(
+                index))
+        connection.execute('ALTER TABLE persons DROP COLUMN _status')
+        connection.execute(
+            'ALTER TABLE persons RENAME COLUMN _status_index TO _status')
+        if engine.dialect.name == 'postgresql':
+            connection.execute(
+                'ALTER TABLE persons ALTER COLUMN _status SET NOT NULL')
+        for status_index in Person.__table__.indexes:
+            if '_status' in status_index.columns:
+                status_index.create(connection)
+    return True
+
+
+def _committed_value(obj, key):
+    history = get_history(obj, key)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return None
+
+
+@event.listens_for(Session, 'before_flush')
+def _remember_person_status(session, flush_context, instances):
+    olds = session.info['person_status_olds'] = {}
+    for person in filter(lambda obj: isinstance(obj, Person),
+                         list(session.dirty) + list(session.deleted)):
+        olds[person] = (_committed_value(person, 'address_id'),
+                        _committed_value(person, '_status'))
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_person_status(session, flush_context):
+    olds = session.info.pop('person_status_olds', {})
+    deltas = {}
+
+    def add(key, delta):
+        deltas[key] = deltas.get(key, 0) + delta
+    for person in filter(lambda obj: isinstance(obj, Person), session.new):
+        add((person.address_id, person._status), 1)
+    for person in filter(lambda obj: isinstance(obj, Person), session.dirty):
+        if person in olds:
+            add(olds[person], -1)
+            add((person.address_id, person._status), 1)
+    for person in filter(lambda obj: isinstance(obj, Person),
+                         session.deleted):
+        if person in olds:
+            add(olds[person], -1)
+    if filter(None, deltas.values()):
+        PersonStatusCounter.apply(session.connection(), deltas)
+
+
 class Standard(db.Model):
     __tablename__ = 'standards'
     id = db.Column(db.Integer, primary_key=True)
@@ -667,7 +940,8 @@ class Bankcard(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     no = db.Column(db.String(length=19), unique=True, nullable=False)
     name = db.Column(db.String, nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey('persons.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('persons.id'),
+                         index=True)
     owner = db.relationship('Person', backref=db.backref('bankcards',
                                                          order_by=id))
     create_user_id = db.Column(
@@ -882,6 +1156,142 @@ class PayBook(db.Model):
             PayBookItem.name.in_(item_names))) if item_names else false()
 
 
+class PeroidClosedError(RuntimeError):
+    '''paybooks of a closed peroid can't change'''
+
+
+class PeroidClose(db.Model):
+    '''
+    a closed peroid, its paybooks are summed up in paybook_summaries and
+    never change again.
+    '''
+    __tablename__ = 'peroid_closes'
+    id = db.Column(db.Integer, primary_key=True)
+    peroid = db.Column(db.Date, nullable=False, unique=True)
+    last_date = db.Column(db.Date, nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user = db.relationship('User', backref='peroid_closes')
+    close_time = db.Column(
+        db.DateTime, default=datetime.datetime.now, nullable=False)
+
+    def __repr__(self):
+        return "<PeroidClose(peroid={peroid})>".format(peroid=self.peroid)
+
+    @classmethod
+    def closed(cls, dates, session=None):
+        '''the first days of the closed peroids dates are in'''
+        dates = filter(None, dates)
+        if not dates:
+            return set()
+        query = (session or db.session).query(cls.peroid).filter(or_(*[
+            and_(cls.peroid <= day, cls.last_date >= day) for day in dates]))
+        return set(peroid for peroid, in query)
+
+    @classmethod
+    def close(cls, peroid, user):
+        '''sum up the paybooks of peroid and close it, caller commit it'''
+        first_date, last_date = PayBook._date_range(peroid)
+        today = datetime.date.today()
+        if first_date >= datetime.date(today.year, today.month, 1):
+            raise PeroidClosedError("can't close a peroid not ended")
+        if cls.closed([first_date]):
+            raise PeroidClosedError('peroid {} closed already'.format(
+                first_date.strftime('%Y%m')))
+        db.session.add(cls(peroid=first_date, last_date=last_date,
+                           user_id=user.id))
+        db.session.flush()
+        books = PayBook.__table__.c
+        db.session.execute(PayBookSummary.__table__.insert().from_select(
+            ['peroid', 'person_id', 'bankcard_id', 'item_id', 'money'],
+            select([
+                literal(first_date, db.Date), books.person_id,
+                books.bankcard_id, books.item_id,
+                func.sum(books.money)]).where(and_(
+                    books._peroid >= first_date,
+                    books._peroid <= last_date)).group_by(
+                        books.person_id, books.bankcard_id, books.item_id)))
+
+
+class PayBookSummary(db.Model):
+    '''total money of (person, bankcard, item) in a closed peroid'''
+    __tablename__ = 'paybook_summaries'
+    id = db.Column(db.Integer, primary_key=True)
+    peroid = db.Column(db.Date, nullable=False)
+    person_id = db.Column(db.Integer, db.ForeignKey('persons.id'),
+                          nullable=False, index=True)
+    bankcard_id = db.Column(db.Integer, db.ForeignKey('bankcards.id'))
+    item_id = db.Column(db.Integer, db.ForeignKey('paybookitems.id'),
+                        nullable=False)
+    money = db.Column(db.Numeric(precision=12, scale=2), nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('peroid', 'person_id', 'bankcard_id', 'item_id'),
+    )
+
+    def __repr__(self):
+        return "<PayBookSummary(peroid={peroid},person_id={person}," \
+            "bankcard_id={bankcard},item_id={item},money={money})>".format(
+                peroid=self.peroid,
+                person=self.person_id,
+                bankcard=self.bankcard_id,
+                item=self.item_id,
+                money=self.money)
+
+
+def ledger(mindate=None, maxdate=None):
+    '''
+    the rows to sum paybooks from: the summaries of the closed peroids and
+    the paybooks of the open ones, between mindate and maxdate.
+    columns: person_id, bankcard_id, item_id, peroid, money.
+    '''
+    books, summaries = PayBook.__table__.c, PayBookSummary.__table__.c
+    # the closed peroids are few and mostly in a row, so they are merged
+    # into date ranges instead of joined to every paybook
+    ranges = []
+    for first_date, last_date in db.session.query(
+            PeroidClose.peroid, PeroidClose.last_date).order_by(
+                PeroidClose.peroid):
+        if ranges and ranges[-1][1] + timedelta(days=1) == first_date:
+            ranges[-1][1] = last_date
+        else:
+            ranges.append([first_date, last_date])
+    live = select([
+        books.person_id, books.bankcard_id, books.item_id,
+        books._peroid.label('peroid'), books.money])
+    if any(mindate and maxdate and first_date <= mindate and
+           maxdate <= last_date for first_date, last_date in ranges):
+        live = live.where(false())
+    elif ranges:
+        live = live.where(~or_(*[
+            books._peroid.between(first_date, last_date)
+            for first_date, last_date in ranges]))
+    summed = select([
+        summaries.person_id, summaries.bankcard_id, summaries.item_id,
+        summaries.peroid, summaries.money])
+    if mindate:
+        live = live.where(books._peroid >= mindate)
+        summed = summed.where(summaries.peroid >= mindate)
+    if maxdate:
+        live = live.where(books._peroid <= maxdate)
+        summed = summed.where(summaries.peroid <= maxdate)
+    return union_all(live, summed).alias('ledger')
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_peroid_closed(session, flush_context, instances):
+    days = set()
+    for book in filter(lambda obj: isinstance(obj, PayBook),
+                       list(session.new) + list(session.dirty) +
+                       list(session.deleted)):
+        days.add(book._peroid)
+        days.update(get_history(book, '_peroid').deleted)
+    # a new paybook without peroid gets the current one, never closed
+    closed = PeroidClose.closed(days, session)
+    if closed:
+        raise PeroidClosedError('peroid {} closed'.format(','.join(
+            peroid.strftime('%Y%m') for peroid in sorted(closed))))
+
+
 class OperationLog(db.Model):
     __tablename__ = 'operation_logs'
     id = db.Column(db.Integer, primary_key=True)
@@ -910,6 +1320,105 @@ class OperationLog(db.Model):
             time=self.time).encode('utf-8')
 
 
+class Job(db.Model):
+    '''background job, see jobs.py'''
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String, nullable=False, default='queued',
+                       index=True)
+    params = db.Column(db.String)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user = db.relationship('User', backref='jobs')
+    worker = db.Column(db.String)
+    result = db.Column(db.String)
+    error = db.Column(db.String)
+    create_time = db.Column(
+        db.DateTime, default=datetime.datetime.now, nullable=False)
+    start_time = db.Column(db.DateTime)
+    # set by the worker while the job runs, see JobQueue.beat
+    heartbeat_time = db.Column(db.DateTime)
+    finish_time = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<Job(id={id},kind='{kind}',status='{status}')>".format(
+            id=self.id, kind=self.kind, status=self.status)
+
+
+class UploadLine(db.Model):
+    '''
+    md5 of an applied line of an uploaded file of kind (paybook, person).
+    the lines uploaded again are skipped, deleting the lines of a file_hash
+    lets that file be applied again.
+    '''
+    __tablename__ = 'upload_lines'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    hash = db.Column(db.String(32), nullable=False)
+    file_hash = db.Column(db.String(32), nullable=False, index=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), nullable=False)
+    create_time = db.Column(
+        db.DateTime, default=datetime.datetime.now, nullable=False)
+    __table_args__ = (db.UniqueConstraint('kind', 'hash'),)
+
+    def __repr__(self):
+        return "<UploadLine(kind='{kind}',hash='{hash}')>".format(
+            kind=self.kind, hash=self.hash)
+
+    @classmethod
+    def applied(cls, kind, hashes):
+        '''the hashes of kind applied already, by one query'''
+        if not hashes:
+            return set()
+        return set(hash for hash, in db.session.query(cls.hash).filter(
+            cls.kind == kind, cls.hash.in_(set(hashes))))
+
+
+class UploadFingerprint(object):
+    '''
+    md5 of an upload of kind and of its lines. the md5 of a line is of
+    salt (e.g. the peroid it is applied to), the line and how many times
+    it came before in the file, so a line repeated in a file is applied as
+    many times as it is in it.
+    '''
+
+    def __init__(self, kind, salt=''):
+        self.kind = kind
+        self.salt = salt
+        self.file = md5()
+        self.counts = {}
+        self.hashes = []
+
+    def line(self, line):
+        '''md5 of the next line of the file'''
+        self.file.update(line)
+        line = line.strip()
+        count = self.counts[line] = self.counts.get(line, 0) + 1
+        return md5('{}\0{}\0{}'.format(self.salt, count, line)).hexdigest()
+
+    def applied(self, hashes):
+        return UploadLine.applied(self.kind, hashes)
+
+    def add(self, hash):
+        '''the line of hash is applied'''
+        self.hashes.append(hash)
+
+    def save(self, user_id, batch_size=1000):
+        '''insert the lines applied, caller commit it'''
+        file_hash = self.file.hexdigest()
+        now = datetime.datetime.now()
+        rows = [dict(kind=self.kind, hash=hash, file_hash=file_hash,
+                     user_id=user_id, create_time=now)
+                for hash in self.hashes]
+        for i in range(0, len(rows), batch_size):
+            db.session.execute(
+                UploadLine.__table__.insert(), rows[i:i + batch_size])
+        self.hashes = []
+
+
 class Note(db.Model):
     __tablename__ = 'notes'
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,422 @@
+# coding=utf-8
+'''
+in process prefix index for the autocomplete of idcard, person name,
+bankcard no and bankcard name.
+every field keeps its keys utf-8 encoded in one string with offset, id and
+owner arrays, sorted and searched by bisect. rows put later go to a small
+sorted list and removed rows are only marked, both are merged into the
+arrays once they grow past MERGE_SIZE. the index is kept in step with the
+commits of this process, new rows of other processes are picked up by max
+id every REFRESH_SECONDS and the whole index is rebuilt every TTL_SECONDS.
+building takes a while for big tables, so it runs in a background thread
+and the suggestions come from the database until it is done.
+'''
+import time
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, insort
+from sqlalchemy import event, select, or_, false
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from models import app, db, Person, Bankcard
+from search_index import prefix_like
+
+_NO_OWNER = -1
+
+
+def _key(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+class _Keys(object):
+    '''sorted keys packed in one string, read by position'''
+
+    def __init__(self, keys=()):
+        parts, offsets = [], array('l', [0])
+        for key in keys:
+            parts.append(key)
+            offsets.append(offsets[-1] + len(key))
+        self.text = b''.join(parts)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+
+class PrefixIndex(object):
+    '''sorted keys with the row id and owner person id of every key'''
+
+    MERGE_SIZE = 4096
+    MAX_SCAN = 5000
+
+    def __init__(self, rows=()):
+        self._set_rows(sorted((_key(row[0]), row[1], row[2])
+                              for row in rows))
+
+    def _set_rows(self, rows):
+        self.keys = _Keys(row[0] for row in rows)
+        self.ids = array('l', (row[1] for row in rows))
+        self.owners = array('l', (row[2] for row in rows))
+        # positions of the removed rows of the arrays
+        self.removed = set()
+        # sorted [key, id, owner] of the rows put after the arrays were made
+        self.added = []
+
+    def _merge(self):
+        rows = [(self.keys[i], self.ids[i], self.owners[i])
+                for i in range(len(self.ids)) if i not in self.removed]
+        self._set_rows(list(heapq.merge(
+            rows, [tuple(row) for row in self.added])))
+
+    def __len__(self):
+        return len(self.ids) - len(self.removed) + len(self.added)
+
+    def _position(self, key, id):
+        i = bisect_left(self.keys, key)
+        while i < len(self.ids) and self.keys[i] == key:
+            if self.ids[i] == id:
+                return i
+            i += 1
+        return None
+
+    def _added_position(self, key, id):
+        i = bisect_left(self.added, [key, id])
+        if i < len(self.added) and self.added[i][:2] == [key, id]:
+            return i
+        return None
+
+    def put(self, key, id, owner):
+        '''add the row, or set its owner if the key of id is there'''
+        key = _key(key)
+        i = self._position(key, id)
+        if i is not None:
+            self.removed.discard(i)
+            self.owners[i] = owner
+            return
+        i = self._added_position(key, id)
+        if i is not None:
+            self.added[i][2] = owner
+            return
+        insort(self.added, [key, id, owner])
+        if len(self.added) > self.MERGE_SIZE:
+            self._merge()
+
+    def remove(self, key, id):
+        key = _key(key)
+        i = self._position(key, id)
+        if i is not None:
+            self.removed.add(i)
+            if len(self.removed) > self.MERGE_SIZE:
+                self._merge()
+            return
+        i = self._added_position(key, id)
+        if i is not None:
+            del self.added[i]
+
+    def _rows(self, prefix):
+        i = bisect_left(self.keys, prefix)
+        while i < len(self.ids):
+            key = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            if i not in self.removed:
+                yield key, self.ids[i], self.owners[i]
+            i += 1
+
+    def _added_rows(self, prefix):
+        i = bisect_left(self.added, [prefix])
+        while i < len(self.added) and self.added[i][0].startswith(prefix):
+            yield tuple(self.added[i])
+            i += 1
+
+    def search(self, prefix, accept, limit=10):
+        '''
+        (key, id) pairs which key starts with prefix, ordered by key and id.
+        accept: one arg fun of owner, return False to skip the row.
+        return None if MAX_SCAN rows are skipped before limit rows are
+        accepted, the database answers a narrow scope faster then.
+        '''
+        result, skipped = [], 0
+        prefix = _key(prefix)
+        for key, id, owner in heapq.merge(
+                self._rows(prefix), self._added_rows(prefix)):
+            if accept(owner):
+                result.append((key.decode('utf-8'), id))
+                if len(result) >= limit:
+                    break
+            else:
+                skipped += 1
+                if skipped >= self.MAX_SCAN:
+                    return None
+        return result
+
+
+class AutocompleteService(object):
+    '''the prefix indexes of person/bankcard fields of this process'''
+
+    FIELDS = ('idcard', 'name', 'bankcard_no', 'bankcard_name')
+    COLUMNS = {
+        'idcard': Person.idcard,
+        'name': Person.name,
+        'bankcard_no': Bankcard.no,
+        'bankcard_name': Bankcard.name,
+    }
+    REFRESH_SECONDS = 5
+    TTL_SECONDS = 600
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indexes = None
+        self.building = False
+        self.refreshing = threading.Lock()
+        self.built_time = 0
+        self.refresh_time = 0
+        self.max_person_id = 0
+        self.max_bankcard_id = 0
+        self.person_addresses = array('l')
+
+    @property
+    def built(self):
+        return self.indexes is not None
+
+    def _set_person_address(self, person_id, address_id):
+        if person_id >= len(self.person_addresses):
+            self.person_addresses.extend(array('l', [_NO_OWNER]) * (
+                person_id + 1 - len(self.person_addresses)))
+        self.person_addresses[person_id] = address_id
+
+    def _load(self, min_person_id=0, min_bankcard_id=0):
+        persons = db.session.execute(select([
+            Person.__table__.c.id,
+            Person.__table__.c.idcard,
+            Person.__table__.c.name,
+            Person.__table__.c.address_id]).where(
+                Person.__table__.c.id > min_person_id)).fetchall()
+        bankcards = db.session.execute(select([
+            Bankcard.__table__.c.id,
+            Bankcard.__table__.c.no,
+            Bankcard.__table__.c.name,
+            Bankcard.__table__.c.owner_id]).where(
+                Bankcard.__table__.c.id > min_bankcard_id)).fetchall()
+        return persons, bankcards
+
+    def build(self):
+        persons, bankcards = self._load()
+        person_addresses = array('l', [_NO_OWNER]) * (
+            max([p.id for p in persons] or [0]) + 1)
+        for person in persons:
+            person_addresses[person.id] = person.address_id
+        indexes = {
+            'idcard': PrefixIndex((p.idcard, p.id, p.id) for p in persons),
+            'name': PrefixIndex((p.name, p.id, p.id) for p in persons),
+            'bankcard_no': PrefixIndex(
+                (b.no, b.id, b.owner_id or _NO_OWNER) for b in bankcards),
+            'bankcard_name': PrefixIndex(
+                (b.name, b.id, b.owner_id or _NO_OWNER) for b in bankcards),
+        }
+        with self.lock:
+            self.person_addresses = person_addresses
+            self.max_person_id = len(person_addresses) - 1
+            self.max_bankcard_id = max([b.id for b in bankcards] or [0])
+            self.built_time = self.refresh_time = time.time()
+            self.indexes = indexes
+
+    def refresh(self):
+        '''
+        load rows inserted by other processes. one thread refreshes at a
+        time, the others go on with the index as it is. a row committed by
+        this process meanwhile is there already, put() only updates it.
+        '''
+        if not self.refreshing.acquire(False):
+            return
+        try:
+            with self.lock:
+                min_person_id = self.max_person_id
+                min_bankcard_id = self.max_bankcard_id
+                indexes = self.indexes
+            persons, bankcards = self._load(min_person_id, min_bankcard_id)
+            with self.lock:
+                # a build swapped in while loading has these rows already
+                if self.indexes is indexes:
+                    for person in persons:
+                        self.put_person(person.id, person.idcard,
+                                        person.name, person.address_id)
+                    for bankcard in bankcards:
+                        self.put_bankcard(bankcard.id, bankcard.no,
+                                          bankcard.name, bankcard.owner_id)
+                self.refresh_time = time.time()
+        finally:
+            self.refreshing.release()
+
+    def build_async(self):
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.build()
+                    db.session.remove()
+            finally:
+                with self.lock:
+                    self.building = False
+        thread = threading.Thread(target=run, name='autocomplete-build')
+        thread.daemon = True
+        thread.start()
+
+    def ensure(self):
+        '''return True if the index can answer suggestions now'''
+        now = time.time()
+        if not self.built:
+            self.build_async()
+            return False
+        if now - self.built_time > self.TTL_SECONDS:
+            self.build_async()
+        elif now - self.refresh_time > self.REFRESH_SECONDS:
+            self.refresh()
+        return True
+
+    def put_person(self, id, idcard, name, address_id):
+        self.indexes['idcard'].put(idcard, id, id)
+        self.indexes['name'].put(name, id, id)
+        self._set_person_address(id, address_id)
+        self.max_person_id = max(self.max_person_id, id)
+
+    def put_bankcard(self, id, no, name, owner_id):
+        owner = owner_id or _NO_OWNER
+        self.indexes['bankcard_no'].put(no, id, owner)
+        self.indexes['bankcard_name'].put(name, id, owner)
+        self.max_bankcard_id = max(self.max_bankcard_id, id)
+
+    def apply(self, changes):
+        '''
+        apply committed changes to the indexes.
+        changes: list of (model, id, old values, new values), values is
+            None for inserted(old)/deleted(new) rows.
+        '''
+        with self.lock:
+            if not self.built:
+                return
+            for model, id, old, new in changes:
+                if model is Person:
+                    if old is not None:
+                        self.indexes['idcard'].remove(old['idcard'], id)
+                        self.indexes['name'].remove(old['name'], id)
+                    if new is not None:
+                        self.put_person(id, new['idcard'], new['name'],
+                                        new['address_id'])
+                    else:
+                        self._set_person_address(id, _NO_OWNER)
+                else:
+                    if old is not None:
+                        self.indexes['bankcard_no'].remove(old['no'], id)
+                        self.indexes['bankcard_name'].remove(old['name'], id)
+                    if new is not None:
+                        self.put_bankcard(id, new['no'], new['name'],
+                                          new['owner_id'])
+
+    def suggest(self, field, prefix, address_ids, limit=10):
+        '''
+        (value, id) pairs of field starts with prefix, limited to the
+        persons in address_ids and the unbinded bankcards. a prefix too
+        common for the scope is answered by the database.
+        '''
+        if not self.ensure():
+            return self._query(field, prefix, address_ids, limit)
+        person_addresses = self.person_addresses
+
+        def accept(owner):
+            return owner == _NO_OWNER or (
+                owner < len(person_addresses) and
+                person_addresses[owner] in address_ids)
+        with self.lock:
+            items = self.indexes[field].search(prefix, accept, limit)
+        if items is None:
+            items = self._query(field, prefix, address_ids, limit)
+        return items
+
+    def _query(self, field, prefix, address_ids, limit):
+        '''the same suggestions as suggest() from the database'''
+        column = self.COLUMNS[field]
+        in_scope = Person.address_id.in_(address_ids)\
+            if address_ids else false()
+        if column.class_ is Person:
+            model, condition = Person, in_scope
+        else:
+            model, condition = Bankcard, or_(
+                Bankcard.owner_id.is_(None),
+                Bankcard.owner_id.in_(select([Person.id]).where(in_scope)))
+        return db.session.query(column, model.id).filter(
+            prefix_like(column, prefix), condition).order_by(
+                column, model.id).limit(limit).all()
+
+
+autocomplete = AutocompleteService()
+
+_TRACKED = {
+    Person: ('idcard', 'name', 'address_id'),
+    Bankcard: ('no', 'name', 'owner_id'),
+}
+
+
+def _committed_values(obj, keys):
+    values = {}
+    for key in keys:
+        history = get_history(obj, key)
+        if history.deleted:
+            values[key] = history.deleted[0]
+        elif history.unchanged:
+            values[key] = history.unchanged[0]
+        else:
+            values[key] = None
+    return values
+
+
+@event.listens_for(Session, 'before_flush')
+def _remember_indexed_values(session, flush_context, instances):
+    if not autocomplete.built:
+        return
+    olds = session.info['prefix_index_olds'] = {}
+    for obj in list(session.dirty) + list(session.deleted):
+        keys = _TRACKED.get(type(obj))
+        if keys:
+            olds[obj] = _committed_values(obj, keys)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_indexed_changes(session, flush_context):
+    if not autocomplete.built:
+        return
+    olds = session.info.pop('prefix_index_olds', {})
+    changes = session.info.setdefault('prefix_index_changes', [])
+    for obj in session.new:
+        keys = _TRACKED.get(type(obj))
+        if keys:
+            changes.append((type(obj), obj.id, None, dict(
+                (key, getattr(obj, key)) for key in keys)))
+    for obj in session.dirty:
+        if obj in olds:
+            new = dict((key, getattr(obj, key)) for key in olds[obj])
+            if new != olds[obj]:
+                changes.append((type(obj), obj.id, olds[obj], new))
+    for obj in session.deleted:
+        if obj in olds:
+            changes.append((type(obj), obj.id, olds[obj], None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_indexed_changes(session):
+    changes = session.info.pop('prefix_index_changes', None)
+    if changes:
+        autocomplete.apply(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_indexed_changes(session, previous_transaction):
+    session.info.pop('prefix_index_changes', None)
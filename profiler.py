@@ -0,0 +1,138 @@
+# coding=utf-8
+'''
+on demand cProfile of single requests.
+a request is profiled when its endpoint is one of the profiled endpoints,
+its user one of the profiled users, or by chance of the profiled fraction.
+the settings start from config PROFILE_ENDPOINTS, PROFILE_USERS (user ids)
+and PROFILE_FRACTION; /admin/profile saves new ones to settings.json of the
+profile folder, so every process of the server uses them.
+every capture is a pstats file in PROFILE_FOLDER (default
+UPLOAD_FOLDER/profiles), only the newest PROFILE_KEEP (default 100) are
+kept.
+'''
+import os
+import re
+import io
+import json
+import time
+import random
+import pstats
+import cProfile
+from collections import namedtuple
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+
+Capture = namedtuple('Capture', 'name,time,endpoint,user,ms')
+
+_CAPTURE_NAME = re.compile(
+    r'^(\d{8}-\d{6}-\d{6})_([\w.]+)_(\w+)_(\d+)ms\.prof$')
+
+
+class RequestProfiler(object):
+    '''profile the chosen requests of app'''
+
+    def __init__(self, app=None):
+        self._settings = None
+        self._settings_mtime = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    @property
+    def folder(self):
+        return self.app.config.get('PROFILE_FOLDER') or os.path.join(
+            self.app.config.get('UPLOAD_FOLDER') or '.', 'profiles')
+
+    @property
+    def settings_file(self):
+        return os.path.join(self.folder, 'settings.json')
+
+    @property
+    def settings(self):
+        '''dict of endpoints, users and fraction'''
+        try:
+            mtime = os.path.getmtime(self.settings_file)
+        except OSError:
+            config = self.app.config
+            return dict(
+                endpoints=list(config.get('PROFILE_ENDPOINTS', [])),
+                users=list(config.get('PROFILE_USERS', [])),
+                fraction=config.get('PROFILE_FRACTION', 0.0))
+        if mtime != self._settings_mtime:
+            with open(self.settings_file) as f:
+                self._settings = json.load(f)
+            self._settings_mtime = mtime
+        return self._settings
+
+    def save_settings(self, endpoints, users, fraction):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        tmp = '{}.{}'.format(self.settings_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(dict(endpoints=endpoints, users=users,
+                           fraction=fraction), f)
+        os.rename(tmp, self.settings_file)
+
+    def wanted(self):
+        settings = self.settings
+        if request.endpoint in settings['endpoints']:
+            return True
+        if settings['users'] and \
+                getattr(current_user, 'id', None) in settings['users']:
+            return True
+        return random.random() < settings['fraction']
+
+    def before_request(self):
+        if self.wanted():
+            g.profile_start = time.time()
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def teardown_request(self, exc=None):
+        # teardown runs when the request raises too, after_request does not
+        # and would leave the profiler enabled on the thread
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        g.profile = None
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        name = '{}_{}_{}_{}ms.prof'.format(
+            datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+            request.endpoint or 'none',
+            getattr(current_user, 'id', None) or 'anonymous',
+            int((time.time() - g.profile_start) * 1000))
+        profile.dump_stats(os.path.join(self.folder, name))
+        for capture in self.captures()[
+                self.app.config.get('PROFILE_KEEP', 100):]:
+            os.remove(os.path.join(self.folder, capture.name))
+
+    def captures(self):
+        '''Capture of every profile file, newest first'''
+        if not os.path.isdir(self.folder):
+            return []
+        result = []
+        for name in os.listdir(self.folder):
+            match = _CAPTURE_NAME.match(name)
+            if match:
+                result.append(Capture(
+                    name,
+                    datetime.strptime(match.group(1), '%Y%m%d-%H%M%S-%f'),
+                    match.group(2), match.group(3), int(match.group(4))))
+        return sorted(result, key=lambda capture: capture.name, reverse=True)
+
+    def report(self, name, sort='cumulative', limit=40):
+        '''pstats text of capture name, None if there is no such capture'''
+        # pstats writes the path to a byte stream
+        path = str(os.path.join(self.folder, name))
+        if not _CAPTURE_NAME.match(name) or not os.path.isfile(path):
+            return None
+        stream = io.BytesIO()
+        pstats.Stats(path, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
@@ -0,0 +1,81 @@
+# coding=utf-8
+'''
+read/write routing with a read only reporting replica.
+the replica is the REPLICA_BIND (default 'replica') key of SQLALCHEMY_BINDS,
+e.g.
+    SQLALCHEMY_BINDS = {'replica': 'postgresql://reader@replica/test'}
+the reads of the GET requests of REPLICA_ENDPOINTS go to it, everything
+else and every flush go to SQLALCHEMY_DATABASE_URI.
+the replica lags behind, so a client that committed a write in the last
+REPLICA_STALENESS_SECONDS (default 5) reads from the primary, the time of
+its last write is kept in its session.
+'''
+import time
+from flask import request, session as client_session, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+
+# not paybook_bankgrant: its zips are cached by the primary's versions
+REPLICA_ENDPOINTS = frozenset((
+    'paybook_public_report', 'paybook_search', 'paybook_sys_search',
+    'admin_log_search'))
+
+
+def use_replica(app):
+    '''should the reads of the current request go to the replica'''
+    config = app.config
+    if not has_request_context() or request.method != 'GET':
+        return False
+    if config.get('REPLICA_BIND', 'replica') not in (
+            config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    if request.endpoint not in config.get(
+            'REPLICA_ENDPOINTS', REPLICA_ENDPOINTS):
+        return False
+    last_write = client_session.get('last_write', 0)
+    return time.time() - last_write >= config.get(
+        'REPLICA_STALENESS_SECONDS', 5)
+
+
+class RoutingSession(SignallingSession):
+    '''SignallingSession sending the reads of the reports to the replica'''
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.info.get('replica_wrote') and \
+                use_replica(self.app):
+            return get_state(self.app).db.get_engine(
+                self.app, bind=self.app.config.get('REPLICA_BIND', 'replica'))
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+
+def mark_write(session):
+    '''the session wrote, e.g. by core inserts the flush events miss'''
+    session.info['replica_wrote'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_write(session, flush_context):
+    mark_write(session)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _mark_bulk_write(context):
+    mark_write(context.session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _remember_write(session):
+    if session.info.pop('replica_wrote', False) and has_request_context():
+        client_session['last_write'] = time.time()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_write(session, previous_transaction):
+    session.info.pop('replica_wrote', None)
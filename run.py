@@ -1,7 +1,14 @@
 # coding=utf-8
 import os
-from models import User, Role
+import sys
+import argparse
+from multiprocessing import Process
+from models import User, Role, PersonStatusCounter, convert_person_status
 from controller import app, db
+from search_index import create_search_indexes
+from jobs import job_queue
+from ledger_check import LedgerChecker, format_report, CHUNK_SIZE
+from ledger_columns import ledger_columns
 
 
 def init():
@@ -11,6 +18,10 @@ def init():
         'config.cfg')
     app.config.from_pyfile(config_file, silent=True)
     db.create_all()
+    if convert_person_status():
+        PersonStatusCounter.rebuild()
+        db.session.commit()
+    create_search_indexes()
     try:
         user = User.query.filter(
             User.name == 'admin').one()
@@ -29,6 +40,55 @@ def init():
         user.roles.append(role)
         db.session.commit()
 
+
+def work(processes, poll):
+    '''run processes job workers until they are killed'''
+    workers = [Process(target=job_queue.work, args=(poll,))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def check(threads, chunk_size, peroid):
+    '''check the ledger balances, exit 1 if it does not'''
+    report = LedgerChecker(db.engine, threads, chunk_size, peroid).run()
+    for line in format_report(report):
+        print line
+    if report['writes'] or report['persons'] or report['peroids']:
+        sys.exit(1)
+
+
+def snapshot():
+    '''write the snapshot of the columnar ledger'''
+    ledger_columns.get()
+    ledger_columns.save()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the server or workers')
+    parser.add_argument('command', nargs='?', default='server',
+                        choices=('server', 'worker', 'check', 'snapshot'))
+    parser.add_argument('--processes', dest='processes', type=int,
+                        default=1,
+                        help='number of job worker processes')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                        help='number of check threads, one connection each')
+    parser.add_argument('--poll', dest='poll', type=float, default=1.0,
+                        help='seconds between looks for queued jobs')
+    parser.add_argument('--chunk', dest='chunk', type=int,
+                        default=CHUNK_SIZE, help='paybooks a check chunk')
+    parser.add_argument('--peroid', dest='peroid',
+                        help='check only the peroid, like 201501')
+    args = parser.parse_args()
     init()
-    app.run()
+    if args.command == 'worker':
+        # the forked workers must not share the connections of init
+        db.engine.dispose()
+        work(args.processes, args.poll)
+    elif args.command == 'check':
+        check(args.threads, args.chunk, args.peroid)
+    elif args.command == 'snapshot':
+        snapshot()
+    else:
+        app.run()
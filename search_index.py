@@ -0,0 +1,104 @@
+# coding=utf-8
+'''
+prefix search support for the *_search views.
+every search box is matched as "starts with", so each searched column gets
+an index the backend can use for it:
+    postgresql: btree with text_pattern_ops, LIKE 'x%' works under any
+        collation.
+    sqlite: btree under COLLATE NOCASE, searched as a range of the same
+        collation, so it stays as case insensitive (for ascii) as LIKE.
+        sqlite only applies its LIKE optimization to literals (python2's
+        sqlite3 prepares with the legacy api), bound parameters always scan.
+'''
+import sys
+from sqlalchemy import inspect, select, and_, true
+from models import db, Person, Bankcard, Address, User, Role, PayBookItem
+
+SEARCH_COLUMNS = (
+    Person.__table__.c.idcard,
+    Person.__table__.c.name,
+    Bankcard.__table__.c.no,
+    Bankcard.__table__.c.name,
+    Address.__table__.c.name,
+    User.__table__.c.name,
+    Role.__table__.c.name,
+    PayBookItem.__table__.c.name,
+)
+
+_INDEX_TEMPLATES = {
+    'postgresql': 'CREATE INDEX {name} ON {table} ({column} text_pattern_ops)',
+    'sqlite': 'CREATE INDEX {name} ON {table} ({column} COLLATE NOCASE)',
+}
+
+
+def index_name(column):
+    return 'ix_{}_{}_prefix'.format(column.table.name, column.name)
+
+
+def create_search_indexes(engine=None):
+    '''
+    create the missing prefix indexes of SEARCH_COLUMNS.
+    return the names of created indexes, empty for unsupported backends.
+    '''
+    engine = engine or db.engine
+    template = _INDEX_TEMPLATES.get(engine.dialect.name)
+    if template is None:
+        return []
+    inspector = inspect(engine)
+    created = []
+    for column in SEARCH_COLUMNS:
+        name = index_name(column)
+        exists_names = map(
+            lambda index: index['name'],
+            inspector.get_indexes(column.table.name))
+        if name in exists_names:
+            continue
+        engine.execute(template.format(
+            name=name, table=column.table.name, column=column.name))
+        created.append(name)
+    return created
+
+
+def drop_search_indexes(engine=None):
+    engine = engine or db.engine
+    if engine.dialect.name not in _INDEX_TEMPLATES:
+        return
+    for column in SEARCH_COLUMNS:
+        engine.execute('DROP INDEX IF EXISTS {}'.format(index_name(column)))
+
+
+def prefix_like(column, prefix):
+    '''
+    "column starts with prefix" condition.
+    like wildcards typed in prefix are matched literally, an empty prefix
+    matches every row.
+    '''
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf-8')
+    if not prefix:
+        return true()
+    if '%' in prefix or '_' in prefix or '\\' in prefix:
+        pattern = prefix.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        condition = column.like(
+            '{}%'.decode('utf-8').format(pattern), escape='\\')
+    else:
+        condition = column.like('{}%'.decode('utf-8').format(prefix))
+    # NOCASE folds only A-Z, the bounds are folded the same way
+    lower = u''.join(c.lower() if u'A' <= c <= u'Z' else c for c in prefix)
+    last = ord(lower[-1])
+    if db.engine.dialect.name == 'sqlite' and last < sys.maxunicode:
+        upper = lower[:-1] + unichr(last + 1)
+        nocase = column.collate('NOCASE')
+        condition = and_(nocase >= lower, nocase < upper, condition)
+    return condition
+
+
+def person_ids_like(column, prefix):
+    '''id subquery of persons whose column starts with prefix'''
+    return select([Person.id]).where(prefix_like(column, prefix))
+
+
+def address_ids_like(prefix):
+    '''id subquery of addresses whose name starts with prefix'''
+    return select([Address.id]).where(prefix_like(Address.name, prefix))
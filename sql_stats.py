@@ -0,0 +1,141 @@
+# coding=utf-8
+'''
+per request sql statistics.
+every statement executed while handling a request is counted, timed and
+grouped by its normalized sql. the totals go to the response headers
+X-SQL-Count, X-SQL-Time-Ms and X-SQL-Repeated and to one json log line of
+the 'sql_stats' logger.
+config:
+    SQL_STATS: False to turn it off, default True.
+    SQL_STATS_REPEAT: a statement run this many times in one request is
+        reported as repeated (the n+1 pattern), default 5.
+    SQL_QUERY_BUDGET: max statements of any endpoint, default no limit.
+    SQL_QUERY_BUDGETS: dict of endpoint: max statements.
+    SQL_QUERY_BUDGET_FAIL: raise QueryBudgetExceeded when a request goes
+        over its budget, for the tests.
+'''
+import re
+import json
+import time
+import logging
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('sql_stats')
+logger.addHandler(logging.NullHandler())
+
+_SPACES = re.compile(r'\s+')
+_PLACEHOLDER = r'\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*'
+_IN_LIST = re.compile(r'\((?:{0},)+{0}\)'.format(_PLACEHOLDER))
+
+
+def normalize(statement):
+    '''sql without layout, IN lists of any length are the same'''
+    return _IN_LIST.sub('(?)', _SPACES.sub(' ', statement).strip())
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class RequestStats(object):
+    '''statements of one request'''
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # normalized sql: [times, seconds]
+        self.statements = {}
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        item = self.statements.setdefault(normalize(statement), [0, 0.0])
+        item[0] += 1
+        item[1] += seconds
+
+    def repeated(self, threshold):
+        '''(sql, times, seconds) run threshold or more times, most first'''
+        return sorted(
+            ((sql, times, seconds)
+             for sql, (times, seconds) in self.statements.items()
+             if times >= threshold),
+            key=lambda item: -item[1])
+
+
+def _current_stats():
+    if has_request_context():
+        return getattr(g, 'sql_stats', None)
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # on the context of the statement, a statement raising leaves nothing
+    # behind on the pooled connection
+    if context is not None:
+        context.sql_stats_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, 'sql_stats_start', None)
+    stats = _current_stats()
+    if start is not None and stats is not None:
+        stats.record(statement, time.time() - start)
+
+
+class SqlStats(object):
+    '''collect RequestStats of every request of app'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        if self.app.config.get('SQL_STATS', True):
+            g.sql_stats = RequestStats()
+
+    def budget(self, endpoint):
+        return self.app.config.get('SQL_QUERY_BUDGETS', {}).get(
+            endpoint, self.app.config.get('SQL_QUERY_BUDGET'))
+
+    def after_request(self, response):
+        stats = getattr(g, 'sql_stats', None)
+        if stats is None:
+            return response
+        g.sql_stats = None
+        config = self.app.config
+        repeated = stats.repeated(config.get('SQL_STATS_REPEAT', 5))
+        response.headers['X-SQL-Count'] = str(stats.count)
+        response.headers['X-SQL-Time-Ms'] = '{:.1f}'.format(
+            stats.seconds * 1000)
+        response.headers['X-SQL-Repeated'] = str(len(repeated))
+        budget = self.budget(request.endpoint)
+        over_budget = budget is not None and stats.count > budget
+        logger.log(
+            logging.WARNING if repeated or over_budget else logging.INFO,
+            json.dumps(dict(
+                endpoint=request.endpoint,
+                method=request.method,
+                path=request.path,
+                status=response.status_code,
+                count=stats.count,
+                ms=round(stats.seconds * 1000, 1),
+                budget=budget,
+                repeated=[dict(sql=sql[:200], times=times,
+                               ms=round(seconds * 1000, 1))
+                          for sql, times, seconds in repeated])))
+        if over_budget and config.get('SQL_QUERY_BUDGET_FAIL'):
+            raise QueryBudgetExceeded(
+                '{} ran {} statements, budget is {}'.format(
+                    request.endpoint, stats.count, budget))
+        return response
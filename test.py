@@ -1,17 +1,24 @@
 import os
 import io
+import sys
+import json
+from decimal import Decimal
 from datetime import date, datetime, timedelta
 from uuid import uuid4
+import shutil
 import tempfile
 import unittest
 from werkzeug import MultiDict
 from flask_testing import TestCase
 from flask import url_for
+from sqlalchemy import create_engine
 from sqlalchemy.orm.exc import NoResultFound
 from wtforms_alchemy import ModelForm
 from models import (User, Role, Address, Person, Standard, Bankcard,
-                    Note, PayBookItem, PayBook, OperationLog)
-from forms import LoginForm, AdminAddRoleForm, PersonForm
+                    Note, PayBookItem, PayBook, OperationLog,
+                    PersonStatusCounter, PeroidClose, PeroidClosedError,
+                    PayBookSummary, UploadLine, convert_person_status)
+from forms import LoginForm, AdminAddRoleForm, PersonForm, AddressForm
 
 
 class Utils(object):
@@ -150,6 +157,26 @@ class TestBase(TestCase):
 
 class UserTestCase(TestBase):
 
+    def setUp(self):
+        from metrics import registry
+        TestBase.setUp(self)
+        # the registry is global to the process and the other tests add to
+        # it too, so the metric tests assert on the change from here
+        self.counters = dict(registry.counters)
+        self.histograms = dict(
+            (key, list(item)) for key, item in registry.histograms.items())
+
+    def _counter_delta(self, name, **labels):
+        from metrics import registry
+        key = (name, tuple(sorted(labels.items())))
+        return registry.counters.get(key, 0) - self.counters.get(key, 0)
+
+    def _observed_delta(self, name, **labels):
+        from metrics import registry
+        key = (name, tuple(sorted(labels.items())))
+        return registry.histograms.get(key, [0])[-1] - \
+            self.histograms.get(key, [0])[-1]
+
     def testLoginGet(self):
         rv = self.client.get('/login')
         assert '<input' in rv.data
@@ -186,6 +213,122 @@ class UserTestCase(TestBase):
         self.client.get('/logout')
         self.assert_not_authorized()
 
+    def testCachedIdentity(self):
+        from user_cache import user_cache
+        user = self._get_or_create(
+            User, 'name', 'test', name='test', password='test')
+        user.roles = []
+        self.session.commit()
+        self.client.post('/login', data=dict(name='test', password='test'))
+        self.assert_authorized()
+        snapshot = user_cache.get(user.id)
+        self.assertIs(snapshot, user_cache.get(user.id))
+        self.assertEqual(frozenset(), snapshot.role_names)
+        rv = self.client.get(url_for(
+            'admin_user_search', page=1, per_page=10))
+        self.assert403(rv)
+        user.roles.append(Role.query.filter(Role.name == 'admin').one())
+        self.session.commit()
+        self.assertIn('admin', user_cache.get(user.id).role_names)
+        rv = self.client.get(url_for(
+            'admin_user_search', page=1, per_page=10))
+        self.assert200(rv)
+        user.roles = []
+        self.session.commit()
+        User.query.filter(User.id != self.admin.id).delete()
+        self.session.commit()
+        self.assertIsNone(user_cache.get(user.id))
+
+    def testSqlStatsLogger(self):
+        import logging
+        from sql_stats import logger
+        # python 2 prints "No handlers could be found" once otherwise
+        self.assertTrue(any(isinstance(handler, logging.NullHandler)
+                            for handler in logger.handlers))
+
+    def testBenchCompare(self):
+        from bench_endpoints import compare
+        base = dict(seconds=1.0, queries=10, status=200)
+        baseline = dict(ok=base, slow=base, failed=base, changed=dict(
+            base, status=302), error=dict(base, status=500))
+        results = dict(
+            ok=dict(base, seconds=1.1), slow=dict(base, seconds=2.0),
+            failed=dict(base, status=500), changed=base,
+            error=dict(base, status=500))
+        self.assertEqual(['changed', 'error', 'failed', 'slow'],
+                         sorted(compare(results, baseline, 0.2)))
+
+    def testSqlStats(self):
+        from sql_stats import RequestStats, QueryBudgetExceeded
+        stats = RequestStats()
+        for id in range(6):
+            stats.record('SELECT * FROM bankcards\n WHERE id = ?', 0.001)
+        stats.record('SELECT * FROM persons WHERE id IN (?, ?)', 0.001)
+        stats.record('SELECT * FROM persons WHERE id IN (?)', 0.001)
+        self.assertEqual(8, stats.count)
+        self.assertEqual(2, len(stats.statements))
+        self.assertEqual(
+            ['SELECT * FROM bankcards WHERE id = ?'],
+            map(lambda item: item[0], stats.repeated(5)))
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        url = url_for('admin_user_search', page=1, per_page=10)
+        rv = self.client.get(url)
+        self.assertGreater(int(rv.headers['X-SQL-Count']), 0)
+        self.assertIn('X-SQL-Time-Ms', rv.headers)
+        self.app.config.update(
+            SQL_QUERY_BUDGETS={'admin_user_search': 0},
+            SQL_QUERY_BUDGET_FAIL=True)
+        try:
+            self.assertRaises(QueryBudgetExceeded, self.client.get, url)
+        finally:
+            self.app.config.update(
+                SQL_QUERY_BUDGETS={}, SQL_QUERY_BUDGET_FAIL=False)
+        from flask import g
+        from sqlalchemy.exc import OperationalError
+        with self.app.test_request_context():
+            g.sql_stats = stats = RequestStats()
+            self.assertRaises(OperationalError, self.db.session.execute,
+                              'SELECT * FROM no_such_table')
+            self.db.session.rollback()
+            self.db.session.execute('SELECT 1')
+            self.assertEqual(['SELECT 1'], stats.statements.keys())
+            self.assertNotIn('sql_stats_start',
+                             self.db.session.connection().info)
+            self.db.session.rollback()
+
+    def testMetrics(self):
+        folder = tempfile.mkdtemp()
+        self.app.config['METRICS_FOLDER'] = folder
+        try:
+            self.client.post(
+                '/login', data=dict(name='admin', password='admin'))
+            self.client.get(url_for('admin_user_search', page=1,
+                                    per_page=10))
+            self.assertEqual(1, self._counter_delta(
+                'http_requests_total', endpoint='admin_user_search',
+                method='GET', status=200))
+            self.assertEqual(1, self._observed_delta(
+                'http_request_duration_seconds',
+                endpoint='admin_user_search'))
+            self.assertLess(0, self._counter_delta(
+                'sql_statements_total', endpoint='admin_user_search'))
+            rv = self.client.get('/metrics')
+            self.assertIn('text/plain', rv.headers['Content-Type'])
+            self.assertIn('# TYPE http_request_duration_seconds histogram',
+                          rv.data)
+            self.assertIn('http_requests_total{endpoint="admin_user_search"'
+                          ',method="GET",status="200"} ', rv.data)
+            self.assertIn('http_request_duration_seconds_count{endpoint='
+                          '"admin_user_search"} ', rv.data)
+            self.assertIn('sql_statements_total{endpoint='
+                          '"admin_user_search"}', rv.data)
+            self.app.config['METRICS_ALLOWED'] = ()
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('METRICS_FOLDER')
+            self.app.config.pop('METRICS_ALLOWED', None)
+
     def testChangePassword(self):
         self.client.get('/logout')
         rv = self.client.get('/user/changepassword')
@@ -425,6 +568,34 @@ class AdminTestCase(TestBase):
             per_page=20))
         self.assertIn('login', rv.data)
 
+    def test_replica_routing(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///' + path
+        self.db.Model.metadata.create_all(create_engine(uri))
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica': uri}
+        self._del_all_instance(OperationLog)
+        self.session.add(OperationLog(operator_id=self.admin.id,
+                                      method='replica_test'))
+        self.session.commit()
+        try:
+            self.client.post(
+                '/login', data=dict(name='admin', password='admin'))
+            url = url_for('admin_log_search', page=1, per_page=20)
+            rv = self.client.get(url)
+            self.assertIn('replica_test', rv.data)
+            self.app.config['REPLICA_STALENESS_SECONDS'] = 0
+            rv = self.client.get(url)
+            self.assertNotIn('replica_test', rv.data)
+            rv = self.client.get(url_for('admin_user_search', page=1,
+                                         per_page=10))
+            self.assertIn('admin', rv.data)
+        finally:
+            self.db.get_engine(self.app, bind='replica').dispose()
+            self.app.config.pop('SQLALCHEMY_BINDS')
+            self.app.config.pop('REPLICA_STALENESS_SECONDS', None)
+            os.remove(path)
+
     def test_admin_log_clean(self):
         self._del_all_instance(OperationLog)
         self.client.post('/login', data=dict(name='admin', password='admin'))
@@ -454,6 +625,43 @@ class AdminTestCase(TestBase):
                 end_date='2015-12-31'))
         self.assertFalse(admin.logs)
 
+    def test_admin_profile(self):
+        from controller import profiler
+        folder = tempfile.mkdtemp()
+        self.app.config['PROFILE_FOLDER'] = folder
+        try:
+            self.client.post(
+                '/login', data=dict(name='admin', password='admin'))
+            rv = self.client.get(url_for('admin_profile'))
+            self.assertIn('<form', rv.data)
+            rv = self.client.post(url_for('admin_profile'), data=dict(
+                endpoints='index', users='', fraction='0'))
+            self.assertEqual(rv.data, 'success')
+            self.client.get('/index.html')
+            captures = profiler.captures()
+            self.assertEqual([c.endpoint for c in captures], ['index'])
+            rv = self.client.get(url_for('admin_profile'))
+            self.assertIn(captures[0].name, rv.data)
+            rv = self.client.get(url_for(
+                'admin_profile_detail', name=captures[0].name))
+            self.assertIn('function calls', rv.data)
+            rv = self.client.get(url_for(
+                'admin_profile_detail', name='../settings.json'))
+            self.assertEqual(rv.status_code, 404)
+            # a request that raises still stops and saves its profile
+            ctx = self.app.test_request_context('/index.html')
+            ctx.push()
+            try:
+                self.app.preprocess_request()
+                self.assertIsNotNone(sys.getprofile())
+            finally:
+                ctx.pop(ValueError())
+            self.assertIsNone(sys.getprofile())
+            self.assertEqual(2, len(profiler.captures()))
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('PROFILE_FOLDER')
+
 
 class AddressDataMixin(object):
     def __init__(self):
@@ -575,6 +783,28 @@ class AddressTestCase(TestBase, AddressDataMixin):
             'address_search', name='child', page=1, per_page=2))
         self.assertIn('tbody', rv.data)
 
+    def test_address_choices(self):
+        from choice_cache import choice_cache
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        rv = self.client.get(url_for('address_add'))
+        self.assertIn('child11', rv.data)
+        self.assertIs(choice_cache.get(Address), choice_cache.get(Address))
+        self.client.post(url_for('address_add'), data=dict(
+            no='42052511zzz', name='test_choice',
+            parent_id=self.child1_addr.id))
+        rv = self.client.get(url_for('address_add'))
+        self.assertIn('test_choice', rv.data)
+        address = Address.query.filter(Address.name == 'test_choice').one()
+        form = PersonForm(self.admin)
+        self.assertIn((address.id, u'test_choice'), form.address_id.choices)
+        form = AddressForm(obj=address)
+        self.assertNotIn(address.id, map(
+            lambda x: x[0], form.parent_id.choices))
+        self.session.delete(address)
+        self.session.commit()
+        rv = self.client.get(url_for('address_add'))
+        self.assertNotIn('test_choice', rv.data)
+
 
 class PersonAddRemoveMixin(object):
     def _add_person(self, idcard, birthday, name, address_id):
@@ -610,6 +840,15 @@ class PersonTestCase(PersonTestBase):
         person.reg()
         self.assertIsNotNone(person.status)
 
+    def test_gen_dataset_idcard(self):
+        from gen_dataset import make_idcard, idcard2birthday, retire_day
+        idcard = make_idcard('110105', date(1949, 12, 31), 2)
+        self.assertEqual('11010519491231002X', idcard)
+        self.assertEqual(date(1949, 12, 31), idcard2birthday(idcard))
+        person = Person(birthday=date(1957, 3, 15))
+        self.assertEqual(person.earliest_retire_day,
+                         retire_day(person.birthday))
+
     def test_person_form(self):
         self._del_all_instance(Bankcard)
         self._del_all_instance(Person)
@@ -655,6 +894,185 @@ class PersonTestCase(PersonTestBase):
         self.assertEqual(0, person_count)
         self._del_all_instance(Person)
 
+    def test_job_heartbeat(self):
+        from controller import job_queue
+        from models import Job
+        import time
+        folder = tempfile.mkdtemp()
+        self.app.config.update(JOB_FOLDER=folder, JOB_HEARTBEAT_SECONDS=0.05,
+                               JOB_STALE_SECONDS=60)
+        job_queue.task('test_sleep')(lambda job: time.sleep(0.3))
+        long_ago = datetime.now() - timedelta(minutes=10)
+        try:
+            lost, alive = [Job(kind='test_sleep', user_id=self.admin.id,
+                               status='running', worker='dead:1',
+                               start_time=long_ago, heartbeat_time=beat)
+                           for beat in (long_ago, datetime.now())]
+            self.session.add_all((lost, alive))
+            self.session.commit()
+            job = job_queue.claim('test:1')
+            self.assertEqual(lost.id, job.id)
+            self.assertEqual('test:1', job.worker)
+            self.assertIsNone(job_queue.claim('test:2'))
+            start = job.start_time
+            job_queue.run(job)
+            job = self.session.query(Job).get(job.id)
+            self.assertEqual('done', job.status)
+            self.assertLess(start, job.heartbeat_time)
+            self.assertEqual('running', self.session.query(Job).get(
+                alive.id).status)
+        finally:
+            shutil.rmtree(folder)
+            for key in ('JOB_FOLDER', 'JOB_HEARTBEAT_SECONDS',
+                        'JOB_STALE_SECONDS'):
+                self.app.config.pop(key)
+            job_queue.tasks.pop('test_sleep')
+            self._del_all_instance(Job)
+
+    def test_person_upload_job(self):
+        from controller import job_queue
+        from models import Job
+        folder = tempfile.mkdtemp()
+        self.app.config['JOB_FOLDER'] = folder
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Person)
+        csvstr = u'420525195107010010,test,420525,xx\u53f7,{}'.format(
+            uuid4().hex).encode('utf-8')
+        try:
+            rv = self.client.post(
+                url_for('person_upload', background='yes'),
+                data=dict(file=(io.BytesIO(csvstr), 'test.csv')))
+            self.assertEqual(202, rv.status_code)
+            status_url = json.loads(rv.data)['status']
+            self.assertEqual('queued',
+                             json.loads(self.client.get(status_url).data)[
+                                 'status'])
+            self.assertEqual(0, Person.query.count())
+            job_queue.work(once=True)
+            status = json.loads(self.client.get(status_url).data)
+            self.assertEqual('done', status['status'])
+            self.assertEqual(1, status['done'])
+            self.assertEqual(1, Person.query.filter(
+                Person.idcard == '420525195107010010').count())
+            rv = self.client.post(
+                url_for('person_upload', background='yes'),
+                data=dict(file=(io.BytesIO('bad,line'), 'test.csv')))
+            job_queue.work(once=True)
+            status = json.loads(self.client.get(
+                json.loads(rv.data)['status']).data)
+            self.assertEqual('failed', status['status'])
+            self.assertTrue(status['error'])
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('JOB_FOLDER')
+            self._del_all_instance(Job)
+            self._del_all_instance(Person)
+
+    def test_person_upload_chunked(self):
+        folder = tempfile.mkdtemp()
+        self.app.config['UPLOAD_SPOOL_FOLDER'] = folder
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Person)
+        csvstr = u'420525195107010010,test,420525,xx\u53f7,{}'.format(
+            uuid4().hex).encode('utf-8')
+        try:
+            # without a size the upload could never be complete
+            rv = self.client.post(url_for('upload_start'), data=dict(
+                name='test.csv'))
+            self.assertEqual(400, rv.status_code)
+            rv = self.client.post(url_for('upload_start'), data=dict(
+                name='test.csv', size=len(csvstr)))
+            self.assertEqual(201, rv.status_code)
+            upload_id = json.loads(rv.data)['id']
+            url = url_for('upload_part', upload_id=upload_id)
+            complete_url = url_for('person_upload_spooled',
+                                   upload_id=upload_id)
+            rv = self.client.put(url + '?offset=0', data=csvstr[:20],
+                                 content_type='application/octet-stream')
+            self.assertEqual(20, json.loads(rv.data)['offset'])
+            self.assertEqual(409, self.client.post(complete_url).status_code)
+            # a part sent again after a dropped connection
+            rv = self.client.put(url + '?offset=0', data=csvstr[:20],
+                                 content_type='application/octet-stream')
+            self.assertEqual(409, rv.status_code)
+            # a part going past the size is not written
+            rv = self.client.put(url + '?offset=20', data=csvstr[20:] + 'x',
+                                 content_type='application/octet-stream')
+            self.assertEqual(413, rv.status_code)
+            offset = json.loads(self.client.get(url).data)['offset']
+            self.assertEqual(20, offset)
+            rv = self.client.put(url + '?offset={}'.format(offset),
+                                 data=csvstr[offset:],
+                                 content_type='application/octet-stream')
+            self.assertTrue(json.loads(rv.data)['complete'])
+            self.assertEqual('success', self.client.post(complete_url).data)
+            self.assertEqual(1, Person.query.filter(
+                Person.idcard == '420525195107010010').count())
+            self.assertEqual(404, self.client.get(url).status_code)
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('UPLOAD_SPOOL_FOLDER')
+            self._del_all_instance(Person)
+
+    def test_upload_spool_lock(self):
+        from uploads import upload_spool, OffsetError
+        import fcntl
+        import threading
+        folder = tempfile.mkdtemp()
+        self.app.config['UPLOAD_SPOOL_FOLDER'] = folder
+        try:
+            upload_id = upload_spool.start(self.admin.id, 'test.csv', 4)['id']
+            results = []
+
+            def append():
+                try:
+                    results.append(upload_spool.append(
+                        upload_id, 0, io.BytesIO('ab')))
+                except OffsetError as e:
+                    results.append(e)
+            with open(upload_spool.path(upload_id), 'r+b') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                threads = [threading.Thread(target=append) for i in (0, 1)]
+                for thread in threads:
+                    thread.start()
+                threads[0].join(0.2)
+                self.assertEqual([], results)
+            for thread in threads:
+                thread.join()
+            self.assertIn(2, results)
+            self.assertEqual(2, upload_spool.get(upload_id)['offset'])
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('UPLOAD_SPOOL_FOLDER')
+
+    def test_person_upload_duplicate(self):
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Person)
+        lines = [u'42052519510701001{},test,420525,xx\u53f7,{}'.format(
+            i, uuid4().hex).encode('utf-8') for i in (0, 9)]
+        try:
+            rv = self.client.post(url_for('person_upload'), data=dict(
+                file=(io.BytesIO(lines[0]), 'test.csv')))
+            self.assertEqual('success', rv.data)
+            # uploaded again after a timeout, with a line more
+            rv = self.client.post(url_for('person_upload'), data=dict(
+                file=(io.BytesIO('\n'.join(lines)), 'test.csv')))
+            self.assertEqual('success, duplicate lines skipped: 0', rv.data)
+            self.assertEqual(2, Person.query.count())
+            self.assertEqual(2, UploadLine.query.filter(
+                UploadLine.kind == 'person').count())
+            # a quoted field spanning lines is one record
+            line = u'420525195107010029,test,420525,"x\nx\u53f7",{}'.format(
+                uuid4().hex).encode('utf-8')
+            for result in ('success', 'success, duplicate lines skipped: 0'):
+                rv = self.client.post(url_for('person_upload'), data=dict(
+                    file=(io.BytesIO(line), 'test.csv')))
+                self.assertEqual(result, rv.data)
+            self.assertEqual(3, Person.query.count())
+        finally:
+            self._del_all_instance(UploadLine)
+            self._del_all_instance(Person)
+
     def test_person_delete(self):
         self.client.post('/login', data=dict(name='admin', password='admin'))
         self._del_all_instance(Person)
@@ -693,6 +1111,57 @@ class PersonTestCase(PersonTestBase):
         self.assertTrue(person.can_retire)
         self._del_all_instance(Person)
 
+    def test_person_status_counter(self):
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Person)
+        PersonStatusCounter.rebuild()
+        self.session.commit()
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.parent_addr.id)
+        self.assertEqual(1, PersonStatusCounter.total(
+            self.parent_addr, Person.REG))
+        person = self.session.query(Person).filter(
+            Person.idcard == '420525195107010010').one()
+        self.client.post(url_for('person_normal_reg', pk=person.id))
+        self.assertEqual(0, PersonStatusCounter.total(
+            self.parent_addr, Person.REG))
+        self.assertEqual(1, PersonStatusCounter.total(
+            self.parent_addr, Person.NORMAL))
+        self.assertEqual(1, Person.query.filter(
+            Person.can_retire.is_(True)).count())
+        self._del_all_instance(Person)
+
+    def test_person_status_counter_race(self):
+        self._del_all_instance(PersonStatusCounter)
+        address_id = self.parent_addr.id
+        connection = self.db.session.connection()
+        self.assertEqual(0, PersonStatusCounter._add(
+            connection, address_id, Person.REG, 2))
+        PersonStatusCounter._insert(connection, address_id, Person.REG, 2)
+        # inserted by a concurrent write after _add found no counter
+        PersonStatusCounter._insert(connection, address_id, Person.REG, 1)
+        self.db.session.commit()
+        self.assertEqual(3, PersonStatusCounter.total(
+            address_id, Person.REG))
+        PersonStatusCounter.rebuild()
+        self.db.session.commit()
+
+    def test_convert_person_status(self):
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE persons (id INTEGER PRIMARY KEY, '
+                       'address_id INTEGER, _status VARCHAR NOT NULL)')
+        engine.execute("INSERT INTO persons VALUES "
+                       "(1, 1, 'registed'), (2, 1, 'normal-retire')")
+        self.assertTrue(convert_person_status(engine))
+        self.assertEqual([(1, Person.REG), (2, Person.NORMAL_RETIRE)], list(
+            engine.execute('SELECT id, _status FROM persons ORDER BY id')))
+        self.assertFalse(convert_person_status(engine))
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE persons (id INTEGER PRIMARY KEY, '
+                       'address_id INTEGER, _status VARCHAR NOT NULL)')
+        engine.execute("INSERT INTO persons VALUES (1, 1, 'unknown')")
+        self.assertRaises(ValueError, convert_person_status, engine)
+
     def test_person_retire_reg(self):
         self.client.post('/login', data=dict(name='admin', password='admin'))
         self._del_all_instance(Person)
@@ -721,12 +1190,44 @@ class PersonTestCase(PersonTestBase):
         self.assertIn('420525195107',
                       [p.idcard[:12] for p in self.session.query(
                           Person).all()])
-        self.client.post(url_for('person_batch_normal'), data=dict(
-            start_date='1951-07-01', end_date='1951-07-31'))
+        from grant_cache import grant_cache
+        folder = tempfile.mkdtemp()
+        self.app.config['GRANT_CACHE_FOLDER'] = folder
+        try:
+            path = grant_cache.fetch(None, lambda: 'zip1')
+            self.client.post(url_for('person_batch_normal'), data=dict(
+                start_date='1951-07-01', end_date='1951-07-31'))
+            # the normaled persons are in the grant of a new version
+            self.assertNotEqual(
+                path, grant_cache.fetch(None, lambda: 'zip2'))
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('GRANT_CACHE_FOLDER')
         for person in self.session.query(Person).filter(
                 Person.idcard.like('420525195107%')).all():
             person = self.session.query(Person).get(person.id)
             self.assertTrue(person.can_retire)
+            self.assertEqual(1, OperationLog.query.filter(
+                OperationLog.method == 'person_batch_normal',
+                OperationLog.remark == '{},'.format(person.id)).count())
+        self._del_all_instance(Person)
+
+    def test_person_batch_normal_subtree(self):
+        self._del_all_instance(Person)
+        self._add_person('420525195107010010', '1951-07-01', 'test1',
+                         self.child11_addr.id)
+        self._add_person('420525195107010020', '1951-07-01', 'test2',
+                         self.child21_addr.id)
+        inside, outside = [self.session.query(Person).filter(
+            Person.idcard == idcard).one() for idcard in (
+                '420525195107010010', '420525195107010020')]
+        self.assertEqual(Person.REG, inside._status)
+        rows = Person.batch_normal(address_id=self.child1_addr.id)
+        self.session.commit()
+        self.assertEqual([inside.id], [row.id for row in rows])
+        # the loaded persons read the new status
+        self.assertEqual(Person.NORMAL, inside._status)
+        self.assertEqual(Person.REG, outside._status)
         self._del_all_instance(Person)
 
     def test_person_dead_reg(self):
@@ -927,6 +1428,105 @@ class PersonTestCase(PersonTestBase):
         self.assertIn('test', rv.data)
         self._del_all_instance(Person)
 
+    def test_person_search_wildcard(self):
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self.client.get('/')
+        self._del_all_instance(Person)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        rv = self.client.get(url_for('person_search', idcard='4205%',
+                                     page=1, per_page=2))
+        self.assertNotIn('420525195107010010', rv.data)
+        rv = self.client.get(url_for('person_search', address='par',
+                                     page=1, per_page=2))
+        self.assertIn('420525195107010010', rv.data)
+        self._del_all_instance(Person)
+
+    def test_person_search_nocase(self):
+        from search_index import (
+            prefix_like, create_search_indexes, drop_search_indexes)
+        self._del_all_instance(Person)
+        self._add_person('420525195107010010', '1951-07-01', 'Test',
+                         self.admin.address.id)
+        create_search_indexes()
+        try:
+            for prefix in ('tes', 'TEST', 'T'):
+                self.assertEqual(1, Person.query.filter(
+                    prefix_like(Person.name, prefix)).count())
+            self.assertEqual(0, Person.query.filter(
+                prefix_like(Person.name, 'tet')).count())
+            self.assertEqual(1, Person.query.filter(
+                prefix_like(Person.name, '')).count())
+            query = self.session.query(Person.id).filter(
+                prefix_like(Person.name, 'tes'))
+            plan = self.session.execute(
+                'EXPLAIN QUERY PLAN ' + str(query.statement.compile(
+                    compile_kwargs={'literal_binds': True}))).fetchall()
+            self.assertIn('ix_persons_name_prefix', str(plan))
+        finally:
+            drop_search_indexes()
+            self._del_all_instance(Person)
+
+    def test_autocomplete(self):
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Bankcard)
+        self._del_all_instance(Person)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        rv = self.client.get(url_for(
+            'autocomplete_search', field='idcard', q='4205251951'))
+        self.assertIn('420525195107010010', rv.data)
+        self._add_person('420525195107010020', '1951-07-01', 'other',
+                         self.admin.address.id)
+        rv = self.client.get(url_for(
+            'autocomplete_search', field='name', q='oth'))
+        self.assertIn('other', rv.data)
+        self.assertNotIn('test', rv.data)
+        rv = self.client.get(url_for(
+            'autocomplete_search', field='unknown', q='oth'))
+        self.assert404(rv)
+        self._del_all_instance(Person)
+
+    def test_prefix_index(self):
+        from prefix_index import PrefixIndex, AutocompleteService
+        index = PrefixIndex(
+            ('4205{:04d}'.format(i), i, i) for i in range(2000))
+        # the only row of the scope is behind the rows of other scopes
+        self.assertEqual([(u'42051999', 1999)], index.search(
+            '4205', lambda owner: owner == 1999))
+        index.put('42050001', 1, 5000)
+        self.assertEqual(2000, len(index))
+        self.assertEqual([(u'42050001', 1)], index.search(
+            '4205', lambda owner: owner == 5000))
+        index.MERGE_SIZE = 2
+        index.put(u'4205\u738b', 3000, 3000)
+        index.remove('42050002', 2)
+        index.put('42050002', 2, 3000)
+        index.put('4205x', 3001, 3000)
+        index.put('42050003', 3002, 3000)
+        self.assertEqual(0, len(index.added))
+        self.assertEqual(2003, len(index))
+        self.assertEqual(
+            [(u'42050002', 2), (u'42050003', 3002), (u'4205x', 3001),
+             (u'4205\u738b', 3000)],
+            index.search('4205', lambda owner: owner == 3000))
+        # too many rows of other scopes, the database answers
+        index.MAX_SCAN = 100
+        self.assertIsNone(index.search('4205', lambda owner: False))
+        self.assertEqual([], index.search('4206', lambda owner: False))
+        self._del_all_instance(Person)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        service = AutocompleteService()
+        service.build()
+        self.assertEqual(1, len(service.indexes['idcard']))
+        # two refreshes loading the same rows
+        for i in range(2):
+            service.max_person_id = 0
+            service.refresh()
+        self.assertEqual(1, len(service.indexes['idcard']))
+        self._del_all_instance(Person)
+
     def test_standard_bind(self):
         self.client.post('/login', data=dict(name='admin', password='admin'))
         self.client.get('/')
@@ -1004,6 +1604,619 @@ class BankcardTestCase(BankcardTestBase):
         self.assertEqual(bankcard.name, 'test')
         self._del_all_instance(Bankcard)
 
+    def test_grant_cache(self):
+        from grant_cache import grant_cache, peroid_key
+        folder = tempfile.mkdtemp()
+        self.app.config['GRANT_CACHE_FOLDER'] = folder
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Bankcard)
+        calls = []
+
+        def make():
+            calls.append(1)
+            return 'zip{}'.format(len(calls))
+        try:
+            peroid = date(2015, 1, 1)
+            path = grant_cache.fetch(peroid, make)
+            self.assertEqual(path, grant_cache.fetch(peroid, make))
+            self.assertEqual(1, len(calls))
+            self.client.post(url_for('bankcard_add'), data=dict(
+                no='6228410770613888888', name='test'))
+            bankcard = self.session.query(Bankcard).filter(
+                Bankcard.no == '6228410770613888888').one()
+            self.assertEqual(path, grant_cache.fetch(peroid, make))
+            bankcard.name = 'test2'
+            self.session.commit()
+            new_path = grant_cache.fetch(peroid, make)
+            self.assertEqual(2, len(calls))
+            self.assertFalse(os.path.exists(path))
+            with open(new_path) as f:
+                self.assertEqual('zip2', f.read())
+            # a zip made at an older version keeps the newer ones
+            newer = []
+
+            def slow_make():
+                grant_cache.bump(peroid_key(peroid))
+                newer.append(grant_cache.fetch(peroid, make))
+                return 'older'
+            grant_cache.bump(peroid_key(peroid))
+            older_path = grant_cache.fetch(peroid, slow_make)
+            self.assertFalse(os.path.exists(new_path))
+            self.assertTrue(os.path.exists(older_path))
+            self.assertTrue(os.path.exists(newer[0]))
+            self.assertEqual(newer[0], grant_cache.fetch(peroid, make))
+            self.assertEqual(3, len(calls))
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('GRANT_CACHE_FOLDER')
+            self._del_all_instance(Bankcard)
+
+    def test_peroid_close(self):
+        role = self._get_or_create(
+            Role, 'name', 'pay_admin', name='pay_admin')
+        if not self.admin.has_role('pay_admin'):
+            self.admin.roles.append(role)
+            self.session.commit()
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        for model in (PayBookSummary, PeroidClose, PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).filter(
+            Person.idcard == '420525195107010010').one()
+        bankcard = Bankcard(no='6228410770613888888', name='test',
+                            owner=person, create_by=self.admin)
+        item = self._get_or_create(
+            PayBookItem, 'name', 'bank_should_pay', name='bank_should_pay',
+            direct=1)
+        peroid = date(2015, 1, 1)
+        for money in (10, 20):
+            self.session.add(PayBook(
+                person=person, bankcard=bankcard, item=item, money=money,
+                peroid=peroid, create_by=self.admin))
+        self.session.commit()
+        try:
+            self.client.post(url_for('paybook_peroid_close', peroid=peroid))
+            summary = self.session.query(PayBookSummary).one()
+            self.assertEqual(30, summary.money)
+            self.assertEqual(peroid, summary.peroid)
+            # the closed peroid is read from its sums
+            self.session.execute(PayBook.__table__.delete())
+            self.session.commit()
+            rv = self.client.get(url_for(
+                'paybook_search', page=1, per_page=10, peroid='201501',
+                person_idcard='420525195107010010', all='yes'))
+            self.assertIn('6228410770613888888', rv.data)
+            self.session.add(PayBook(
+                person=person, bankcard=bankcard, item=item, money=1,
+                peroid=date(2015, 1, 1), create_by=self.admin))
+            self.assertRaises(PeroidClosedError, self.session.commit)
+            self.session.rollback()
+            rv = self.client.post(
+                url_for('paybook_peroid_close', peroid=peroid))
+            self.assert500(rv)
+            self.assertEqual(1, self.session.query(PeroidClose).count())
+        finally:
+            for model in (PayBookSummary, PeroidClose, PayBook, Bankcard,
+                          Person):
+                self._del_all_instance(model)
+
+    def test_ledger_check(self):
+        from ledger_check import LedgerChecker
+        for model in (PayBookSummary, PeroidClose, PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).filter(
+            Person.idcard == '420525195107010010').one()
+        bankcard = Bankcard(no='6228410770613888888', name='test',
+                            owner=person, create_by=self.admin)
+        should, payed = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('bank_should_pay', 'bank_payed')]
+        for item, money in ((should, -10), (payed, 10), (should, -5)):
+            self.session.add(PayBook(
+                person=person, bankcard=bankcard, item=item, money=money,
+                peroid=date(2015, 1, 1), create_by=self.admin))
+        self.session.commit()
+        try:
+            # chunks of one paybook cut every write in two
+            report = LedgerChecker(self.db.engine, 2, 1).run()
+            self.assertEqual(3, report['chunks'])
+            self.assertEqual([person.id], [
+                group['person_id'] for group in report['persons']])
+            self.assertEqual(-5, report['peroids'][0]['money'])
+            self.assertEqual([-10, 10, -5], [
+                row['money'] for row in report['writes'][0]['rows']])
+            self.session.add(PayBook(
+                person=person, bankcard=bankcard, item=payed, money=5,
+                peroid=date(2015, 1, 1), create_by=self.admin))
+            self.session.commit()
+            report = LedgerChecker(self.db.engine, 2, 1).run()
+            self.assertFalse(report['writes'] or report['persons'] or
+                             report['peroids'])
+            self.assertEqual(0, LedgerChecker(
+                self.db.engine, peroid='201502').run()['chunks'])
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_analysis(self):
+        from ledger_columns import ledger_columns
+        folder = tempfile.mkdtemp()
+        self.app.config['LEDGER_COLUMNS_VERSION_FILE'] = os.path.join(
+            folder, 'ledger_columns.version')
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).filter(
+            Person.idcard == '420525195107010010').one()
+        bankcard = Bankcard(no='6228410770613888888', name='test',
+                            owner=person, create_by=self.admin)
+        should, payed = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('bank_should_pay', 'bank_payed')]
+
+        def add(item, money, peroid):
+            self.session.add(PayBook(
+                person=person, bankcard=bankcard, item=item, money=money,
+                peroid=peroid, create_by=self.admin))
+            self.session.commit()
+        try:
+            add(payed, 10.5, date(2015, 1, 1))
+            add(should, -10.5, date(2015, 1, 1))
+            rv = self.client.get(url_for(
+                'paybook_analysis', by='month', items='bank_payed'))
+            self.assertEqual('201501,10.50', rv.data)
+            add(payed, 3, date(2015, 2, 1))
+            rv = self.client.get(url_for(
+                'paybook_analysis', by='address,item', mindate='2015-02-01'))
+            self.assertEqual(u'{},bank_payed,3.00'.format(
+                self.admin.address.name).encode('utf-8'), rv.data)
+            self.assertEqual(3, len(ledger_columns.get()))
+            self.assertEqual([((payed.id, ), 1350)], ledger_columns.get(
+                ).filter(item_id=[payed.id]).group_sum('item_id'))
+        finally:
+            shutil.rmtree(folder)
+            self.app.config.pop('LEDGER_COLUMNS_VERSION_FILE')
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_ledger_snapshot(self):
+        import numpy
+        from ledger_columns import LedgerColumns
+        folder = tempfile.mkdtemp()
+        self.app.config.update(
+            LEDGER_COLUMNS_VERSION_FILE=os.path.join(folder, 'version'),
+            LEDGER_SNAPSHOT_FOLDER=os.path.join(folder, 'ledger'),
+            LEDGER_SNAPSHOT_ROWS=2)
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).filter(
+            Person.idcard == '420525195107010010').one()
+        item = self._get_or_create(
+            PayBookItem, 'name', 'bank_payed', name='bank_payed', direct=1)
+
+        def add(*moneys):
+            for money in moneys:
+                self.session.add(PayBook(
+                    person=person, item=item, money=money,
+                    peroid=date(2015, 1, 1), create_by=self.admin))
+            self.session.commit()
+        try:
+            add(1, 2)
+            columns = LedgerColumns()
+            self.assertEqual(300, columns.get().total())
+            self.assertEqual(0, columns.size)
+            # a new process maps the snapshot and loads the rows after it
+            add(4)
+            columns = LedgerColumns()
+            self.assertEqual(700, columns.get().total())
+            self.assertIsInstance(columns.base['cents'], numpy.memmap)
+            self.assertEqual(1, columns.size)
+            # the loaded rows stay when the new snapshot can not be mapped
+            add(8, 16)
+            columns = LedgerColumns()
+            columns.open_snapshot = lambda: False
+            self.assertEqual(3100, columns.get().total())
+            self.assertEqual(5, columns.size)
+            snapshots = os.path.join(folder, 'ledger')
+            self.assertEqual(1, len([
+                name for name in os.listdir(snapshots)
+                if os.path.isdir(os.path.join(snapshots, name))]))
+        finally:
+            shutil.rmtree(folder)
+            for key in ('LEDGER_COLUMNS_VERSION_FILE',
+                        'LEDGER_SNAPSHOT_FOLDER', 'LEDGER_SNAPSHOT_ROWS'):
+                self.app.config.pop(key)
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_ledger(self):
+        from controller import PayBookLedger, PayBookManager
+        from flask_login import login_user
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        for idcard in ('420525195107010010', '420525195107010029'):
+            self._add_person(idcard, '1951-07-01', 'test',
+                             self.admin.address.id)
+        persons = self.session.query(Person).order_by(Person.id).all()
+        bankcards = [Bankcard(no='622841077061388888{}'.format(i),
+                              name='test', owner=person, create_by=self.admin)
+                     for i, person in enumerate(persons)]
+        self.session.add_all(bankcards)
+        should, bank_should, failed = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay', 'bank_failed')]
+        self.session.commit()
+        ids = [person.id for person in persons]
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                ledger = PayBookLedger(ids)
+                for person, bankcard, money in zip(persons, bankcards,
+                                                   (10, 20)):
+                    ledger.create_tuple(person.id, bankcard, bankcard,
+                                        should, bank_should, money)
+                ledger.create_tuple(ids[0], bankcards[0], bankcards[0],
+                                    bank_should, failed, 4)
+                self.assertEqual(0, self.session.query(PayBook).count())
+                ledger.commit()
+                self.assertEqual(6, self.session.query(PayBook).count())
+                ledger = PayBookLedger(ids, 'bank_should_pay')
+                self.assertEqual({ids[0]: 6, ids[1]: 20},
+                                 ledger.sum_money())
+                self.assertEqual([20], [book.money for book in ledger.
+                                        lst_groupby_bankcard(False)[ids[1]]])
+                book, = PayBookManager(
+                    persons[0], 'bank_should_pay').lst_groupby_bankcard(False)
+                self.assertEqual(
+                    (bankcards[0].id, bankcards[0].no, True,
+                     'bank_should_pay', 6),
+                    (book.bankcard_id, book.bankcard_no, book.binded,
+                     book.item_name, book.money))
+                ledger.settle_to(failed, dict(zip(ids, bankcards)))
+                self.assertEqual({ids[0]: 0, ids[1]: 0}, ledger.sum_money())
+                self.assertEqual({ids[0]: 10, ids[1]: 20}, PayBookLedger(
+                    ids, 'bank_failed').sum_money())
+                self.assertRaises(RuntimeError, PayBookManager(
+                    None, failed).settle_to, should, bankcards[1])
+                manager = PayBookManager(persons[1], failed)
+                manager.settle_to(should, bankcards[1])
+                self.assertEqual(0, manager.sum_money())
+                self.assertEqual(0, PayBookManager(persons[1]).sum_money())
+                self.assertEqual(2, PayBookManager(
+                    persons[1], should).query.count())
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_bulk_correct(self):
+        from controller import (
+            PayBookLedger, _fail_correct_upload, _amend_upload)
+        from flask_login import login_user
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        for idcard in ('420525195107010010', '420525195107010029'):
+            self._add_person(idcard, '1951-07-01', 'test',
+                             self.admin.address.id)
+        persons = self.session.query(Person).order_by(Person.id).all()
+        bankcards = [Bankcard(no='62284107706138888{}'.format(i),
+                              name='test', owner=persons[i % 2],
+                              create_by=self.admin) for i in range(10, 14)]
+        self.session.add_all(bankcards)
+        should, bank_should, failed, amend = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay', 'bank_failed',
+                         'sys_amend')]
+        self.session.commit()
+        ids = [person.id for person in persons]
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                ledger = PayBookLedger(ids)
+                for person_id, bankcard in zip(ids, bankcards):
+                    ledger.create_tuple(person_id, bankcard, bankcard,
+                                        bank_should, failed, 10)
+                ledger.commit()
+                report = io.BytesIO()
+                _fail_correct_upload(io.BytesIO(
+                    '420525195107010010,6228410770613888812\n'
+                    '420525195107010029,6228410770613888813,5\n'
+                    '420525195107010010,6228410770613888812\n'
+                    '420525195107010037,6228410770613888812\n'), report)
+                self.assertEqual(
+                    ['success', 'failed money is not 5', 'duplicate idcard',
+                     'person not found'],
+                    [line.split(',')[-1] for line in
+                     report.getvalue().splitlines()[1:]])
+                self.assertEqual({ids[0]: 0, ids[1]: 10}, PayBookLedger(
+                    ids, failed).sum_money())
+                self.assertEqual({ids[0]: 10}, PayBookLedger(
+                    ids, bank_should).sum_money(bankcards[2]))
+                ledger = PayBookLedger(ids)
+                ledger.create_tuple(ids[0], bankcards[0], bankcards[0],
+                                    should, failed, 30)
+                ledger.commit()
+                report = io.BytesIO()
+                _amend_upload(io.BytesIO(
+                    '420525195107010010,6228410770613888812,25\n'
+                    '420525195107010029,6228410770613888813,20\n'), report)
+                self.assertEqual(
+                    ['success', 'bank should pay not payed'],
+                    [line.split(',')[-1] for line in
+                     report.getvalue().splitlines()[1:]])
+                self.assertEqual({ids[0]: 0}, PayBookLedger(
+                    ids, should).sum_money())
+                self.assertEqual({ids[0]: -25}, PayBookLedger(
+                    ids, amend).sum_money())
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_manager_items(self):
+        from controller import PayBookManager
+        from flask_login import login_user
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).one()
+        bankcard = Bankcard(no='6228410770613888810', name='test',
+                            owner=person, create_by=self.admin)
+        self.session.add(bankcard)
+        should, bank_should = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay')]
+        self.session.commit()
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                PayBookManager(person).create_tuple(
+                    bankcard, bankcard, should, bank_should, 10)
+                self.assertEqual(0, PayBookManager(person).sum_money())
+                self.assertEqual(2, PayBookManager(person).count)
+                self.assertEqual(10, PayBookManager(
+                    person, 'bank_should_pay').sum_money())
+                self.assertEqual(-10, PayBookManager(
+                    person.id, u'sys_should_pay').sum_money())
+                manager = PayBookManager(person, should, bank_should)
+                self.assertEqual(0, manager.sum_money())
+                self.assertEqual(2, manager.count)
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_query_peroid(self):
+        from controller import PayBookLedger, _paybook_query
+        from user_cache import user_cache, CachedUser
+        from flask_login import login_user
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).one()
+        bankcard = Bankcard(no='6228410770613888810', name='test',
+                            owner=person, create_by=self.admin)
+        self.session.add(bankcard)
+        should, bank_should = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay')]
+        self.session.commit()
+        try:
+            with self.app.test_request_context():
+                login_user(CachedUser(user_cache.get(self.admin.id)))
+                ledger = PayBookLedger([person.id])
+                ledger.create_tuple(person.id, bankcard, bankcard, should,
+                                    bank_should, 10)
+                ledger.commit()
+                peroid = ledger.current_peroid
+                last_month = (peroid - timedelta(days=1)).replace(day=1)
+                for arg, count in (
+                        (peroid, 1),
+                        (unicode(peroid.strftime('%Y-%m-%d')), 1),
+                        (u'{:%Y%m}'.format(peroid), 1),
+                        ('{:%Y-%m-%d}'.format(last_month), 0),
+                        (u'2015-13', 0)):
+                    self.assertEqual(count, _paybook_query(
+                        None, ['bank_should_pay'], arg).count())
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_grant_non_ascii(self):
+        from controller import PayBookLedger, _bankgrant_zip
+        from flask_login import login_user
+        from zipfile import ZipFile
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        name = u'\u5f20\u4e09'
+        self._add_person('420525195107010010', '1951-07-01', name,
+                         self.admin.address.id)
+        person = self.session.query(Person).one()
+        bankcard = Bankcard(no='6228410770613888810', name=name,
+                            owner=person, create_by=self.admin)
+        self.session.add(bankcard)
+        should, bank_should = [self._get_or_create(
+            PayBookItem, 'name', item, name=item, direct=1)
+            for item in ('sys_should_pay', 'bank_should_pay')]
+        self.session.commit()
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                ledger = PayBookLedger([person.id])
+                ledger.create_tuple(person.id, bankcard, bankcard, should,
+                                    bank_should, 10)
+                ledger.commit()
+                peroid = ledger.current_peroid
+                zipf = ZipFile(io.BytesIO(_bankgrant_zip(peroid)))
+                self.assertEqual(['1.csv'], zipf.namelist())
+                self.assertIn(u',{},10'.format(name),
+                              zipf.read('1.csv').decode('utf-8'))
+            # the public report lists the persons whose books do not sum up
+            self.session.add(PayBook(
+                person_id=person.id, bankcard_id=bankcard.id,
+                item_id=bank_should.id, create_user_id=self.admin.id,
+                money=5, peroid=peroid))
+            self.session.commit()
+            self.client.post(
+                '/login', data=dict(name='admin', password='admin'))
+            rv = self.client.get(url_for(
+                'paybook_public_report', mindate=peroid.isoformat(),
+                maxdate=peroid.isoformat()))
+            self.assertEqual(200, rv.status_code)
+            self.assertIn(u'420525195107010010,{},'.format(name),
+                          rv.data.decode('utf-8'))
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_upload(self):
+        from controller import PayBookLedger, _paybook_upload
+        from flask_login import login_user
+        for model in (UploadLine, PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        self._add_person('420525195107010010', '1951-07-01', 'test',
+                         self.admin.address.id)
+        person = self.session.query(Person).one()
+        bankcard = Bankcard(no='6228410770613888810', name='test',
+                            owner=person, create_by=self.admin)
+        self.session.add(bankcard)
+        for name in ('sys_should_pay', 'bank_should_pay'):
+            self._get_or_create(PayBookItem, 'name', name, name=name,
+                                direct=1)
+        self.session.commit()
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                self.assertEqual([], _paybook_upload(io.BytesIO('\n'.join(
+                    '{}|test|420525195107010010|{}|x|6228410770613888810'
+                    .format(i, money)
+                    for i, money in enumerate(('0.10', '0.20', '0.07'))))))
+                self.assertEqual({person.id: Decimal('0.37')}, PayBookLedger(
+                    [person.id], 'bank_should_pay').sum_money())
+        finally:
+            for model in (UploadLine, PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_batch_success(self):
+        from controller import PayBookLedger, _batch_success
+        from flask_login import login_user
+        from werkzeug.exceptions import HTTPException
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        for idcard in ('420525195107010010', '420525195107010029'):
+            self._add_person(idcard, '1951-07-01', 'test',
+                             self.admin.address.id)
+        persons = self.session.query(Person).order_by(Person.id).all()
+        bankcards = [Bankcard(no='62284107706138888{}'.format(i),
+                              name='test', owner=persons[i % 2],
+                              create_by=self.admin) for i in range(10, 12)]
+        self.session.add_all(bankcards)
+        should, bank_should, payed, failed = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay', 'bank_payed',
+                         'bank_failed')]
+        self.session.commit()
+        ids = [person.id for person in persons]
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                ledger = PayBookLedger(ids)
+                for i, bankcard in enumerate(bankcards):
+                    ledger.create_tuple(ids[i], bankcard, bankcard, should,
+                                        bank_should, 10 * (i + 1))
+                ledger.commit()
+                peroid = ledger.current_peroid
+                for fails in ('6228410770613888810,10.01',
+                              '6228410770613888810,0',
+                              '6228410770613888810,x'):
+                    self.assertRaises(
+                        HTTPException, _batch_success, peroid, fails)
+                    self.assertEqual({}, PayBookLedger(
+                        ids, payed).sum_money())
+                _batch_success(peroid, '6228410770613888810,4.35\n')
+                self.assertEqual({ids[0]: Decimal('5.65'), ids[1]: 20},
+                                 PayBookLedger(ids, payed).sum_money())
+                self.assertEqual({ids[0]: Decimal('4.35')}, PayBookLedger(
+                    ids, failed).sum_money())
+                self.assertEqual({ids[0]: 0, ids[1]: 0}, PayBookLedger(
+                    ids, bank_should).sum_money())
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
+    def test_paybook_reconcile(self):
+        from controller import PayBookLedger, _reconcile, _cents
+        self.assertEqual([-7, 10, 300, 9223372036854775],
+                         map(_cents, ('-0.07', Decimal('0.1'), '3',
+                                      '92233720368547.75')))
+        from flask_login import login_user
+        from zipfile import ZipFile
+        for model in (PayBook, Bankcard, Person):
+            self._del_all_instance(model)
+        for idcard in ('420525195107010010', '420525195107010029'):
+            self._add_person(idcard, '1951-07-01', 'test',
+                             self.admin.address.id)
+        persons = self.session.query(Person).order_by(Person.id).all()
+        bankcards = [Bankcard(no='62284107706138888{}'.format(i),
+                              name='test', owner=persons[i % 2],
+                              create_by=self.admin) for i in range(10, 16)]
+        self.session.add_all(bankcards)
+        should, bank_should, payed, failed = [self._get_or_create(
+            PayBookItem, 'name', name, name=name, direct=1)
+            for name in ('sys_should_pay', 'bank_should_pay', 'bank_payed',
+                         'bank_failed')]
+        self.session.commit()
+        ids = [person.id for person in persons]
+        try:
+            with self.app.test_request_context():
+                login_user(self.admin)
+                ledger = PayBookLedger(ids)
+                for i, bankcard in enumerate(bankcards):
+                    ledger.create_tuple(ids[i % 2], bankcard, bankcard,
+                                        should, bank_should, 10 * (i + 1))
+                # the last bankcard paid both persons
+                ledger.create_tuple(ids[0], bankcards[5], bankcards[5],
+                                    should, bank_should, 5)
+                ledger.commit()
+                lines = ['0,{},test,{},normal,{}'.format(
+                    bankcards[i].no, money, payed_money)
+                    for i, money, payed_money in (
+                        (0, 10, 10), (1, 20, 5), (2, 30, 0), (0, 10, 10),
+                        (3, 41, 41), (5, 60, 60))]
+                lines.insert(4, '0,6228410770613888899,test,1,normal,1')
+                f = io.BytesIO()
+                with ZipFile(f, 'w') as zipf:
+                    zipf.writestr('1.csv', '\n'.join(lines[:3]))
+                    zipf.writestr('2.csv', '\n'.join(lines[3:]))
+                report = io.BytesIO()
+                progress = []
+                counts = _reconcile(
+                    ledger.current_peroid, f, report,
+                    lambda done, total=None: progress.append((done, total)))
+                self.assertEqual(
+                    ['partial', 'failed', 'duplicate', 'unknown card',
+                     'amount mismatch', 'several balances', 'missing'],
+                    [line.split(',')[-1] for line in
+                     report.getvalue().splitlines()[1:]])
+                self.assertEqual(1, counts['paid'])
+                self.assertEqual([(0, 7), (7, None)],
+                                 [progress[0], progress[-1]])
+                self.assertEqual({ids[0]: 10, ids[1]: 5}, PayBookLedger(
+                    ids, payed).sum_money())
+                self.assertEqual({ids[0]: 30, ids[1]: 15}, PayBookLedger(
+                    ids, failed).sum_money())
+                self.assertEqual({ids[0]: 55, ids[1]: 100}, PayBookLedger(
+                    ids, bank_should).sum_money())
+        finally:
+            for model in (PayBook, Bankcard, Person):
+                self._del_all_instance(model)
+
     def test_bankcard_bind(self):
         self.client.post('/login', data=dict(name='admin', password='admin'))
         self._del_all_instance(Person)
@@ -1061,6 +2274,21 @@ class BankcardTestCase(BankcardTestBase):
         self._del_all_instance(Bankcard)
         self._del_all_instance(Person)
 
+    def test_bankcard_search_pagination(self):
+        self.client.post('/login', data=dict(name='admin', password='admin'))
+        self._del_all_instance(Bankcard)
+        for i in range(3):
+            self.client.post(url_for('bankcard_add'), data=dict(
+                no='62284107706138888{}'.format(10 + i), name='test'))
+        rv = self.client.get(url_for(
+            'bankcard_search', no='622841', page=2, per_page=1))
+        self.assertEqual(200, rv.status_code)
+        for page in (1, 3):
+            self.assertIn(url_for(
+                'bankcard_search', no='622841', page=page, per_page=1),
+                rv.data.replace('&amp;', '&'))
+        self._del_all_instance(Bankcard)
+
 
 class NoteTestCase(TestBase, AddressDataMixin):
 
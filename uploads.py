@@ -0,0 +1,132 @@
+# coding=utf-8
+'''
+chunked, resumable uploads spooled to disk.
+a client starts an upload with the size of the file, then sends the file
+in parts, each part is a request with the raw bytes as its body and the
+offset it starts at, so no part goes over MAX_CONTENT_LENGTH and nothing is
+held in memory. after a dropped connection the client asks for the offset
+and goes on from there. the upload is complete when all its bytes are in.
+the spool files are in UPLOAD_SPOOL_FOLDER (default UPLOAD_FOLDER/spool),
+one folder an upload, the unfinished ones older than UPLOAD_SPOOL_HOURS
+(default 24) are removed when a new upload starts.
+'''
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+
+DATA = 'data'
+META = 'meta.json'
+BLOCK_SIZE = 1 << 16
+
+
+class OffsetError(ValueError):
+    '''the part does not start at the end of the spooled data'''
+
+    def __init__(self, offset):
+        super(OffsetError, self).__init__(
+            'upload is at offset {}'.format(offset))
+        self.offset = offset
+
+
+class SizeError(ValueError):
+    '''the part goes past the size of the upload'''
+
+    def __init__(self, offset, size):
+        super(SizeError, self).__init__(
+            'upload of {} bytes is at offset {}'.format(size, offset))
+        self.offset = offset
+        self.size = size
+
+
+class UploadSpool(object):
+    '''the spooled uploads of app'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def folder(self):
+        return self.app.config.get('UPLOAD_SPOOL_FOLDER') or os.path.join(
+            self.app.config.get('UPLOAD_FOLDER') or '.', 'spool')
+
+    def _path(self, upload_id, name=DATA):
+        if not upload_id.isalnum():
+            raise KeyError(upload_id)
+        return os.path.join(self.folder, upload_id, name)
+
+    def start(self, user_id, name, size):
+        '''new upload of size bytes, return its meta dict'''
+        if size is None or size < 0:
+            raise ValueError('size of the upload is required')
+        self.clean()
+        meta = dict(id=uuid.uuid4().hex, user_id=user_id, name=name,
+                    size=size, start_time=time.time())
+        os.makedirs(os.path.dirname(self._path(meta['id'])))
+        open(self._path(meta['id']), 'wb').close()
+        with open(self._path(meta['id'], META), 'w') as f:
+            json.dump(meta, f)
+        return self.get(meta['id'])
+
+    def get(self, upload_id):
+        '''meta dict of upload with its offset, None if there is none'''
+        try:
+            with open(self._path(upload_id, META)) as f:
+                meta = json.load(f)
+        except (KeyError, IOError):
+            return None
+        meta['offset'] = os.path.getsize(self._path(upload_id))
+        meta['complete'] = meta['offset'] == meta['size']
+        return meta
+
+    def append(self, upload_id, offset, stream):
+        '''
+        write stream at offset of upload, return the new offset.
+        a part going past the size of the upload is not written.
+        '''
+        with open(self._path(upload_id, META)) as f:
+            size = json.load(f)['size']
+        with open(self._path(upload_id), 'r+b') as f:
+            # the same part sent twice at once must not be written twice
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0, os.SEEK_END)
+            if f.tell() != offset:
+                raise OffsetError(f.tell())
+            while True:
+                block = stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                if f.tell() + len(block) > size:
+                    f.truncate(offset)
+                    raise SizeError(offset, size)
+                f.write(block)
+            return f.tell()
+
+    def path(self, upload_id):
+        '''path of the spooled data of upload'''
+        return self._path(upload_id)
+
+    def discard(self, upload_id):
+        shutil.rmtree(os.path.dirname(self._path(upload_id)), True)
+
+    def clean(self):
+        '''remove the uploads older than UPLOAD_SPOOL_HOURS'''
+        if not os.path.isdir(self.folder):
+            return
+        limit = time.time() - self.app.config.get(
+            'UPLOAD_SPOOL_HOURS', 24) * 3600
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            data = os.path.join(path, DATA)
+            if os.path.getmtime(
+                    data if os.path.isfile(data) else path) < limit:
+                shutil.rmtree(path, True)
+
+
+upload_spool = UploadSpool()
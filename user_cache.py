@@ -0,0 +1,196 @@
+# coding=utf-8
+'''
+cache of what the login/permission layer needs of a user: roles, address
+scope and active flag.
+all cached users carry the auth version they were loaded at. the version
+lives in a small file, so every process of the server sees a change on its
+next request; any commit touching users, roles or addresses writes a new
+version.
+'''
+import os
+import threading
+from uuid import uuid4
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import get_history
+from models import app, db, User, Role, Address, UserRoleAssoc
+
+
+class UserSnapshot(object):
+    '''auth related fields of a user at one auth version'''
+
+    __slots__ = ('id', 'name', 'active', 'address_id', 'role_names',
+                 'address_ids', 'version')
+
+    def __init__(self, id, name, active, address_id, role_names,
+                 address_ids, version):
+        self.id = id
+        self.name = name
+        self.active = active
+        self.address_id = address_id
+        self.role_names = role_names
+        self.address_ids = address_ids
+        self.version = version
+
+
+class CachedUser(object):
+    '''
+    current_user of one request, backed by a UserSnapshot.
+    other User attributes are read from the users row on first access.
+    '''
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._row = None
+
+    def __repr__(self):
+        return "<CachedUser(id={id},name='{name}',version='{version}')>".\
+            format(id=self.id, name=self.name, version=self.version)
+
+    id = property(lambda self: self.snapshot.id)
+    name = property(lambda self: self.snapshot.name)
+    active = property(lambda self: self.snapshot.active)
+    address_id = property(lambda self: self.snapshot.address_id)
+    role_names = property(lambda self: self.snapshot.role_names)
+    address_ids = property(lambda self: self.snapshot.address_ids)
+    version = property(lambda self: self.snapshot.version)
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = User.query.get(self.id)
+        return self._row
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.row, name)
+
+    def has_role(self, rolename):
+        return rolename in self.role_names
+
+    def is_active(self):
+        return self.active
+
+    def get_id(self):
+        return unicode('{}'.format(self.id))
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+
+class UserCache(object):
+    '''UserSnapshot of every user by id, dropped when auth version changes'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.version = None
+
+    @property
+    def version_file(self):
+        return app.config.get('AUTH_VERSION_FILE') or os.path.join(
+            app.config.get('UPLOAD_FOLDER') or '.', 'auth.version')
+
+    def current_version(self):
+        try:
+            with open(self.version_file) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def invalidate(self):
+        '''write a new auth version, all processes reload their users'''
+        path = self.version_file
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp = '{}.{}'.format(path, uuid4().hex)
+        with open(tmp, 'w') as f:
+            f.write(uuid4().hex)
+        os.rename(tmp, path)
+        with self.lock:
+            self.snapshots = {}
+            self.version = None
+
+    def get(self, user_id):
+        '''snapshot of user, None if no such user'''
+        version = self.current_version()
+        with self.lock:
+            if version != self.version:
+                self.snapshots = {}
+                self.version = version
+            snapshot = self.snapshots.get(user_id)
+        if snapshot is None:
+            snapshot = self.load(user_id, version)
+            if snapshot is not None:
+                with self.lock:
+                    if self.version == version:
+                        self.snapshots[user_id] = snapshot
+        return snapshot
+
+    def load(self, user_id, version):
+        user = User.query.options(joinedload('roles')).filter(
+            User.id == user_id).first()
+        if user is None:
+            return None
+        return UserSnapshot(
+            id=user.id,
+            name=user.name,
+            active=user.active,
+            address_id=user.address_id,
+            role_names=frozenset(role.name for role in user.roles),
+            address_ids=self.address_scope(user.address_id),
+            version=version)
+
+    @staticmethod
+    def address_scope(address_id):
+        '''ids of address and all its descendants, by one query'''
+        return Address.scope(address_id)
+
+
+user_cache = UserCache()
+
+_AUTH_FIELDS = {
+    User: ('name', '_password', 'active', 'address_id', 'roles'),
+    Role: ('name', ),
+    Address: ('parent_id', ),
+}
+
+
+def _auth_changed(session):
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (User, Role, Address, UserRoleAssoc)):
+            return True
+    for obj in session.dirty:
+        for key in _AUTH_FIELDS.get(type(obj), ()):
+            if get_history(obj, key).has_changes():
+                return True
+    return False
+
+
+@event.listens_for(Session, 'after_flush')
+def _check_auth_changes(session, flush_context):
+    if not session.info.get('auth_changed') and _auth_changed(session):
+        session.info['auth_changed'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _check_bulk_auth_changes(context):
+    if context.mapper.class_ in (User, Role, Address, UserRoleAssoc):
+        context.session.info['auth_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_user_cache(session):
+    if session.info.pop('auth_changed', False):
+        user_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_auth_changes(session, previous_transaction):
+    session.info.pop('auth_changed', None)